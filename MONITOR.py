@@ -2,31 +2,50 @@ import os, sys
 import json
 import time
 import multiprocessing
+import threading
+import signal
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, wait
 import utils.users as users
 import utils.data_io as data_io
 import utils.operate as operate
 import utils.unit_tests as unit_tests
 import utils.jobs as jobs
 import utils.clean as clean
+import utils.watcher as watcher
+import utils.log_tail as log_tail
+import utils.monitor_control as monitor_control
+import utils.metrics as metrics
+import utils.ring_log as ring_log
+import utils.develop as develop
+import utils.sheet as sheet
+import utils.queue as queue
+import utils.staging as staging
+import utils.dispatcher as dispatcher
 from utils.helpers import *
 
 running_processes = []
+log_cursors = log_tail.LogCursors()
+LOG_PATTERNS = {"GRPC error": 'grpc', "Could not open any log file": 'locked'}
+
+LOOP_SECONDS = metrics.histogram("monitor_loop_seconds", "Time of a MONITOR check (scan, marking and submitting recoveries)", ["kind"])
+SCAN_SECONDS = metrics.histogram("monitor_scan_seconds", "Time to classify the monitored jobs", ["kind"])
+TPU_STATUS_SECONDS = metrics.histogram("monitor_tpu_status_seconds", "Time of a gcloud TPU status query", ["tpu"])
+RECOVERY_SECONDS = metrics.histogram("monitor_recovery_seconds", "Time of a recovery action", ["action", "outcome"])
+DETECTED_TOTAL = metrics.counter("monitor_detected_jobs_total", "Failed jobs found by the scan", ["error"])
+RECOVERY_TOTAL = metrics.counter("monitor_recoveries_total", "Finished recovery actions", ["action", "outcome"])
+LOOPS_TOTAL = metrics.counter("monitor_loops_total", "MONITOR checks", ["kind"])
 
 def add_MONITOR_log(log):
-    data = data_io.read_and_lock_data()
+    # the ring log has its own file lock, logging does not touch data.json
     try:
-        data["MONITOR_logs"].append({
-            "time": get_abs_time_str(),
-            "msg": log
-        })
-        data_io.write_and_unlock_data(data)
+        ring_log.MONITOR_LOG.append({"time": get_abs_time_str(), "msg": log})
     except Exception as e:
         print(f"{FAIL} add_MONITOR_log: Failed to add log {log}: {e}")
-        data_io.release_lock_data()
 
-def show_MONITOR_log(timezone = 'us'):
-    data = data_io.read_data()
-    for log in data["MONITOR_logs"]:
+def show_MONITOR_log(timezone = 'us', hours = None):
+    since = time.time() - float(hours) * 3600 if hours is not None else None
+    for log in ring_log.MONITOR_LOG.read(since=since):
         cur_time = log["time"]
         msg = log["msg"]
         show_time = None
@@ -38,14 +57,20 @@ def show_MONITOR_log(timezone = 'us'):
             show_time = cur_time
         print(f"{LOG} {show_time}: {msg}")
 
-def check_job_status(job):
+def check_job_status(job, tpu_status = None, deadline = None):
+    """
+    tpu_status: the status of job["tpu"] if it is already known, otherwise it is queried here.
+    deadline: the time after which the result is not used any more, the log cursor is then not moved.
+    """
     if job["log_dir"] == '' or job["log_dir"] is None:
         return None
     tpu = job["tpu"]
     if tpu == '':
         print(f"{FAIL} check_job_status: tpu is empty")
         return None
-    tpu_status = operate.check_tpu_status(tpu)
+    if tpu_status is None:
+        with TPU_STATUS_SECONDS.time(tpu=tpu):
+            tpu_status = operate.check_tpu_status(tpu)
     if tpu_status == 'preempted':
         return 'preempted'
     
@@ -53,14 +78,16 @@ def check_job_status(job):
     if not os.path.exists(log_dir):
         print(f"{FAIL} check_tpu_status: log file {log_dir} not found")
         return None
-    with open(log_dir, 'r') as file:
-        lines = file.readlines()
-    for line in lines:
-        if "GRPC error" in line:
-            return 'grpc'
-        if "Could not open any log file" in line:
-            return 'locked'
-    return None
+    # only the bytes appended since the last check are scanned
+    pattern = log_cursors.find(job_key(job), log_dir, list(LOG_PATTERNS), deadline=deadline)
+    return LOG_PATTERNS.get(pattern)
+
+def flush_sheet(worker, ka):
+    # a multiprocessing child exits without running atexit, the sheet writes it queued are sent here
+    try:
+        sheet.flush()
+    except Exception as e:
+        add_MONITOR_log(f"{WARNING} {worker}: Failed to write the sheet rows of TPU {ka}: {e}")
 
 def reapply_worker(ka, result_queue):
     sys.stdout = open(os.devnull, 'w')
@@ -76,6 +103,8 @@ def reapply_worker(ka, result_queue):
         print(f"{FAIL} reapply_worker: Failed to reapply TPU {ka}: {e}")
         add_MONITOR_log(f"{FAIL} reapply_worker: Failed to reapply TPU {ka}: {e}")
         result_queue.put(e)
+    finally:
+        flush_sheet("reapply_worker", ka)
 
 def restart_worker(ka, result_queue):
     sys.stdout = open(os.devnull, 'w')
@@ -92,6 +121,8 @@ def restart_worker(ka, result_queue):
         print(f"{FAIL} restart_worker: Failed to restart TPU {ka}: {e}")
         add_MONITOR_log(f"{FAIL} restart_worker: Failed to restart TPU {ka}: {e}")
         result_queue.put(e)
+    finally:
+        flush_sheet("restart_worker", ka)
 
 def kill_resume(job):
     ka = job["tpu"]
@@ -113,13 +144,19 @@ def restart_rerun(job, timeout=900):
     result_queue = multiprocessing.Queue()
     process = multiprocessing.Process(target=restart_worker, args=(ka, result_queue))
     running_processes.append(process)
-    process.start()
-    process.join(timeout)
-    if process.is_alive():
-        print(f"Restart TPU {ka} timeout, killing the process")
-        process.terminate()
-        process.join()
+    killed = False
+    try:
+        process.start()
+        process.join(timeout)
+        if process.is_alive():
+            print(f"Restart TPU {ka} timeout, killing the process")
+            process.terminate()
+            process.join()
+            killed = True
+    finally:
+        # the process has ended on every path here, don't keep it for status() and shutdown
         running_processes.remove(process)
+    if killed:
         print(f"{WARNING} restart_rerun: Restart TPU {ka} failed, process killed")
     else:
         if not result_queue.empty():
@@ -141,13 +178,19 @@ def reapply_resume(job, timeout=900):
     result_queue = multiprocessing.Queue()
     process = multiprocessing.Process(target=reapply_worker, args=(ka, result_queue))
     running_processes.append(process)
-    process.start()
-    process.join(timeout)
-    if process.is_alive():
-        print(f"Reapply TPU {ka} timeout, killing the process")
-        process.terminate()
-        process.join()
+    killed = False
+    try:
+        process.start()
+        process.join(timeout)
+        if process.is_alive():
+            print(f"Reapply TPU {ka} timeout, killing the process")
+            process.terminate()
+            process.join()
+            killed = True
+    finally:
+        # the process has ended on every path here, don't keep it for status() and shutdown
         running_processes.remove(process)
+    if killed:
         print(f"{WARNING} reapply_resume: Reapply TPU {ka} failed, process killed")
     else:
         if not result_queue.empty():
@@ -162,20 +205,229 @@ def reapply_resume(job, timeout=900):
             print(f"{FAIL} reapply_resume: Reapply TPU {ka} failed, no result returned")
             add_MONITOR_log(f"{FAIL} reapply_resume: Reapply TPU {ka} failed, no result returned")
 
-def mainloop():
-    error_jobs = {'preempted': [], 'grpc': [], 'locked': []}
+class RecoveryScheduler:
+    """
+    Run the recovery actions (reapply_resume, kill_resume, kill_rerun, restart_rerun) in background threads,
+    so that mainloop does not block on them:
+    - at most zone_limit recoveries run at the same time in one zone (a new limit applies to the waiting ones at once)
+    - one recovery per TPU, if several failed jobs share a TPU only the newest one is recovered
+    - a TPU whose recovery is still in flight is skipped by the following loops
+    """
+    def __init__(self, zone_limit=2):
+        self.zone_limit = zone_limit
+        self.zone_running = {}  # zone -> recoveries running in it
+        self.inflight = {}      # tpu -> {"job", "action", "start"}
+        self.threads = {}       # tpu -> thread of its recovery
+        self.stopping = False
+        self.lock = threading.Lock()
+        self.slot_freed = threading.Condition(self.lock)
+
+    def set_zone_limit(self, zone_limit):
+        with self.lock:
+            if zone_limit != self.zone_limit:
+                self.zone_limit = zone_limit
+                self.slot_freed.notify_all()
+
+    @contextlib.contextmanager
+    def _zone_slot(self, zone):
+        with self.lock:
+            while self.zone_running.get(zone, 0) >= max(1, self.zone_limit):
+                if self.stopping:
+                    raise RuntimeError("MONITOR is stopping, recovery not started")
+                self.slot_freed.wait()
+            self.zone_running[zone] = self.zone_running.get(zone, 0) + 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.zone_running[zone] -= 1
+                self.slot_freed.notify_all()
+
+    def busy(self, tpu):
+        with self.lock:
+            return tpu in self.inflight
+
+    def status(self):
+        with self.lock:
+            return {tpu: dict(info) for tpu, info in self.inflight.items()}
+
+    def submit(self, job, error_type):
+        """
+        Start the recovery of job according to its rule for error_type.
+        Return False if there is nothing to do or the TPU is already being recovered.
+        """
+        rule = job["rules"][error_type]
+        if rule == 'pass' or rule not in ['reapply', 'resume', 'rerun', 'restart']:
+            return False
+        tpu = job["tpu"]
+        with self.lock:
+            if tpu in self.inflight or self.stopping:
+                return False
+            self.inflight[tpu] = {"job": job_key(job), "action": rule, "start": time.time()}
+            self.threads[tpu] = threading.Thread(target=self._run, args=(job, error_type, rule), daemon=True)
+            self.threads[tpu].start()
+        return True
+
+    def drain(self, deadline):
+        """
+        Start no more recoveries (the waiting ones give up) and wait until deadline (a time.time()) for the running ones,
+        which may hold the data lock. Return the TPUs whose recovery is still running.
+        """
+        with self.lock:
+            self.stopping = True
+            self.slot_freed.notify_all()
+            threads = dict(self.threads)
+        for thread in threads.values():
+            thread.join(max(0, deadline - time.time()))
+        return sorted(tpu for tpu, thread in threads.items() if thread.is_alive())
+
+    def _run(self, job, error_type, rule):
+        tpu = job["tpu"]
+        start = time.time()
+        outcome = 'error'
+        try:
+            zone, _, _, _ = get_zone_pre_spot(tpu)
+            with self._zone_slot(zone):
+                add_MONITOR_log(f"{INFO} RecoveryScheduler: start {rule} of job {job_key(job)} on TPU {tpu} (error type {error_type})")
+                start = time.time()
+                if rule == 'reapply':   reapply_resume(job, timeout=1800)
+                elif rule == 'resume':  kill_resume(job)
+                elif rule == 'rerun':   kill_rerun(job)
+                elif rule == 'restart': restart_rerun(job)
+            outcome = 'success' if recovered(job) else 'failed'
+            add_MONITOR_log(f"{INFO} RecoveryScheduler: {rule} of job {job_key(job)} on TPU {tpu} {outcome} in {time.time() - start:.0f} seconds")
+        except Exception as e:
+            print(f"{FAIL} RecoveryScheduler: Failed to handle job {job['windows_id']} for user {job['user']}, (error type {error_type}, rule {rule}): {e}")
+            add_MONITOR_log(f"{FAIL} RecoveryScheduler: Failed to handle job {job['windows_id']} for user {job['user']}, (error type {error_type}, rule {rule}): {e}")
+        finally:
+            RECOVERY_SECONDS.observe(time.time() - start, action=rule, outcome=outcome)
+            RECOVERY_TOTAL.inc(action=rule, outcome=outcome)
+            metrics.write_textfile()
+            with self.lock:
+                self.inflight.pop(tpu, None)
+                self.threads.pop(tpu, None)
+
+recovery = RecoveryScheduler()
+
+def recovered(job):
+    """
+    Whether job has been resumed or rerun (the recovery actions do not report their result).
+    """
     data = data_io.read_data()
-    print(f"{INFO} mainloop: checking jobs")
+    for jb in data["users"][job["user"]]["job_data"]:
+        if jb["windows_id"] == job["windows_id"]:
+            return jb["status"] in ['resumed', 'rerunned']
+    return False
+
+def job_key(job):
+    return f"{job['user']}:{job['windows_id']}"
+
+def job_age_key(job):
+    return (job.get("start_time", {}).get("utc", ""), job["windows_id"])
+
+def monitored_jobs(data):
+    """
+    Yield all the jobs that MONITOR is responsible for.
+    """
     for user in data["user_list"]:
         for job in data["users"][user]["job_data"]:
             if job['status'] in ['finished', 'rerunned', 'resumed', 'killed'] or not job['monitor']:
                 continue
-            if job['status'] == 'error' and job['error'] != 'unknown':
-                error_type = job['error']
+            yield job
+
+def timed_call(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+def parallel_check(job_list, workers, timeout):
+    """
+    Check the jobs in job_list with a pool of workers, return their error types in the same order.
+    The status of a TPU is queried only once however many jobs run on it, so the time of a loop is
+    about that of the slowest TPU. A check that does not finish within timeout seconds of the call gives None
+    (the job is checked again in the next loop, a late check leaves its log cursor alone).
+    """
+    start = time.time()
+    deadline = start + timeout
+    tpus = {job["tpu"] for job in job_list if job["log_dir"] and job["tpu"]}
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        tpu_futures = {tpu: pool.submit(timed_call, operate.check_tpu_status, tpu, True, timeout) for tpu in tpus}
+        wait(tpu_futures.values(), timeout=timeout)
+        tpu_status, latency, timed_out = {}, {}, []
+        for tpu, future in tpu_futures.items():
+            if future.done() and future.exception() is None:
+                tpu_status[tpu], latency[tpu] = future.result()
+                TPU_STATUS_SECONDS.observe(latency[tpu], tpu=tpu)
+            else:
+                timed_out.append(tpu)
+
+        job_futures = [None if job["tpu"] in timed_out else pool.submit(check_job_status, job, tpu_status.get(job["tpu"]), deadline)
+                       for job in job_list]
+        wait([future for future in job_futures if future is not None], timeout=max(0, deadline - time.time()))
+        results = []
+        for job, future in zip(job_list, job_futures):
+            if future is not None and future.done() and future.exception() is None:
+                results.append(future.result())
             else:
-                error_type = check_job_status(job)
-            if error_type in error_jobs:
-                error_jobs[error_type].append(job)
+                if future is not None:
+                    timed_out.append(job_key(job))
+                results.append(None)
+    finally:
+        pool.shutdown(wait=False)
+
+    elapsed = max(time.time() - start, 1e-6)
+    slowest = max(latency.items(), key=lambda x: x[1]) if latency else ('-', 0.0)
+    msg = (f"{INFO} parallel_check: checked {len(job_list)} jobs on {len(tpus)} TPUs with {workers} workers in {elapsed:.2f} seconds, "
+           f"parallelism {sum(latency.values()) / elapsed:.1f}x, slowest TPU {slowest[0]} ({slowest[1]:.2f} seconds)")
+    if timed_out:
+        msg += f", timed out: {timed_out}"
+    print(msg)
+    add_MONITOR_log(msg)
+    return results
+
+def scan_jobs(data, only=None):
+    """
+    Classify the monitored jobs, if only is given, only the jobs whose job_key is in only are checked.
+    With check_workers > 1 in MONITOR_config, the jobs are checked concurrently (see parallel_check).
+    """
+    config = data["MONITOR_config"]
+    error_jobs = {'preempted': [], 'grpc': [], 'locked': []}
+    to_check = []
+    for job in monitored_jobs(data):
+        if only is not None and job_key(job) not in only:
+            continue
+        if job['status'] == 'error' and job['error'] != 'unknown':
+            if job['error'] in error_jobs:
+                error_jobs[job['error']].append(job)
+        else:
+            to_check.append(job)
+
+    workers = config.get("check_workers", 1)
+    if workers > 1 and len(to_check) > 1:
+        results = parallel_check(to_check, workers, config.get("check_timeout", 120))
+    else:
+        results = [check_job_status(job) for job in to_check]
+    for job, error_type in zip(to_check, results):
+        if error_type in error_jobs:
+            error_jobs[error_type].append(job)
+    return error_jobs
+
+def mainloop(only=None):
+    kind = 'full' if only is None else 'event'
+    with LOOP_SECONDS.time(kind=kind):
+        _mainloop(only)
+    LOOPS_TOTAL.inc(kind=kind)
+
+def _mainloop(only=None):
+    data = data_io.read_data()
+    print(f"{INFO} mainloop: checking jobs" + (f" {sorted(only)}" if only is not None else ""))
+    with SCAN_SECONDS.time(kind='full' if only is None else 'event'):
+        error_jobs = scan_jobs(data, only)
+    for error_type in error_jobs:
+        if error_jobs[error_type]:
+            DETECTED_TOTAL.inc(len(error_jobs[error_type]), error=error_type)
+    log_cursors.save(keep=None if only is not None else [job_key(job) for job in monitored_jobs(data)])
 
     if len(error_jobs['locked']) != 0:
         error_windows_list = [(job['user'], job['windows_id']) for job in error_jobs['locked']]
@@ -199,80 +451,327 @@ def mainloop():
     if all_good:
         print(f"{INFO} mainloop: All jobs are good")
         
+    # one recovery per TPU, for the newest failed job on it
+    targets = {}
+    for error_type in error_jobs:
+        for job in error_jobs[error_type]:
+            newest = targets.get(job["tpu"])
+            if newest is None or job_age_key(job) > job_age_key(newest[0]):
+                targets[job["tpu"]] = (job, error_type)
+
     if not all_good:
         for error_type in error_jobs:
             for job in error_jobs[error_type]:
                 user = job["user"]
+                # the TPU runs the newest job, an older failed job on it is not recovered now or in a later loop
+                superseded = targets[job["tpu"]][0] is not job
                 data = data_io.read_and_lock_data()
                 try:
                     for jb in data["users"][user]["job_data"]:
                         if jb["windows_id"] == job["windows_id"]:
                             jb["status"] = 'error'
                             jb['error'] = error_type
+                            if superseded:
+                                jb['monitor'] = False
                     data_io.write_and_unlock_data(data)
                 except:
                     print(f"{FAIL} mainloop: Failed to update job {job['windows_id']} for user {user}")
                     add_MONITOR_log(f"{FAIL} mainloop: Failed to update job {job['windows_id']} for user {user}")
                     data_io.release_lock_data()
+                    continue
+                if superseded:
+                    add_MONITOR_log(f"{INFO} mainloop: job {job_key(job)} ({error_type}) is superseded by job {job_key(targets[job['tpu']][0])} on TPU {job['tpu']}, stop monitoring it")
 
     if not all_good:
-        for error_type in error_jobs:
-            for job in error_jobs[error_type]:
-                rule = job["rules"][error_type]
-                try:
-                    if rule == 'pass':      continue
-                    elif rule == 'reapply': reapply_resume(job, timeout=1800)
-                    elif rule == 'resume':  kill_resume(job)
-                    elif rule == 'rerun':   kill_rerun(job)
-                    elif rule == 'restart': restart_rerun(job)
-                except:
-                    print(f"{FAIL} mainloop: Failed to handle job {job['windows_id']} for user {user}, (error type {error_type}, rule {rule})")
-                    add_MONITOR_log(f"{FAIL} mainloop: Failed to handle job {job['windows_id']} for user {user}, (error type {error_type}, rule {rule})")
+        recovery.set_zone_limit(data["MONITOR_config"].get("recovery_zone_limit", 2))
+        for tpu, (job, error_type) in targets.items():
+            if recovery.busy(tpu):
+                print(f"{INFO} mainloop: recovery of TPU {tpu} is still in flight, skip job {job_key(job)}")
+                continue
+            if recovery.submit(job, error_type):
+                print(f"{INFO} mainloop: submitted recovery of job {job_key(job)} on TPU {tpu} (error type {error_type})")
+
+    if only is None:
+        staging.pump()
+        schedule_queue(data)
     
 
-if __name__ == "__main__":
+scheduler = {"thread": None}
+
+def schedule_queue(data):
+    """
+    Run queue.schedule_pass in the background (starting the jobs takes a while), unless a pass is still running.
+    """
+    if not data["MONITOR_config"].get("schedule_queue", True):
+        return
+    thread = scheduler["thread"]
+    if thread is not None and thread.is_alive():
+        return
+    scheduler["thread"] = threading.Thread(target=queue.schedule_pass, kwargs={"quiet": True}, daemon=True)
+    scheduler["thread"].start()
+
+def watch_targets(data):
+    """
+    The files the event-driven MONITOR watches: data.json and the output.log of every monitored job.
+    """
+    targets = {watcher.DATA_KEY: DATA_PATH}
+    for job in monitored_jobs(data):
+        if job.get("log_dir"):
+            targets[job_key(job)] = job["log_dir"] + "/output.log"
+    return targets
+
+# state of the MONITOR daemon, shared with the control socket thread
+daemon_state = {
+    "started": time.time(),
+    "mode": None,
+    "num_loops": 0,
+    "last_loop": None,
+    "paused": False,
+    "check_now": False,
+    "reload": False,
+    "stop": False,
+    "exit_code": 0,
+    "wake": threading.Event(),
+}
+RESTART_EXIT_CODE = 3 # monitor.sh restarts MONITOR unless it exits with 0
+CONTROL_SLICE = 2 # seconds, how often the event loop looks at the control state
+
+def control_handlers():
+    def ack(args):
+        daemon_state["check_now"] = True
+        daemon_state["wake"].set()
+        return {"msg": "full check scheduled" + (" (MONITOR is paused)" if daemon_state["paused"] else "")}
+    def status(args):
+        return {
+            "pid": os.getpid(),
+            "mode": daemon_state["mode"],
+            "uptime": f"{time.time() - daemon_state['started']:.0f} seconds",
+            "loops": daemon_state["num_loops"],
+            "last_loop": daemon_state["last_loop"],
+            "paused": daemon_state["paused"],
+            "recoveries": recovery.status(),
+            "running_processes": len(running_processes),
+            "log_cursors": len(log_cursors.cursors),
+        }
+    def pause(args):
+        daemon_state["paused"] = True
+        add_MONITOR_log(f"{WARNING} MONITOR paused")
+        return {}
+    def resume(args):
+        daemon_state["paused"] = False
+        daemon_state["wake"].set()
+        add_MONITOR_log(f"{INFO} MONITOR resumed")
+        return {}
+    def reload(args):
+        daemon_state["reload"] = True
+        daemon_state["check_now"] = True
+        daemon_state["wake"].set()
+        return {"msg": "MONITOR_config will be reloaded before the next check"}
+    def stop(args):
+        daemon_state["stop"] = True
+        daemon_state["wake"].set()
+        return {"msg": "MONITOR is stopping"}
+    return {"ack": ack, "status": status, "pause": pause, "resume": resume, "reload": reload, "stop": stop}
+
+def wait_control(timeout):
+    """
+    Wait for at most timeout seconds for a control command, return True if a full check is requested.
+    """
+    if timeout > 0 and daemon_state["wake"].wait(timeout):
+        daemon_state["wake"].clear()
+    if daemon_state["check_now"] and not daemon_state["paused"]:
+        daemon_state["check_now"] = False
+        return True
+    return False
+
+def finish_loop(num_loops, last_time):
+    time_used = time.time() - last_time # in seconds
+    daemon_state["num_loops"] = num_loops
+    daemon_state["last_loop"] = get_abs_time_str()
+    print(f"{INFO} Time: {convert_utcstr_to_edtstr(get_abs_time_str())}")
+    print(f"Loop {num_loops} finished, time used: {time_used:.2f} seconds")
+    add_MONITOR_log(f"{INFO} Loop {num_loops} finished, time used: {time_used:.2f} seconds")
+    metrics.write_textfile()
+    max_loops = data_io.read_data()["MONITOR_config"].get("max_loops", 0) # 0 for a persistent daemon
+    if max_loops and num_loops >= max_loops:
+        print(f"{GOOD} successfully run {num_loops} loops, exiting...")
+        add_MONITOR_log(f"{GOOD} successfully run {num_loops} loops, exiting...")
+        daemon_state["stop"] = True
+        daemon_state["exit_code"] = RESTART_EXIT_CODE
+
+def consume_ack():
+    """
+    Return True (and reset the flag) if the user acknowledged the MONITOR through data.json
+    (the fallback of tpu ack when the control socket is not reachable).
+    """
+    data = data_io.read_data()
+    if not data.get('ack_MONITOR'):
+        return False
+    print(f"{INFO} Acknowledged by user, start checking...")
+    data = data_io.read_and_lock_data()
+    data['ack_MONITOR'] = False
+    data_io.write_and_unlock_data(data)
+    return True
+
+def polling_loop():
+    num_loops = 0
+    while not daemon_state["stop"]:
+        data = data_io.read_data()
+        checking_freq = data["MONITOR_config"]["checking_freq"]
+        daemon_state["reload"] = False
+
+        last_time = time.time()
+        if not daemon_state["paused"]:
+            num_loops += 1
+            mainloop()
+            finish_loop(num_loops, last_time)
+        while time.time() - last_time < checking_freq and not daemon_state["stop"]:
+            if wait_control(min(10, checking_freq - (time.time() - last_time))):
+                break
+            if not daemon_state["paused"] and consume_ack():
+                break
+
+def event_loop():
+    """
+    Event-driven MONITOR: wake up as soon as a monitored output.log or data.json changes and only
+    classify the changed jobs. A full check still runs every checking_freq seconds, since a preempted
+    TPU may simply stop writing its log.
+    """
     num_loops = 0
-    last_test_time = time.time()
-    last_clean_time = time.time()
+    data = data_io.read_data()
+    log_watcher = None
+    last_checked = {}
+    pending = set()
+    last_full = 0
+    daemon_state["reload"] = True
+    try:
+        while not daemon_state["stop"]:
+            if daemon_state["reload"]:
+                daemon_state["reload"] = False
+                data = data_io.read_data()
+                config = data["MONITOR_config"]
+                if log_watcher is not None:
+                    log_watcher.close()
+                log_watcher = watcher.LogWatcher(poll_interval=config.get("event_poll_interval", 5))
+                min_interval = config.get("event_min_interval", 60) # per job, bounds the gcloud queries of chatty logs
+                log_watcher.set_targets(watch_targets(data))
+                add_MONITOR_log(f"{INFO} event_loop: watching logs, polling {len(log_watcher.polled_keys())} targets on NFS")
+
+            checking_freq = data["MONITOR_config"]["checking_freq"]
+            if wait_control(0):
+                last_full = 0
+            if not daemon_state["paused"] and time.time() - last_full >= checking_freq:
+                num_loops += 1
+                last_time = last_full = time.time()
+                mainloop()
+                last_checked = {key: last_time for key in last_checked}
+                pending.clear()
+                finish_loop(num_loops, last_time)
+                data = data_io.read_data()
+                continue
+
+            log_watcher.set_targets(watch_targets(data))
+            timeout = checking_freq - (time.time() - last_full)
+            if pending:
+                timeout = min(timeout, max(1, min(last_checked.get(k, 0) + min_interval for k in pending) - time.time()))
+            changed = log_watcher.wait(max(1, min(timeout, CONTROL_SLICE)))
+
+            if watcher.DATA_KEY in changed:
+                changed.discard(watcher.DATA_KEY)
+                data = data_io.read_data()
+                if not daemon_state["paused"]:
+                    schedule_queue(data) # a job finished or failed, or a TPU was released
+                if not daemon_state["paused"] and consume_ack():
+                    last_full = 0
+                    continue
+            pending |= changed
+            now = time.time()
+            due = {key for key in pending if now - last_checked.get(key, 0) >= min_interval}
+            if due and not daemon_state["paused"]:
+                pending -= due
+                for key in due:
+                    last_checked[key] = now
+                mainloop(only=due)
+                data = data_io.read_data()
+    finally:
+        if log_watcher is not None:
+            log_watcher.close()
+
+def shutdown(reason, timeout=60):
+    """
+    Stop the MONITOR gracefully: close the control socket, save the log cursors, terminate the
+    running recovery processes, then wait (at most timeout seconds in all) for the recovery threads,
+    the queue scheduling pass and the dispatcher, so that none is killed while it holds the data or queue lock.
+    """
+    if control_server is not None:
+        control_server.close()
+    if dispatcher_handle is not None:
+        dispatcher_handle[0].set()
+    log_cursors.save()
+    for process in list(running_processes):
+        if process.is_alive():
+            process.terminate()
+        process.join()
+    deadline = time.time() + timeout
+    left = recovery.drain(deadline)
+    threads = [scheduler["thread"]] + ([dispatcher_handle[1]] if dispatcher_handle is not None else [])
+    for thread in threads:
+        if thread is not None:
+            thread.join(max(0, deadline - time.time()))
+    left += [name for name, thread in zip(["scheduler", "dispatcher"], threads) if thread is not None and thread.is_alive()]
+    if left:
+        print(f"{WARNING} MONITOR: still running after {timeout} seconds, exiting anyway: {left}")
+        add_MONITOR_log(f"{WARNING} MONITOR: still running after {timeout} seconds, exiting anyway: {left}")
+    print(f"{INFO} MONITOR: {reason}, all processes killed")
+    add_MONITOR_log(f"{WARNING} MONITOR: {reason}, all processes killed")
+
+def handle_sigterm(signum, frame):
+    daemon_state["stop"] = True
+    daemon_state["wake"].set()
+
+control_server = None
+dispatcher_handle = None # (stop event, thread) of the dispatcher
+
+if __name__ == "__main__":
     print(f"{INFO} MONITOR: Starting MONITOR...")
+    develop.migrate_MONITOR_log()
     add_MONITOR_log(f"{GOOD} Starting monitor...")
 
     if data_io.check_code_lock():
         print(f"{FAIL} Code is locked for developing, please unlock it first.")
         sys.exit(1)
+    control_server = monitor_control.ControlServer(control_handlers())
     try:
-        while True:
-            data = data_io.read_data()
-            checking_freq, test_freq, clean_freq = data["MONITOR_config"]["checking_freq"], data["MONITOR_config"]["test_freq"], data["MONITOR_config"]["clean_freq"]
-
-            num_loops += 1
-            last_time = time.time()
-            mainloop()
-            time_used = time.time()- last_time # in seconds
-            print(f"{INFO} Time: {convert_utcstr_to_edtstr(get_abs_time_str())}")
-            print(f"Loop {num_loops} finished, time used: {time_used:.2f} seconds")
-            add_MONITOR_log(f"{INFO} Loop {num_loops} finished, time used: {time_used:.2f} seconds")
-            while time.time() - last_time < checking_freq:
-                data = data_io.read_data()
-                time.sleep(10)
-                if data['ack_MONITOR']:
-                    print(f"{INFO} Acknowledged by user, start checking...")
-                    data = data_io.read_and_lock_data()
-                    data['ack_MONITOR'] = False
-                    data_io.write_and_unlock_data(data)
-                    break
-            
-            if num_loops > 24:
-                print(f"{GOOD} successfully run {num_loops} loops, exiting...")
-                add_MONITOR_log(f"{GOOD} successfully run {num_loops} loops, exiting...")
-                sys.exit(0)
-                
+        control_server.start()
+    except RuntimeError as e:
+        print(f"{FAIL} MONITOR: {e}")
+        sys.exit(1)
+    except OSError as e:
+        print(f"{WARNING} MONITOR: Failed to open the control socket {MONITOR_SOCKET_PATH}: {e}, only the data.json ack works")
+        control_server = None
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    shutdown_timeout = 60 # seconds to wait for the recovery, scheduler and dispatcher threads on exit
+    try:
+        data = data_io.read_data()
+        metrics_port = data["MONITOR_config"].get("metrics_port", 9465) # 0 to disable
+        if metrics_port:
+            metrics.start_http_server(metrics_port)
+        registry_sync = data["MONITOR_config"].get("registry_sync", sheet.REGISTRY_SYNC_INTERVAL) # 0 to disable
+        if registry_sync:
+            sheet.start_registry_sync(registry_sync)
+        dispatch_interval = data["MONITOR_config"].get("dispatch_interval", dispatcher.POLL_INTERVAL) # 0 to disable
+        if dispatch_interval:
+            dispatcher_handle = dispatcher.start(dispatch_interval)
+        shutdown_timeout = data["MONITOR_config"].get("shutdown_timeout", shutdown_timeout)
+        if "--event" in sys.argv or data["MONITOR_config"].get("mode") == "event":
+            daemon_state["mode"] = "event"
+            event_loop()
+        else:
+            daemon_state["mode"] = "polling"
+            polling_loop()
+        shutdown("stopped", shutdown_timeout)
+        sys.exit(daemon_state["exit_code"])
     except KeyboardInterrupt:
         print("KeyboardInterrupt, exiting...")
-        # kill all the processes
-        for process in running_processes:
-            process.terminate()
-            process.join()
-        print("All processes killed")
-        add_MONITOR_log(f"{FAIL} KeyboardInterrupt, all processes killed")
-        sys.exit(1)
\ No newline at end of file
+        shutdown("KeyboardInterrupt", shutdown_timeout)
+        sys.exit(1)
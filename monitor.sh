@@ -1,6 +1,7 @@
 DIR="$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &>/dev/null && pwd )"
 
+# MONITOR runs as a daemon, exit code 0 means it was stopped on purpose (tpu -Mctl stop / SIGTERM)
 while true; do
-    python "$DIR/MONITOR.py"
+    python "$DIR/MONITOR.py" "$@" && break
     sleep 5
 done
@@ -13,7 +13,11 @@ import utils.sheet as sheet
 import utils.clean as clean
 import utils.autenticate as autenticate
 import utils.queue as queue
+import utils.runtime as runtime
+import utils.staging as staging
+import utils.dispatcher as dispatcher
 import utils.gs_buckets as gs_buckets
+import utils.monitor_control as monitor_control
 from utils.helpers import *
 
 
@@ -89,6 +93,22 @@ if __name__ == "__main__":
             )
         elif cmd == "dqr":
             queue.dequeue_and_run(args[2], args[3])
+        elif cmd == "staging":
+            staging.pump(quiet=False)
+            staging.report()
+        elif cmd == "runtime-report":
+            runtime.report()
+        elif cmd == "dispatcher":
+            # standalone dispatcher, may run along MONITOR's (the TPU claims prevent double booking)
+            interval = int(args[2]) if len(args) > 2 and args[2].isdigit() else dispatcher.POLL_INTERVAL
+            print(f"{INFO} dispatcher: watching the free TPUs every {interval}s, Ctrl+C to stop")
+            try:
+                dispatcher.Dispatcher(interval, quiet=False).run()
+            except KeyboardInterrupt:
+                pass
+        elif cmd == "schedule":
+            dispatched = queue.schedule_pass(dry_run="--dry" in args[2:])
+            print(f"{INFO} schedule: {len(dispatched)} task(s) {'matched' if '--dry' in args[2:] else 'started'}")
 
         # ------------ GS Buckets ------------
         elif cmd == "cp":
@@ -137,6 +157,11 @@ if __name__ == "__main__":
         # ------------ Spreadsheet Operations ------------
         elif cmd == "upd-status-spreadsheet" or cmd == "uss":
             operate.update_tpu_status_for_spreadsheet()
+        elif cmd == "sync-registry":
+            if "-loop" in args:
+                sheet.registry_sync_loop()
+            else:
+                print(f"{INFO} sync-registry: {sheet.sync_registry()} rows pushed to the sheet")
 
         # ------------ TPU registration ------------
         elif cmd == "add-tpu-alias" or cmd == "-ta" or cmd == "-ata":
@@ -225,7 +250,7 @@ if __name__ == "__main__":
         elif cmd == "get-monitor-config" or cmd == "-gmc":
             logger.get_monitor_config()
         elif cmd == "maj":
-            jobs.monitor_all_jobs()
+            jobs.monitor_all_jobs(args[2:])
         elif cmd == "caj":
             jobs.check_all_jobs(args[2:])
 
@@ -262,10 +287,12 @@ if __name__ == "__main__":
             (
                 develop.show_MONITOR_log()
                 if len(args) < 3
-                else develop.show_MONITOR_log(args[2])
+                else develop.show_MONITOR_log(*args[2:4])
             )
         elif cmd == "-Mc":
             develop.clear_MONITOR_log()
+        elif cmd == "-Mctl":
+            monitor_control.control_MONITOR(args[2:])
         elif cmd == "debug-stats":
             develop.debug_stats(args[2])
         elif cmd == "debug-kill":
@@ -276,6 +303,12 @@ if __name__ == "__main__":
             print(sheet.get_tpu_info_sheet(args[2]))
         elif cmd == "twsi":
             unit_tests.test_write_sheet_info(args[2])
+        elif cmd == "test-classifier":
+            unit_tests.test_classifier()
+        elif cmd == "bench-classifier":
+            unit_tests.bench_classifier(*args[2:4])
+        elif cmd == "bench-sheet":
+            unit_tests.bench_sheet(*args[2:4])
         elif cmd == "cc":
             (
                 gs_buckets.copy_checkpoint(args[2], args[3], src_zone=args[4])
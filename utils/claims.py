@@ -0,0 +1,61 @@
+import os, json, time, uuid, fcntl, socket
+from .constants import *
+from .data_io import _atomic_write_json
+
+CLAIM_TTL = 300     # seconds a TPU stays booked by a dispatcher: the start of the job and the staleness of the TPU snapshot
+
+
+class _ClaimsLock:
+    def __enter__(self):
+        self.file = open(CLAIMS_PATH + '.lock', 'a')
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+        return False
+
+
+def _load():
+    try:
+        with open(CLAIMS_PATH, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def claim(tpu, ttl=CLAIM_TTL):
+    """
+    Book tpu for ttl seconds, so that no other dispatcher (ack_queue, schedule_pass, the dispatcher daemon, dqr),
+    in this process or another, starts a job on it meanwhile.
+    Return the token of the claim (to release it), None if tpu already has an unexpired claim.
+    """
+    now = time.time()
+    token = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+    with _ClaimsLock():
+        claims = {name: c for name, c in _load().items() if c['until'] > now}
+        if tpu in claims:
+            return None
+        claims[tpu] = {'token': token, 'until': now + ttl}
+        _atomic_write_json(CLAIMS_PATH, claims)
+    return token
+
+
+def release(tpu, token):
+    """
+    Drop the claim token on tpu (the job could not be started).
+    """
+    with _ClaimsLock():
+        claims = _load()
+        if claims.get(tpu, {}).get('token') == token:
+            del claims[tpu]
+            _atomic_write_json(CLAIMS_PATH, claims)
+
+
+def claimed():
+    """
+    {tpu: claim} of the unexpired claims.
+    """
+    now = time.time()
+    return {name: c for name, c in _load().items() if c['until'] > now}
@@ -0,0 +1,130 @@
+import re
+from typing import NamedTuple, Optional, Tuple
+
+# messages that contain "error" but are harmless, they are skipped by the scan
+IGNORED_PATTERNS = [
+    "AttributeError: 'MessageFactory' object has no attribute 'GetPrototype'",
+    "ERROR: pip's dependency",
+    "lead to an error eventually; if no error is raised",
+]
+
+# (group, error kind written to the job, pattern), in the order of precedence
+ERROR_KINDS = [
+    ('oom', 'OOM', r'Allocation type'),
+    ('grpc', 'grpc', r'GRPC [Ee]rror'),
+    ('file', 'file error', r'python: No such file or directory'),
+    ('pointer', 'invalid pointer', r'Attempt to free invalid pointer'),
+    ('deadline', 'deadline exceeded', r'DEADLINE_EXCEEDED'),
+]
+
+STATE_PATTERNS = [
+    ('failed', r'Job failed|[eE]rror|FAIL'),
+    ('compiling', r'[cC]ompil(?:ing|ation|e)'),
+    ('sampling', r'[sS]ampling '),
+    ('epoch', r'[eE]poch\s(?P<epoch_n>[0-9]{1,6})'),
+    ('ep', r'ep\s*=\s*(?P<ep_n>[0-9]{1,4}(?:\.[0-9]{1,6})?)'),
+    ('initializing', r'[iI]nitializing'),
+    ('staging', r'[sS]taging'),
+]
+
+# one alternation for everything: the ignored messages come first so that the "error" inside them is consumed,
+# and the specific errors come before the generic one so that "GRPC Error" is reported as grpc
+MASTER_RE = re.compile('|'.join(
+    [f"(?P<ignored>{'|'.join(re.escape(p) for p in IGNORED_PATTERNS)})"]
+    + [f"(?P<{group}>{pattern})" for group, _, pattern in ERROR_KINDS]
+    + [f"(?P<{group}>{pattern})" for group, pattern in STATE_PATTERNS]
+))
+# groups that mean "this job has failed" when they show up in the cut
+FAILED_GROUPS = ('failed', 'grpc')
+
+
+class Classification(NamedTuple):
+    """
+    state: 'error', 'compiling', 'sampling', 'running', 'initializing', 'staging' or 'unknown'
+    epoch: the epoch text (e.g. '12' or '3.25') for 'sampling' and 'running', else None
+    error: the error kind for 'error' ('OOM', 'grpc', 'file error', 'invalid pointer', 'deadline exceeded', 'unknown')
+    span: (start, end) offsets in the text of the match that decided the result, None for 'unknown'
+    """
+    state: str
+    epoch: Optional[str] = None
+    error: Optional[str] = None
+    span: Optional[Tuple[int, int]] = None
+
+
+def classify(text, cut=None, history=None, history_kinds=None):
+    """
+    Classify a job from its tmux pane in one pass over the tail (the last cut characters, monitor_length).
+    Only if the tail shows a failure, the whole text is searched once more for the error kind, or what history()
+    returns if given (the whole pane history: text is only the captured tail, the cause may have scrolled out of it),
+    for the kinds in history_kinds only (default: all) when the caller looks elsewhere for the other ones.
+    The precedence is the one of check_jobs: error > compiling > sampling > epoch > ep= > initializing > staging.
+    """
+    cut_start = max(0, len(text) - cut) if cut is not None else 0
+    first = {}        # group -> first match in the tail
+    for m in MASTER_RE.finditer(text, cut_start):
+        group = m.lastgroup
+        if group != 'ignored' and group not in first:
+            first[group] = m
+
+    failed = [first[g] for g in FAILED_GROUPS if g in first]
+    if failed:
+        kind, span = find_error_kind(text)
+        if kind is None and history is not None:
+            # the span is only meaningful in text
+            kind, span = find_error_kind(history(), kinds=history_kinds)[0], None
+        if kind is not None:
+            return Classification('error', error=kind, span=span)
+        return Classification('error', error='unknown', span=min(failed, key=lambda m: m.start()).span())
+
+    if 'compiling' in first:
+        return Classification('compiling', span=first['compiling'].span())
+    if 'sampling' in first:
+        epoch = first.get('epoch') or first.get('ep')
+        return Classification('sampling', epoch=_epoch_of(epoch), span=first['sampling'].span())
+    for group in ('epoch', 'ep'):
+        if group in first:
+            return Classification('running', epoch=_epoch_of(first[group]), span=first[group].span())
+    for group in ('initializing', 'staging'):
+        if group in first:
+            return Classification(group, span=first[group].span())
+    return Classification('unknown')
+
+
+def _epoch_of(m):
+    if m is None:
+        return None
+    return m.group('epoch_n') if m.lastgroup == 'epoch' else m.group('ep_n')
+
+
+LOG_ERROR_RE = re.compile('|'.join(f"(?P<{group}>{pattern})" for group, _, pattern in ERROR_KINDS))
+
+
+def find_error_kind(text, kinds=None):
+    """
+    One pass over text (e.g. output.log), return (kind, span) of the error kind with the highest precedence
+    among kinds (default: all), or (None, None).
+    """
+    found = {}
+    for m in LOG_ERROR_RE.finditer(text):
+        if m.lastgroup not in found:
+            found[m.lastgroup] = m
+    for group, kind, _ in ERROR_KINDS:
+        if group in found and (kinds is None or kind in kinds):
+            return kind, found[group].span()
+    return None, None
+
+
+LOG_ERROR_BRE = re.compile(LOG_ERROR_RE.pattern.encode())
+KIND_OF_GROUP = {group: kind for group, kind, _ in ERROR_KINDS}
+
+
+def find_error_signatures(data, base=0):
+    """
+    One pass over bytes data (a region of output.log starting at byte base), return the error signatures
+    found as a list of (kind, byte offset in the file), the first occurrence of every kind, by offset.
+    """
+    found = {}
+    for m in LOG_ERROR_BRE.finditer(data):
+        if m.lastgroup not in found:
+            found[m.lastgroup] = base + m.start()
+    return sorted(((KIND_OF_GROUP[group], offset) for group, offset in found.items()), key=lambda x: x[1])
@@ -5,9 +5,21 @@ DATA_PATH = os.path.join(BASE_DIR, "data.json")
 MOUNTED_FILE = os.path.join(BASE_DIR, "mounted.json")
 LEGACY_PATH = os.path.join(BASE_DIR, "legacy.json")
 QUEUE_PATH = os.path.join(BASE_DIR, "queue.json")
+QUEUE_INDEX_PATH = os.path.join(BASE_DIR, "queue_index.json")
+STAGING_STATS_PATH = os.path.join(BASE_DIR, "staging_stats.json")
+STAGING_LOG_DIR = os.path.join(BASE_DIR, "staging_logs")
+CLAIMS_PATH = os.path.join(BASE_DIR, "tpu_claims.json")
 LOCK_PATH = os.path.join(BASE_DIR, "lock.json")
 SECRET_PATH = os.path.join(BASE_DIR, "secret.json")
 APPLY_PATH = os.path.join(BASE_DIR, "apply.json")
+LOG_CURSOR_PATH = os.path.join(BASE_DIR, "log_cursors.json")
+MONITOR_SOCKET_PATH = os.path.join(BASE_DIR, "MONITOR.sock")
+METRICS_PATH = os.path.join(BASE_DIR, "MONITOR.prom")
+MONITOR_LOG_DIR = os.path.join(BASE_DIR, "MONITOR_logs")
+PROGRESS_DIR = os.path.join(BASE_DIR, "progress")
+SHEET_CACHE_PATH = os.path.join(BASE_DIR, "sheet_cache.json")
+REGISTRY_PATH = os.path.join(BASE_DIR, "registry.json")
+SHEET_BUCKET_PATH = os.path.join(BASE_DIR, "sheet_bucket.json")
 
 MAX_LEGACY_LENGTH = 500
 PROJECT = 'he-vision-group'
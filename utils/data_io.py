@@ -1,5 +1,8 @@
 import fcntl, json, os, tempfile, time
 from .constants import *
+from .metrics import histogram
+
+DATA_LOCK_WAIT_SECONDS = histogram("data_lock_wait_seconds", "Time waited for the data.json lock")
 
 
 def _mutate_lock_file(mutator):
@@ -223,6 +226,7 @@ def lock_data():
 
 def read_and_lock_data():
     num_ack = 0
+    start = time.time()
     while True:
         num_ack += 1
         if _try_acquire_lock("data"):
@@ -236,6 +240,7 @@ def read_and_lock_data():
             raise Exception(
                 "Lock not released after 30 mins, this may indicate a deadlock. Please check the lock file and release it manually."
             )
+    DATA_LOCK_WAIT_SECONDS.observe(time.time() - start)
     try:
         with open(DATA_PATH, "r") as file:
             data = json.load(file)
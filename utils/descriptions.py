@@ -290,7 +290,8 @@ Default rules:
 Available `rule=` values:
 - `pre`, `resume`, `reapply`, `rerun`, `pass`.
 See all: `tpu check-rules`.
-- Immediate manual trigger for stuck job: `tpu ack` (MONITOR reacts ≤3 min).
+- Immediate manual trigger for stuck job: `tpu ack` (MONITOR reacts within seconds).
+- MONITOR daemon control: `tpu -Mctl status|pause|resume|reload|stop`.
 - `--log-stage` injects `config.stage` integer into script.
 
 {YELLOW}== User Settings=={NC}
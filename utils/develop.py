@@ -1,16 +1,18 @@
 from .data_io import read_and_lock_data, write_and_unlock_data, release_lock_data, read_data, write_data
 from .helpers import *
 from .constants import *
+from .ring_log import MONITOR_LOG
 import json, subprocess, os, time
 
 def clear_MONITOR_log():
-    data = read_and_lock_data()
-    data["MONITOR_logs"] = []
-    write_and_unlock_data(data)
+    MONITOR_LOG.clear()
 
-def show_MONITOR_log(timezone = 'us'):
-    data = read_data()
-    for log in data["MONITOR_logs"]:
+def show_MONITOR_log(timezone = 'us', hours = None):
+    """
+    Show the MONITOR logs, only those of the last hours hours if hours is given.
+    """
+    since = time.time() - float(hours) * 3600 if hours is not None else None
+    for log in MONITOR_LOG.read(since=since):
         cur_time = log["time"]
         msg = log["msg"]
         show_time = None
@@ -22,6 +24,28 @@ def show_MONITOR_log(timezone = 'us'):
             show_time = cur_time
         print(f"{show_time} {msg}")
 
+def migrate_MONITOR_log():
+    """
+    Move the MONITOR logs that are still in data.json into the ring log.
+    """
+    data = read_data()
+    if "MONITOR_logs" not in data:
+        return
+    data = read_and_lock_data()
+    try:
+        for log in data.get("MONITOR_logs", []):
+            try:
+                ts = time.mktime(time.strptime(log["time"], "%Y-%m-%d %H:%M:%S"))
+            except (KeyError, ValueError):
+                ts = 0
+            MONITOR_LOG.append({"ts": ts, "time": log.get("time", ""), "msg": log.get("msg", "")})
+        print(f"{INFO} migrate_MONITOR_log: moved {len(data.get('MONITOR_logs', []))} logs out of data.json")
+        data.pop("MONITOR_logs", None)
+        write_and_unlock_data(data)
+    except Exception as e:
+        print(f"{FAIL} migrate_MONITOR_log: Failed to migrate logs: {e}")
+        release_lock_data()
+
 def add_global_config(key, value):
     """
     Add a global configuration key-value pair to the data.json file.
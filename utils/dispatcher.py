@@ -0,0 +1,86 @@
+import time, threading
+from concurrent.futures import ThreadPoolExecutor
+from .constants import *
+from .data_io import read_queue
+from .sheet import read_sheet_info
+from .operate import check_tpu_status
+from . import queue, claims
+
+POLL_INTERVAL = 10           # seconds between two looks at the TPU snapshot
+READY_RECHECK = 60           # seconds between two gcloud checks of a free TPU that is not ready yet (creating, ...)
+
+
+class Dispatcher:
+    """
+    Watch the TPU snapshot (registry / sheet cache, see sheet.read_sheet_info) for the TPUs wanted by the queue that
+    become free, whatever freed them (a finished job, release, a new apply, a manual kill), and dispatch the queue
+    to them with a schedule_pass restricted to these TPUs. A free TPU that is not ready yet is checked again every
+    READY_RECHECK seconds. Several dispatchers may run (MONITOR, `tpu dispatcher`, ack_queue), the TPU claims
+    make sure only one of them starts a job on a TPU.
+    """
+    def __init__(self, interval=POLL_INTERVAL, quiet=True):
+        self.interval = interval
+        self.quiet = quiet
+        self.free = set()           # the wanted TPUs free in the last snapshot
+        self.tasks = set()          # the staged tasks of the last snapshot
+        self.not_ready = {}         # free TPU -> time of its last gcloud check
+
+    def poll(self):
+        """
+        Look at the snapshot once, dispatch to the TPUs that became free or ready. Return the dispatched (task_id, tpu).
+        """
+        staged = {(task_dict.get("other_info") or {}).get("task_id"): (task_dict.get("tpu_info") or {}).get("valid_tpu", [])
+                  for task_dict in read_queue() if (task_dict.get("job_info") or {}).get("stage_dir")}
+        wanted = {tpu for valid in staged.values() for tpu in valid}
+        # a newly staged task may use the TPUs that were already free
+        newly_wanted = {tpu for task_id, valid in staged.items() if task_id not in self.tasks for tpu in valid}
+        self.tasks = set(staged)
+        if not wanted:
+            self.free, self.not_ready = set(), {}
+            return []
+        information = read_sheet_info(max_age=self.interval)
+        free = {tpu for tpu, info in information.items() if tpu in wanted and info.get("running_status") == "free"}
+        free -= set(claims.claimed())
+        now = time.time()
+        due = (free - self.free) | (free & newly_wanted) | {tpu for tpu in free if now - self.not_ready.get(tpu, now) >= READY_RECHECK}
+        self.free = free
+        self.not_ready = {tpu: checked for tpu, checked in self.not_ready.items() if tpu in free}
+        if not due:
+            return []
+
+        ready = set()
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            states = dict(zip(due, pool.map(lambda tpu: check_tpu_status(tpu, quiet=True, timeout=60), due)))
+        for tpu, state in states.items():
+            if state == "ready":
+                ready.add(tpu)
+                self.not_ready.pop(tpu, None)
+            else:
+                self.not_ready[tpu] = now
+        if not ready:
+            return []
+        if not self.quiet:
+            print(f"{INFO} Dispatcher: TPUs free and ready: {sorted(ready)}")
+        return queue.schedule_pass(quiet=self.quiet, tpus=ready, checked=True)
+
+    def run(self, stop=None):
+        """
+        Poll until stop (a threading.Event) is set.
+        """
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"{WARNING} Dispatcher: poll failed: {e}")
+            stop.wait(self.interval)
+
+
+def start(interval=POLL_INTERVAL):
+    """
+    Run a Dispatcher in a daemon thread (MONITOR), return (the Event that stops it, the thread).
+    """
+    stop = threading.Event()
+    thread = threading.Thread(target=Dispatcher(interval).run, args=(stop,), daemon=True)
+    thread.start()
+    return stop, thread
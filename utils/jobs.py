@@ -1,13 +1,17 @@
-import os, re, time, json, copy, subprocess
+import os, re, time, json, copy, mmap, subprocess, threading, functools
 from .helpers import *
 from .constants import *
 from . import users
 from .data_io import read_and_lock_data, write_and_unlock_data, release_lock_data, read_data, read_and_lock_legacy, write_legacy, write_and_unlock_legacy, release_lock_legacy
 from .operate import check_tpu_status, apply_and_set_env, kill_jobs_tpu, restart, check_tpu_running, mount_disk
-from .sheet import get_tpu_info_sheet, write_sheet_info, read_tpu_info_from_type, find_tpu_from_type
+from .sheet import get_tpu_info_sheet, write_sheet_info, read_tpu_info_from_type, find_tpu_from_type, format_snapshot_age
 from .logger import get_wandb_notes, register_tpu_and_write_spreadsheet, register_tpu_quick, check_reserved_user, zhan
 from .autenticate import autenticate
 from .gs_buckets import check_gs_logdir_exists
+from .monitor_control import send_command
+from .classifier import classify, find_error_signatures, ERROR_KINDS
+from . import tmux, tmux_stream, progress
+from .screen import DiffRenderer
 
 # --- ANSI helpers ---
 ANSI_RE = re.compile(r'\x1B\[[0-?]*[ -/]*[@-~]')
@@ -42,27 +46,28 @@ def _print_in_columns(blocks, num_columns=2, gap=" │ "):
 
     Each block is a list of lines (may include ANSI color).
     """
-    import math
-
-    # safe fallbacks
     from shutil import get_terminal_size
-    term_width = get_terminal_size((120, 20)).columns
-    col_width = (term_width - (num_columns - 1) * len(gap) - 4) // num_columns  # inner width
+    for line in _column_lines(blocks, num_columns, get_terminal_size((120, 20)).columns, gap=gap):
+        print(line)
 
-    # utility: ANSI-safe pad
-    import re
-    ANSI = re.compile(r'\x1b\[[0-9;]*m')
-    def visible_len(s):
-        return len(ANSI.sub('', s))
-    def ansi_ljust(s, width):
-        return s + ' ' * max(0, width - visible_len(s))
 
-    # horizontal border pieces
+@functools.lru_cache(maxsize=8)
+def _column_frame(term_width, num_columns, gap=" │ "):
+    # the layout only depends on the terminal width, computed once per size
+    col_width = (term_width - (num_columns - 1) * len(gap) - 4) // num_columns  # inner width
     horiz = "─" * col_width
     top    = "┌" + "┬".join([horiz] * num_columns) + "┐"
     mid    = "├" + "┼".join([horiz] * num_columns) + "┤"
     bottom = "└" + "┴".join([horiz] * num_columns) + "┘"
+    return col_width, top, mid, bottom
+
 
+def _column_lines(blocks, num_columns, term_width, gap=" │ "):
+    """
+    The lines of the bordered table of _print_in_columns, for a terminal term_width wide.
+    """
+    col_width, top, mid, bottom = _column_frame(term_width, num_columns, gap)
+    lines = []
     # iterate rows of blocks
     for i in range(0, len(blocks), num_columns):
         row_blocks = blocks[i:i + num_columns]
@@ -72,17 +77,18 @@ def _print_in_columns(blocks, num_columns=2, gap=" │ "):
         # row height
         h = max(len(b) for b in row_blocks)
         if i == 0:
-            print(top)
+            lines.append(top)
         for r in range(h):
             line_parts = []
             for b in row_blocks:
                 cell = b[r] if r < len(b) else ""
-                line_parts.append(ansi_ljust(cell, col_width))
-            print("│" + "│".join(line_parts) + "│")
+                line_parts.append(_ansi_ljust(cell, col_width))
+            lines.append("│" + "│".join(line_parts) + "│")
         if i + num_columns < len(blocks):
-            print(mid)
+            lines.append(mid)
         else:
-            print(bottom)
+            lines.append(bottom)
+    return lines
 
 
 
@@ -110,7 +116,7 @@ def _kv_rows_to_block(rows):
 
 
 # ---------- render one job to rows ----------
-def _render_rows_for_job(job_data, msg, last_line, last_line_cut, config, user_obj):
+def _render_rows_for_job(job_data, msg, last_line, last_line_cut, config, user_obj, history=None):
     # returns the rows (list of (key,value)) for this job, and may trigger side-effects like write_error_to_job/ack
     rows = []
     # Base guard
@@ -165,84 +171,27 @@ def _render_rows_for_job(job_data, msg, last_line, last_line_cut, config, user_o
 
     # running / starting (detailed parsing)
     if status in ('running', 'starting'):
-        # Error patterns
-        if (re.search(r'Job failed', last_line_cut) or
-            re.search(r'[eE]rror', last_line_cut) or
-            re.search(r'FAIL', last_line_cut)) and 's' in config:
-
-            if re.search(r'Allocation type', last_line):
-                rows += [("Status", f"{RED}OOM Error{NC}")]
-                write_error_to_job(user_obj, job_data, 'OOM')
-
-            elif re.search(r'GRPC [Ee]rror', last_line):
-                rows += [("Status", f"{RED}GRPC Error{NC}")]
-                write_error_to_job(user_obj, job_data, 'grpc')
-                ack_MONITOR()
-
-            elif re.search(r'python: No such file or directory', last_line):
-                rows += [("Status", f"{RED}File Error{NC}")]
-                write_error_to_job(user_obj, job_data, 'file error')
-                ack_MONITOR()
-
-            elif re.search(r'DEADLINE_EXCEEDED', last_line):
-                rows += [("Status", f"{RED}DEADLINE EXCEEDED{NC}")]
-                write_error_to_job(user_obj, job_data, 'deadline exceeded')
-                ack_MONITOR()
-
-            else:
-                rows += [("Status", f"{RED}Unknown Error{NC}")]
-                write_error_to_job(user_obj, job_data, 'unknown')
+        result = classify(last_line, cut=len(last_line_cut), history=history)
+        if result.state == 'error':
+            label = {'OOM': 'OOM Error', 'grpc': 'GRPC Error', 'file error': 'File Error',
+                     'deadline exceeded': 'DEADLINE EXCEEDED', 'invalid pointer': 'Invalid Pointer'}.get(result.error, 'Unknown Error')
+            rows += [("Status", f"{RED}{label}{NC}")]
+            write_error_to_job(user_obj, job_data, result.error)
+            if result.error != 'OOM':
                 ack_MONITOR()
             return rows
 
-        # Activity patterns
-        if (re.search(r'[cC]ompiling', last_line_cut) or
-            re.search(r'[cC]ompilation', last_line_cut) or
-            re.search(r'[cC]ompile', last_line_cut)) and 's' in config:
-            rows += [("Status", f"{GREEN}Compiling{NC}")]
-            if 'v' in config:
-                rows.append(("msg", msg))
-            return rows
-
-        if re.search(r'[sS]ampling ', last_line_cut) and 's' in config:
-            epoch = None
-            m1 = re.search(r'[eE]poch\s([0-9]{1,6})', last_line_cut)
-            m2 = re.search(r'ep=([0-9]){1,4}\.([0-9]){1,6}', last_line_cut)
-            if m1:
-                epoch = m1.group(1)
-            elif m2:
-                epoch = m2.group(0)[3:]
-            rows += [("Status", f"{GREEN}Sampling{NC}")]
-            if epoch is not None:
-                rows.append(("Epoch", f"{int(float(epoch))}"))
-            if 'v' in config:
-                rows.append(("msg", msg))
-            return rows
-
-        m_epoch1 = re.search(r'[eE]poch\s([0-9]{1,6})', last_line_cut)
-        if m_epoch1 and ('s' in config):
-            epoch = m_epoch1.group(1)
-            rows += [("Status", f"{GREEN}Running{NC}(ep={epoch})")]
-            if 'v' in config:
-                rows.append(("msg", msg))
-            return rows
-
-        m_epoch2 = re.search(r"ep\s*=\s*([0-9]{1,4}(?:\.[0-9]{1,6})?)", last_line_cut)
-        if m_epoch2 and ('s' in config):
-            epoch = m_epoch2.group(0).split('=')[1].strip()
-            rows += [("Status", f"{GREEN}Running{NC}(ep={float(epoch):.2f})")]
-            if 'v' in config:
-                rows.append(("msg", msg))
-            return rows
-
-        if re.search(r'[iI]nitializing', last_line_cut) and 's' in config:
-            rows += [("Status", f"{GREEN}Initializing{NC}")]
-            if 'v' in config:
-                rows.append(("msg", msg))
-            return rows
-
-        if re.search(r'[sS]taging', last_line_cut) and 's' in config:
-            rows += [("Status", f"{GREEN}Staging{NC}")]
+        if result.state != 'unknown':
+            if result.state == 'running' and '.' in result.epoch:
+                rows += [("Status", f"{GREEN}Running{NC}(ep={float(result.epoch):.2f})")]
+            elif result.state == 'running':
+                rows += [("Status", f"{GREEN}Running{NC}(ep={result.epoch})")]
+            else:
+                rows += [("Status", f"{GREEN}{result.state.capitalize()}{NC}")]
+                if result.epoch is not None:
+                    rows.append(("Epoch", f"{int(float(result.epoch))}"))
+            if result.state in ('running', 'sampling'):
+                rows += _progress_rows(job_data, result.epoch, user_obj)
             if 'v' in config:
                 rows.append(("msg", msg))
             return rows
@@ -255,6 +204,19 @@ def _render_rows_for_job(job_data, msg, last_line, last_line_cut, config, user_o
 
     return rows
 
+def _progress_rows(job_data, epoch, user_obj):
+    # record the epoch, and show the throughput / ETA, or how long the job has not advanced if it is stalled
+    stall_minutes = user_obj.settings.get('stall_minutes', progress.STALL_MINUTES)
+    summary = progress.observe(job_data, epoch, stall_minutes=stall_minutes)
+    if summary is None:
+        return []
+    if summary['stalled']:
+        return [("Stalled", f"{RED}no progress for {progress.format_duration(summary['idle'])}{NC}")]
+    rows = [("Speed", progress.format_rate(summary['rate']))]
+    if summary['eta'] is not None:
+        rows.append(("ETA", progress.format_duration(summary['eta'])))
+    return rows
+
 class Job:
     def __init__(
         self,
@@ -1047,7 +1009,7 @@ def run(user_obj, args, monitor_job = True):
     # Check the spreadsheet for the TPU information
     print(f"{INFO} run: Checking the TPU information in the spreadsheet..., tpu: {tpu}")
     tpu_info = get_tpu_info_sheet(tpu)
-    print(f"{INFO} run: TPU {tpu} information in the spreadsheet: {tpu_info}")
+    print(f"{INFO} run: TPU {tpu} information in the spreadsheet {format_snapshot_age()}: {tpu_info}")
     running_status, running_user, notes = tpu_info['running_status'], tpu_info['user'], tpu_info['user_note']
     if running_user != user_obj.spreadsheet_name and (running_status == 'running' or running_status == 'reserved') and (not '--auto' in args):
         print(f"{WARNING} run: TPU {tpu} is already {RED}{running_status}{NC} by {running_user} in the spreadsheet")
@@ -1236,7 +1198,11 @@ def monitor_all_jobs(args):
     """
     try:
         while True:
-            check_all_jobs()
+            data = read_data()
+            # check_jobs reads the windows of every user from the control-mode streams from the second refresh on
+            for user in data['users'].values():
+                tmux_stream.HUB.watch(user['tmux_name'])
+            check_all_jobs(args)
             data = read_data()
             sleep_time = data["monitor_all_check_time"] if "monitor_all_check_time" in data else 20
             time.sleep(sleep_time)
@@ -1244,6 +1210,7 @@ def monitor_all_jobs(args):
             os.system('clear' if os.name == 'posix' else 'cls')
     except KeyboardInterrupt:
         print(f"\n{INFO} Stopping monitor...")
+        tmux_stream.HUB.close()
         return
 
 def write_error_to_job(user_obj, job_data, error):
@@ -1305,15 +1272,10 @@ def check_jobs(user_obj, args, config = None):
     
 
     session_name = user_obj.tmux_name
-    windows = os.popen(f"tmux list-windows -t {session_name}").read().splitlines()
-    for window in windows:
-        window_id = window.split(':')[0]
-        window_name = window.split(':')[1].split(' ')[0]
-        job_data = None
-        for job in user_obj.job_data:
-            if str(job['windows_id']) == str(window_id):
-                job_data = job
-                break
+    jobs_by_window = tmux.job_index(user_obj.job_data)
+    for window in tmux.windows_of(session_name):
+        window_id = window.index
+        job_data = jobs_by_window.get(window_id)
         if job_data is None:
             if window_id != '0' and 'w' in config:
                 print(f'Window {window_id} (NOT FOUND IN DATA)')
@@ -1362,10 +1324,10 @@ def check_jobs(user_obj, args, config = None):
             if 'z' in config:
                 zone, _, _, _ = get_zone_pre_spot(job_data['tpu'])
                 print(f"ZONE: {zone}")
-        last_line = os.popen(f"tmux capture-pane -t {session_name}:{window_id} -p -S -").read()
-        last_line = last_line.rstrip()
         show_length = user_obj.settings['show_length']
         monitor_length = user_obj.settings['monitor_length']
+        # streamed by tmux control mode in tpu monitor, else the capture is skipped when nothing was printed since the last refresh
+        last_line = tmux_stream.pane_tail(session_name, window_id, chars=max(monitor_length, show_length), activity=window.activity)
         monitor_verbose = user_obj.settings['monitor_verbose']
         last_line_cut = last_line[-monitor_length:]
         msg = last_line_cut[-show_length:]
@@ -1403,88 +1365,59 @@ def check_jobs(user_obj, args, config = None):
                 print('-'*40)
                 continue
             elif job_data["status"] == 'running' or job_data["status"] == 'starting':
-                exclude_ = [
-                    "AttributeError: 'MessageFactory' object has no attribute 'GetPrototype'",
-                    "ERROR: pip's dependency",
-                    "lead to an error eventually; if no error is raised",
-                ]
-                # if detect something in exclude_, delete it. do this recursively
-                while True:
-                    found = False
-                    for ex in exclude_:
-                        if re.search(ex, last_line_cut):
-                            found = True
-                            last_line_cut = last_line_cut.replace(ex, '')
-                    if not found: break
-                if (re.search(r'Job failed', last_line_cut) or re.search(r'[eE]rror', last_line_cut) or re.search(r'FAIL', last_line_cut)) and 's' in config:
-                    # read the logdir
-                    logfile = read_head_tail(job_data['log_dir']+'/output.log', n=500)
-                    if re.search(r'Allocation type', last_line):
-                        print(f"Status: {RED}OOM Error{NC}\nmsg: {msg}")
-                        write_error_to_job(user_obj, job_data, 'OOM')
-                    elif re.search(r'GRPC [Ee]rror', last_line):
-                        print(f"Status: {RED}GRPC Error{NC}\nmsg: {msg}")
-                        write_error_to_job(user_obj, job_data, 'grpc')
-                        ack_MONITOR()
-                    elif re.search(r'python: No such file or directory', logfile):
-                        print(f"Status: {RED}没mount, 啥比{NC}\nmsg: {msg}")
-                        write_error_to_job(user_obj, job_data, 'file error')
-                        ack_MONITOR()
-                    elif re.search(r'Attempt to free invalid pointer', logfile):
-                        print(f"Status: {RED}invalid pointer{NC}\nmsg: {msg}")
-                        write_error_to_job(user_obj, job_data, 'invalid pointer')
+                # an OOM / grpc error is looked up in the whole pane history if the captured tail does not show it,
+                # the other kinds in the log below
+                result = classify(last_line, cut=len(last_line_cut), history=lambda: tmux.capture_pane(session_name, window_id),
+                                  history_kinds=['OOM', 'grpc'])
+                if result.state == 'error':
+                    error = result.error
+                    evidence = None
+                    if error not in ['OOM', 'grpc']:
+                        # the pane may not show the cause, look it up in the head and tail of the log
+                        error = 'unknown'
+                        try:
+                            signatures = dict(scan_log_errors(job_data['log_dir']+'/output.log', n=500))
+                        except (OSError, TypeError):
+                            signatures = {}
+                        for _, kind, _ in ERROR_KINDS:
+                            if kind in ['file error', 'invalid pointer', 'deadline exceeded'] and kind in signatures:
+                                error, evidence = kind, signatures[kind]
+                                break
+                    label = {'OOM': 'OOM Error', 'grpc': 'GRPC Error', 'file error': '没mount, 啥比',
+                             'invalid pointer': 'invalid pointer', 'deadline exceeded': 'DEADLINE EXCEEDED'}.get(error, 'Unknown Error')
+                    print(f"Status: {RED}{label}{NC}\nmsg: {msg}")
+                    if evidence is not None and 'v' in config:
+                        print(f"evidence: {error} at byte {evidence} of output.log")
+                    write_error_to_job(user_obj, job_data, error)
+                    if error != 'OOM':
                         ack_MONITOR()
-                    elif re.search(r'DEADLINE_EXCEEDED', logfile):
-                        print(f"Status: {RED}DEADLINE EXCEEDED{NC}\nmsg: {msg}")
-                        write_error_to_job(user_obj, job_data, 'deadline exceeded')
-                        ack_MONITOR()
-                    else:
-                        # print(f"{RED}last line cut: {last_line}{NC}")
-                        print(f"Status: {RED}Unknown Error{NC}\nmsg: {msg}")
-                        write_error_to_job(user_obj, job_data, 'unknown')
-                        ack_MONITOR()
-                elif (re.search(r'[cC]ompiling', last_line_cut) or re.search(r'[cC]ompilation', last_line_cut) or re.search(r'[cC]ompile', last_line_cut)) and 's' in config:
+                elif result.state == 'compiling':
                     print(f"Status: {GREEN}Compiling{NC}")
                     if 'v' in config: print(f"msg: {msg}")
-                elif re.search(r'[sS]ampling ', last_line_cut) and 's' in config:
-                    epoch = None
-                    if re.search(r'[eE]poch\s([0-9]{1,4})', last_line_cut):
-                        epoch = re.search(r'[eE]poch\s([0-9]{1,6})', last_line_cut).group(1)
-                    elif re.search(r'ep=([0-9]){1,4}\.([0-9]){1,6}', last_line_cut):
-                        epoch = re.search(r'ep=([0-9]){1,4}\.([0-9]){1,6}', last_line_cut).group(0)[3:]
-                    if epoch is not None:
-                        print(f"Status: {GREEN}Sampling{NC} (in epoch {int(float(epoch))})")
+                elif result.state == 'sampling':
+                    if result.epoch is not None:
+                        print(f"Status: {GREEN}Sampling{NC} (in epoch {int(float(result.epoch))})")
                     else:
                         print(f"Status: {GREEN}Sampling{NC}")
                     if 'v' in config:
                         print(f"msg: {msg}")
-
-                elif re.search(r'[eE]poch\s([0-9]{1,4})', last_line_cut) and ('s' in config):
-                    epoch = re.search(r'[eE]poch\s([0-9]{1,6})', last_line_cut).group(1)
+                elif result.state == 'running':
+                    epoch = result.epoch if '.' not in result.epoch else f"{float(result.epoch):.2f}"
                     print(f"Status: {GREEN}Running{NC} (ep={epoch})")
                     if 'v' in config: print(f"msg: {msg}")
-                elif re.search(r'ep\s*=\s*([0-9]){1,4}\.([0-9]){1,6}', last_line_cut) and ('s' in config):
-                    epoch = re.search(r'ep\s*=\s*([0-9]){1,4}\.([0-9]){1,6}', last_line_cut).group(0).split('=')[1]
-                    epoch = epoch.strip()
-                    print(f"Status: {GREEN}Running{NC} (ep={float(epoch):.2f})")
-                    if 'v' in config: print(f"msg: {msg}")
-                elif re.search(r'[iI]nitializing', last_line_cut) and 's' in config:
+                elif result.state == 'initializing':
                     print(f"Status: {GREEN}Initializing{NC}")
                     if 'v' in config: print(f"msg: {msg}")
-                elif re.search(r'[sS]taging', last_line_cut) and 's' in config:
-                    # if '纳' in config:
-                        # raise MAX_LEGACY_LENGTH
+                elif result.state == 'staging':
                     print(f"Status: {GREEN}Staging{NC}") if '纳' not in config else print(f"Status: {RED}Staging{NC}")
                     if 'v' in config: print(f"msg: {msg}")
-                elif 's' in config:
+                else:
                     print(f"Status: {YELLOW}Unknown{NC}\nmsg: {msg}")
-                    # print(f"last line: {last_line_cut}")
-                    # print(re.search(r'ep=([0-9]){1,4}\.([0-9]){1,6}', last_line_cut))
         print('-'*40)
 
-def check_jobs_simp(user_obj, args, config = None, num_columns = 3):
+def check_jobs_simp(user_obj, args, config = None, num_columns = 3, renderer = None):
     """
-    Print the status of all the jobs in the tmux session.
+    Print the status of all the jobs in the tmux session (or draw them with renderer, a DiffRenderer).
     """
 
     num_columns = 3
@@ -1508,18 +1441,12 @@ def check_jobs_simp(user_obj, args, config = None, num_columns = 3):
     session_name = user_obj.tmux_name
     job_blocks = []
 
-    windows = os.popen(f"tmux list-windows -t {session_name}").read().splitlines()
+    jobs_by_window = tmux.job_index(user_obj.job_data)
 
-    for window in windows:
-        window_id = window.split(':')[0]
-        window_name = window.split(':')[1].split(' ')[0]
-
-        # find job_data by window id
-        job_data = None
-        for job in user_obj.job_data:
-            if str(job.get('windows_id')) == str(window_id):
-                job_data = job
-                break
+    # one list-windows call for all the sessions
+    for window in tmux.windows_of(session_name):
+        window_id = window.index
+        job_data = jobs_by_window.get(window_id)
 
         # If job not found in data
         if job_data is None:
@@ -1566,16 +1493,19 @@ def check_jobs_simp(user_obj, args, config = None, num_columns = 3):
                 rows_meta.append(("ZONE", "(unknown)"))
 
         # ---------- Capture pane & compute msg ----------
-        last_line = os.popen(f"tmux capture-pane -t {session_name}:{window_id} -p -S -").read().rstrip()
         show_length = user_obj.settings['show_length']
         monitor_length = user_obj.settings['monitor_length']
+        # streamed by tmux control mode in tpu monitor, else the capture is skipped when nothing was printed since the last refresh
+        last_line = tmux_stream.pane_tail(session_name, window_id, chars=max(monitor_length, show_length), activity=window.activity)
         monitor_verbose = user_obj.settings['monitor_verbose']  # kept for parity; not directly used here
         last_line_cut = last_line[-monitor_length:]
         msg = last_line_cut[-show_length:]
 
         # ---------- Status rows via your helper (does side-effects like write_error_to_job/ack) ----------
         # Assumes your helper implements suppression via _kv_rows_to_block/_suppress_preview:
-        rows_status = _render_rows_for_job(job_data, msg, last_line, last_line_cut, config, user_obj)
+        # the error kind is looked up in the whole pane history if the captured tail does not show it
+        rows_status = _render_rows_for_job(job_data, msg, last_line, last_line_cut, config, user_obj,
+                                           history=lambda: tmux.capture_pane(session_name, window_id))
 
         # If there was no status to show (e.g., 's' not in config), still add meta-only block if any meta exists
         combined_rows = rows_meta + rows_status
@@ -1584,7 +1514,9 @@ def check_jobs_simp(user_obj, args, config = None, num_columns = 3):
             job_blocks.append(block)
     # ---------- Print two columns for two jobs ----------
     # Renders blocks 2-up, with a separator after each row of two
-    if job_blocks:
+    if renderer is not None:
+        renderer.render(_column_lines(job_blocks, num_columns, renderer.size().columns) if job_blocks else [])
+    elif job_blocks:
         _print_in_columns(job_blocks, num_columns=num_columns)
 
 
@@ -1623,60 +1555,97 @@ def kill_window(user_obj, args):
         release_lock_data()
 
 
-def run_job_on_tpu(job: Job, tpu, quiet = True, ignore_window = None):
+def _record_job(job, tpu):
+    """
+    Take the next tmux window id of the user and record job on tpu in it, under the data lock.
+    """
     data = read_and_lock_data()
     try:
-        # update logs
-        user = job.user
-        user_obj = users.user_from_dict(data['users'][user])
+        user_obj = users.user_from_dict(data['users'][job.user])
         window_id = user_obj.windows_offset
-        data['users'][user_obj.name]['windows_offset'] = window_id + 1
+        data['users'][job.user]['windows_offset'] = window_id + 1
         user_obj.windows_offset = window_id + 1
+        job.windows_id = window_id
+        job.tpu = tpu
+        data['users'][job.user]['job_data'].append(job.to_dict())
+        write_and_unlock_data(data)
+    except:
+        release_lock_data()
+        raise
+    return user_obj
+
+def _forget_job(job):
+    # the recorded job could not be started
+    data = read_and_lock_data()
+    try:
+        job_data = data['users'][job.user]['job_data']
+        job_data[:] = [jb for jb in job_data if jb['windows_id'] != job.windows_id]
+        write_and_unlock_data(data)
+    except Exception as e:
+        release_lock_data()
+        print(f"{WARNING} run_job_on_tpu: Failed to remove the record of job {job.windows_id} of {job.user}: {e}")
+
+def run_job_on_tpu(job: Job, tpu, quiet = True, ignore_window = None):
+    """
+    Start job in a new tmux window of its user on tpu.
+    The job is recorded (running on tpu) before its window is set up, and the data lock is only held for that,
+    so several jobs can be started at the same time (see queue.schedule_pass).
+    Return True if the job was started (even if the spreadsheet could not be updated).
+    """
+    user = job.user
+    recorded = False
+    try:
         zone, pre, spot, tpu = get_zone_pre_spot(tpu)
         if not job.rules:
             job.rules = RULE_DICT["pre"] if pre else RULE_DICT["pass"]
-        
-        job.windows_id = window_id
-        job.tpu = tpu
-        data['users'][user_obj.name]['job_data'].append(job.to_dict())
 
         # sanity check
-        session_name = user_obj.tmux_name
         assert job.stage_dir is not None, f"run_job_on_tpu: Job don't have stagedir"
 
         tpu_status = check_tpu_status(tpu)
         assert tpu_status == 'ready', f"run_job_on_tpu: TPU {tpu} is not ready, status: {tpu_status}"
 
+        user_obj = _record_job(job, tpu)
+        recorded = True
+        window_id = job.windows_id
+        session_name = user_obj.tmux_name
+
         kill_jobs_tpu(tpu, ignore_window=ignore_window)
 
         # run the job
-        os.system(f"tmux new-window -t {session_name}:{window_id}")
-        time.sleep(8.5)
-        os.system(f"tmux send-keys -t {session_name}:{window_id} 'cd {job.stage_dir}' Enter")
-        time.sleep(8.5)
-        os.system(f"tmux send-keys -t {session_name}:{window_id} 'source staging.sh ka={tpu} zone={zone} {job.extra_configs}' Enter")
+        assert os.system(f"tmux new-window -t {session_name}:{window_id}") == 0, f"run_job_on_tpu: Failed to create tmux window {session_name}:{window_id}"
 
-        if not quiet:
-            print(f"{GOOD} run_job_on_tpu: Successfully created job in tmux window {session_name}:{window_id}")
+    except Exception as e:
+        print(f"{FAIL} run_job_on_tpu: Failed to run job for user {user}, error: {e}")
+        if recorded:
+            _forget_job(job)
+        return False
 
-            print(f"{INFO} run_job_on_tpu: new job {job.to_dict()}")
+    except KeyboardInterrupt:
+        print(f"{INFO} run_job_on_tpu: Stopping ...")
+        if recorded:
+            _forget_job(job)
+        return False
 
-        write_and_unlock_data(data)
+    time.sleep(8.5)
+    os.system(f"tmux send-keys -t {session_name}:{window_id} 'cd {job.stage_dir}' Enter")
+    time.sleep(8.5)
+    os.system(f"tmux send-keys -t {session_name}:{window_id} 'source staging.sh ka={tpu} zone={zone} {job.extra_configs}' Enter")
+
+    if not quiet:
+        print(f"{GOOD} run_job_on_tpu: Successfully created job in tmux window {session_name}:{window_id}")
 
+        print(f"{INFO} run_job_on_tpu: new job {job.to_dict()}")
+
+    try:
         tpu_info = get_tpu_info_sheet(tpu)
         tpu_info['running_status'] = 'running'
         tpu_info['user'] = user_obj.spreadsheet_name
         tpu_info['user_note'] = job.job_tags
         write_sheet_info(tpu_info)
-
     except Exception as e:
-        print(f"{FAIL} run_job_on_tpu: Failed to run job for user {user_obj.name}, error: {e}")
-
-    except KeyboardInterrupt:
-        print(f"{INFO} run_job_on_tpu: Stopping ...")
-
-    finally:
-        release_lock_data()
+        print(f"{WARNING} run_job_on_tpu: Job started in {session_name}:{window_id}, but failed to update the spreadsheet: {e}")
+    return True
 
 def monitor_jobs(user_obj, args):
     config = None
@@ -1701,18 +1670,31 @@ def monitor_jobs(user_obj, args):
     
     if '-nt' in args:
         config += 'T'
+    # follow the output of the windows through tmux control mode, and refresh as soon as something is printed
+    streaming = tmux_stream.HUB.watch(user_obj.tmux_name) is not None
+    wake = tmux_stream.HUB.changed if streaming else threading.Event()
+    # only the changed lines are redrawn, the whole screen when the terminal is resized
+    renderer = DiffRenderer(on_resize=wake.set)
+    data_mtime = os.path.getmtime(DATA_PATH)
     try:
         while True:
-            check_jobs_simp(user_obj, args, config=config, num_columns=num_columns)
-            time.sleep(user_obj.settings['monitor_upd_time'])
-            # clear the screen
-            os.system('clear' if os.name == 'posix' else 'cls')
-            # Update user object
-            data = read_data()
-            user_obj = data['users'][user_obj.name]
-            user_obj = users.user_from_dict(user_obj)
+            last_time = time.time()
+            check_jobs_simp(user_obj, args, config=config, num_columns=num_columns, renderer=renderer)
+            wake.wait(user_obj.settings['monitor_upd_time'])
+            wake.clear()
+            if streaming and not renderer.resized:
+                time.sleep(max(0, 1 - (time.time() - last_time))) # at most one refresh per second
+            # Update user object, only if data.json was written meanwhile
+            mtime = os.path.getmtime(DATA_PATH)
+            if mtime != data_mtime:
+                data_mtime = mtime
+                data = read_data()
+                user_obj = data['users'][user_obj.name]
+                user_obj = users.user_from_dict(user_obj)
     except KeyboardInterrupt:
+        renderer.close()
         print(f"\n{INFO} Stopping monitor...")
+        tmux_stream.HUB.close()
         return
     
 
@@ -1919,7 +1901,12 @@ def clear_zombie_jobs(user_object):
 def ack_MONITOR():
     """
     Acknowledge the monitor command
+    Go through the control socket of the MONITOR daemon if it is reachable, otherwise set the flag in data.json.
     """
+    reply = send_command('ack')
+    if reply is not None and reply.get('ok'):
+        print(f"{GOOD} ack_MONITOR: Monitor acknowledged, {reply.get('msg')}")
+        return
     data = read_and_lock_data()
     try:
         data["ack_MONITOR"] = True
@@ -1929,20 +1916,68 @@ def ack_MONITOR():
         print(f"{RED}[Error] {NC}ack_MONITOR: Failed to acknowledge monitor")
         release_lock_data()
 
-from collections import deque
-
-def read_head_tail(path, n=1000, encoding="utf-8"):
-    # head = []
-    # tail = deque(maxlen=n)
-
-    # with open(path, 'r', encoding=encoding, errors='ignore') as f:
-    #     for i, line in enumerate(f):
-    #         if i < n:
-    #             head.append(line)
-    #         tail.append(line)
+def _head_tail_ranges(mm, size, n, unit, max_bytes):
+    """
+    Byte ranges (head_end, tail_start) of the first and last n lines (or bytes) of the mapped file,
+    each side is capped at max_bytes.
+    """
+    if unit == 'bytes':
+        head_end = min(n, size)
+        return head_end, max(head_end, size - n)
+    head_end, cap = 0, min(size, max_bytes)
+    for _ in range(n):
+        idx = mm.find(b'\n', head_end, cap)
+        if idx < 0:
+            head_end = cap
+            break
+        head_end = idx + 1
+    pos = size - 1 if size > 0 and mm[size - 1:size] == b'\n' else size
+    floor = max(head_end, size - max_bytes)
+    tail_start = floor
+    for _ in range(n):
+        idx = mm.rfind(b'\n', floor, pos)
+        if idx < 0:
+            tail_start = floor
+            break
+        pos = idx
+        tail_start = idx + 1
+    return head_end, tail_start
 
-    # return head, list(tail)
-    with open(path, 'r') as f:
-        x = f.read()
-    return x
+def read_head_tail_bytes(path, n=1000, unit='lines', max_bytes=1 << 22):
+    """
+    Return (head, tail, tail_start) of path as bytes: the first and last n lines (unit='lines') or bytes
+    (unit='bytes'), without reading the middle of the file. tail_start is the byte offset of the tail,
+    the head always starts at 0. The tail does not overlap the head.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return b'', b'', 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            head_end, tail_start = _head_tail_ranges(mm, size, n, unit, max_bytes)
+            return mm[:head_end], mm[tail_start:size], tail_start
+
+def read_head_tail(path, n=1000, encoding="utf-8", unit='lines'):
+    """
+    Return the first and last n lines (or bytes) of path as one string, reading O(n) of the file.
+    Undecodable bytes are replaced, skipped middle parts are marked with a '...' line.
+    """
+    head, tail, tail_start = read_head_tail_bytes(path, n, unit)
+    text = head.decode(encoding, errors='replace')
+    if tail:
+        if tail_start > len(head):
+            text += ("" if text.endswith("\n") else "\n") + "...\n"
+        text += tail.decode(encoding, errors='replace')
+    return text
+
+def scan_log_errors(path, n=1000):
+    """
+    Find the error signatures in the first and last n lines of path.
+    Return a list of (kind, byte offset), e.g. [('deadline exceeded', 10423)], see classifier.find_error_signatures.
+    """
+    head, tail, tail_start = read_head_tail_bytes(path, n)
+    found = {}
+    for kind, offset in find_error_signatures(head) + find_error_signatures(tail, base=tail_start):
+        found.setdefault(kind, offset)
+    return sorted(found.items(), key=lambda x: x[1])
 
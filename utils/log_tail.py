@@ -0,0 +1,91 @@
+import os, json, time
+from .constants import *
+from .data_io import _atomic_write_json
+
+READ_BLOCK = 1 << 20     # bytes read from the log at a time
+HEAD_BYTES = 64          # prefix remembered to detect copy-truncate rotation
+
+
+class LogCursors:
+    """
+    Per-job read cursors on output.log files, so that each loop only scans what was appended since the last one.
+    A cursor is {"inode", "offset", "head"}; it is reset when the inode changes (log rotated / recreated),
+    when the file is shorter than the offset (truncated), or when the first bytes differ (truncated and regrown).
+    Cursors are persisted to LOG_CURSOR_PATH so that a restarted MONITOR does not rescan multi-day logs.
+    """
+    def __init__(self, path=LOG_CURSOR_PATH):
+        self.path = path
+        self.cursors = {}
+        self.dirty = False
+        try:
+            with open(path, 'r') as file:
+                self.cursors = json.load(file)
+        except (OSError, ValueError):
+            self.cursors = {}
+
+    def save(self, keep=None):
+        """
+        Persist the cursors, if keep is given, drop the cursors whose key is not in keep.
+        """
+        if keep is not None:
+            keep = set(keep)
+            for key in list(self.cursors):
+                if key not in keep:
+                    del self.cursors[key]
+                    self.dirty = True
+        if not self.dirty:
+            return
+        try:
+            _atomic_write_json(self.path, dict(self.cursors))
+            self.dirty = False
+        except Exception as e:
+            print(f"{WARNING} LogCursors.save: Failed to save cursors to {self.path}: {e}")
+
+    def find(self, key, path, patterns, deadline=None):
+        """
+        Scan the bytes of path appended since the cursor of key for the given patterns (list of str).
+        Return the pattern that occurs first, or None. Patterns split across two reads are found through
+        an overlap of len(longest pattern) - 1 bytes. On a match the cursor stays before the match, so the
+        same error is reported again until the job is marked.
+        If the scan ends after deadline (a time.time(), its caller gave up on it), the cursor is left as it was.
+        """
+        needles = [p.encode() for p in patterns]
+        overlap = max(len(n) for n in needles) - 1
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        cursor = self.cursors.get(key)
+        with open(path, 'rb') as file:
+            head = file.read(HEAD_BYTES).hex()
+            if (cursor is None or cursor["inode"] != st.st_ino or st.st_size < cursor["offset"]
+                    or not head.startswith(cursor["head"])):
+                cursor = {"inode": st.st_ino, "offset": 0, "head": ""}
+            start = max(0, cursor["offset"] - overlap)
+            file.seek(start)
+            carry = b''
+            pos = start
+            while True:
+                block = file.read(READ_BLOCK)
+                if not block:
+                    break
+                chunk = carry + block
+                chunk_start = pos - len(carry)
+                hits = [(chunk.find(n), i) for i, n in enumerate(needles)]
+                hits = [h for h in hits if h[0] >= 0]
+                if hits:
+                    idx, i = min(hits)
+                    self._update(key, st.st_ino, chunk_start + idx, head, deadline)
+                    return patterns[i]
+                pos += len(block)
+                carry = chunk[-overlap:] if overlap > 0 else b''
+        self._update(key, st.st_ino, pos, head, deadline)
+        return None
+
+    def _update(self, key, inode, offset, head, deadline=None):
+        if deadline is not None and time.time() > deadline:
+            return
+        cursor = {"inode": inode, "offset": offset, "head": head[:2 * min(offset, HEAD_BYTES)]}
+        if self.cursors.get(key) != cursor:
+            self.cursors[key] = cursor
+            self.dirty = True
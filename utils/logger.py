@@ -6,12 +6,12 @@ from .data_io import (
     release_lock_data,
     read_data,
 )
-from .users import user_from_dict
+from .users import user_from_dict, User
 from .operate import mount_disk
+from .sheet import get_worksheet, invalidate_sheet_cache
+from . import rate_limit
 
 import os, yaml
-import gspread
-from google.oauth2.service_account import Credentials
 import re
 import subprocess
 import sys
@@ -226,17 +226,8 @@ def register_tpu_and_write_spreadsheet(
 
         # Write to spreadsheet
         try:
-            secret_path = SECRET_PATH
-            sheet_id = "1MFtgLx7uzBFdiPxrIqck00ilrSslZU2w2jRwriVpKMw"
-            sheet_name = "ka[experimental]"
-
-            # Authenticate
-            scopes = ["https://www.googleapis.com/auth/spreadsheets"]
-            creds = Credentials.from_service_account_file(secret_path, scopes=scopes)
-            client = gspread.authorize(creds)
-
-            # Open the sheet
-            ws = client.open_by_key(sheet_id).worksheet(sheet_name)
+            # the cached worksheet handle of sheet.py
+            ws = get_worksheet()
 
             # Find the last row of the TPU table.
             # IMPORTANT:
@@ -245,7 +236,7 @@ def register_tpu_and_write_spreadsheet(
             # This avoids being affected by unrelated sections (e.g. K/L usage stats).
             last_row = 10
             for sentinel_col in range(2, 6):  # COL B, C, D, E
-                col_values = ws.col_values(sentinel_col)
+                col_values = rate_limit.call(ws.col_values, sentinel_col)
                 last_row = max(last_row, len(col_values))
 
             # Determine TPU version and type from full_name
@@ -292,11 +283,13 @@ def register_tpu_and_write_spreadsheet(
 
             # Write exactly one line under the current last line of the table (A..I).
             target_row = last_row + 1
-            ws.update(
+            rate_limit.call(
+                ws.update,
                 f"A{target_row}:I{target_row}",
                 [new_row],
                 value_input_option="USER_ENTERED",
             )
+            invalidate_sheet_cache()  # the new row is read by the next read_sheet_info
             print(
                 f"{GOOD} Successfully added TPU {spreadsheet_name} to spreadsheet at row {target_row}"
             )
@@ -412,7 +405,8 @@ def set_settings(user_object, args):
     data = read_and_lock_data()
     try:
         key, value = args[0], args[1]
-        if key not in user_object.settings:
+        # settings added after the user was created (e.g. stall_minutes) can be set as well
+        if key not in user_object.settings and key not in User(None, None).settings:
             raise ValueError(f"Setting {key} not found")
         if is_integer(value):
             value = int(value)
@@ -0,0 +1,176 @@
+import os, time, threading, tempfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .constants import *
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + (list(extra) if extra else [])
+    if not pairs:
+        return ''
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Monotonic counter, optionally split by labels: counter.inc(error='grpc').
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(k, '')) for k in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram:
+    """
+    Cumulative histogram of durations (in seconds), optionally split by labels.
+    Use histogram.observe(seconds, **labels) or `with histogram.time(**labels):`.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.values = {}   # label values -> [bucket counts, sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(k, '')) for k in self.labelnames)
+        with self.lock:
+            entry = self.values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        with self.lock:
+            items = sorted((key, ([*entry[0]], entry[1], entry[2])) for key, entry in self.values.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', _format_value(bound))])} {bucket_count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total!r}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+        return False
+
+
+def _register(metric):
+    with _registry_lock:
+        for existing in _registry:
+            if existing.name == metric.name:
+                return existing
+        _registry.append(metric)
+    return metric
+
+
+def counter(name, help, labelnames=()):
+    return _register(Counter(name, help, labelnames))
+
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, help, labelnames, buckets))
+
+
+def render():
+    """
+    All the registered metrics in the Prometheus text exposition format.
+    """
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path=METRICS_PATH):
+    """
+    Atomically write the metrics to path (for node_exporter's textfile collector, or to read by hand).
+    """
+    dir_path = os.path.dirname(path) or '.'
+    try:
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=dir_path)
+        with os.fdopen(fd, 'w') as file:
+            file.write(render())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"{WARNING} write_textfile: Failed to write metrics to {path}: {e}")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, host='127.0.0.1'):
+    """
+    Serve the metrics on http://host:port/metrics from a daemon thread, return the server (None on failure).
+    """
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        print(f"{WARNING} start_http_server: Failed to serve metrics on {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,113 @@
+import os, json, socket, threading
+from .constants import *
+
+CONTROL_COMMANDS = ['ack', 'status', 'pause', 'resume', 'reload', 'stop']
+
+
+def _send_line(conn, payload):
+    conn.sendall((json.dumps(payload) + "\n").encode())
+
+
+def _recv_line(conn, limit=1 << 20):
+    buf = b''
+    while not buf.endswith(b"\n"):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        buf += chunk
+        if len(buf) > limit:
+            raise ValueError("control message too long")
+    return json.loads(buf.decode()) if buf.strip() else None
+
+
+class ControlServer:
+    """
+    Unix-socket control channel of the MONITOR daemon.
+    Every connection sends one JSON line {"cmd": ..., "args": [...]} and receives one JSON line back,
+    handlers maps a command to a function(args) returning a JSON-serializable dict.
+    """
+    def __init__(self, handlers, path=MONITOR_SOCKET_PATH):
+        self.handlers = handlers
+        self.path = path
+        self.sock = None
+        self.thread = None
+
+    def start(self):
+        if send_command('status', path=self.path, timeout=1) is not None:
+            raise RuntimeError(f"another MONITOR is already listening on {self.path}")
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(8)
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return # closed
+            with conn:
+                try:
+                    conn.settimeout(5)
+                    request = _recv_line(conn) or {}
+                    cmd = request.get("cmd")
+                    if cmd not in self.handlers:
+                        reply = {"ok": False, "error": f"unknown command {cmd}, choose from {list(self.handlers)}"}
+                    else:
+                        reply = {"ok": True} | (self.handlers[cmd](request.get("args", [])) or {})
+                    _send_line(conn, reply)
+                except Exception as e:
+                    try:
+                        _send_line(conn, {"ok": False, "error": str(e)})
+                    except OSError:
+                        pass
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            finally:
+                self.sock = None
+                try:
+                    os.unlink(self.path)
+                except OSError:
+                    pass
+
+
+def send_command(cmd, args=None, path=MONITOR_SOCKET_PATH, timeout=5):
+    """
+    Send a command to the running MONITOR, return its reply (dict), or None if no MONITOR is listening.
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(timeout)
+            conn.connect(path)
+            _send_line(conn, {"cmd": cmd, "args": args or []})
+            return _recv_line(conn)
+    except (OSError, ValueError):
+        return None
+
+
+def control_MONITOR(args):
+    """
+    tpu -Mctl <cmd>: send a control command to the running MONITOR and print the reply.
+    """
+    cmd = args[0] if len(args) > 0 else 'status'
+    if cmd not in CONTROL_COMMANDS:
+        print(f"{FAIL} control_MONITOR: Unknown command {cmd}, choose from {CONTROL_COMMANDS}")
+        return
+    reply = send_command(cmd, args[1:])
+    if reply is None:
+        print(f"{FAIL} control_MONITOR: MONITOR is not reachable at {MONITOR_SOCKET_PATH}")
+        return
+    if not reply.pop("ok", False):
+        print(f"{FAIL} control_MONITOR: {reply.get('error')}")
+        return
+    print(f"{GOOD} control_MONITOR: {cmd} done")
+    for key, value in reply.items():
+        print(f"{INFO} {key}: {value}")
@@ -4,8 +4,14 @@ from .data_io import read_and_lock_data, write_and_unlock_data, release_lock_dat
 from .helpers import *
 from .constants import *
 from .sheet import read_sheet_info, write_sheet_info, get_tpu_info_sheet, get_tpu_usage_by_zone_and_type, write_tpu_usage_to_sheet
+from . import rate_limit
 
 def update_tpu_status_for_spreadsheet():
+    # a bulk refresh, its Sheets API requests yield to the interactive ones
+    with rate_limit.background():
+        _update_tpu_status_for_spreadsheet()
+
+def _update_tpu_status_for_spreadsheet():
 
     # After the loop, get TPU usage statistics and write to K, L columns
     print(f"{INFO} Getting TPU usage statistics by zone and type...")
@@ -372,9 +378,10 @@ def delete_tpu(tpu):
         return 'delete failed'
     return 'success'
 
-def check_tpu_status(tpu, quiet = False):
+def check_tpu_status(tpu, quiet = False, timeout = None):
     """
     Check whether a TPU is preempted or not.
+    timeout: seconds to wait for gcloud, None for no limit.
     return value: ['no tpu found', 'preempted', 'terminated', 'creating', 'ready', 'failed']
     """
     zone, pre, spot, tpu = get_zone_pre_spot(tpu)
@@ -384,12 +391,18 @@ def check_tpu_status(tpu, quiet = False):
         # "PATH=/kmh-nfs-ssd-us-mount/code/siri/google-cloud-sdk/bin:$PATH "
         f"gcloud compute tpus tpu-vm describe {tpu} --zone={zone} --project {PROJECT} --format='value(state)'"
     )
+    if timeout is not None:
+        cmd = "exec " + cmd # so that the timeout kills gcloud itself, not only the shell
     if not quiet:
         print(f"{INFO} check_tpu_status: running cmd: {cmd}")
     try:
-        state = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT).decode().strip()
+        state = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT, timeout=timeout).decode().strip()
         if not quiet:
             print(f"{INFO} check_tpu_status: raw output: {state}")
+    except subprocess.TimeoutExpired:
+        if not quiet:
+            print(f"{FAIL} check_tpu_status: Query TPU {tpu} state timed out after {timeout} seconds")
+        return 'failed'
     except subprocess.CalledProcessError as e:
         if not quiet:
             print(f"{FAIL} check_tpu_status: Failed to query TPU {tpu} state")
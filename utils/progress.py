@@ -0,0 +1,186 @@
+import os, re, time, struct, threading
+from .constants import *
+
+RECORD = struct.Struct('<dd')   # (unix time, epoch), 16 bytes per sample
+RATE_WINDOW = 2 * 3600          # throughput is measured over the last two hours of samples
+STALL_MINUTES = 30              # default threshold, the user setting stall_minutes overrides it
+STALL_PACE = 2                  # ... and a job is only stalled after this many times its slowest recent advance
+PACE_SAMPLES = 8                # the advances of the last samples set the pace of a job
+KEEP_DAYS = 14                  # files of jobs that recorded nothing for this long are removed
+NUM_EPOCHS_RE = re.compile(r'--config\.training\.num_epochs=([0-9]+(?:\.[0-9]+)?)')
+
+
+def job_key(job_data):
+    """
+    The name of the samples file of a job. A window id is reused once its window is closed, so the start time
+    of the job (else its stage dir) is part of the key, a new job in the same window starts a new file.
+    """
+    key = f"{job_data.get('user')}-{job_data.get('windows_id')}"
+    run = re.sub(r'\D', '', (job_data.get('start_time') or {}).get('utc') or '')
+    if not run:
+        run = re.sub(r'[^\w.-]', '_', os.path.basename((job_data.get('stage_dir') or '').rstrip('/')))
+    return f"{key}-{run}" if run else key
+
+
+def num_epochs(job_data):
+    """
+    The total number of epochs of a job, from --config.training.num_epochs in its extra_configs (None if not set).
+    """
+    matches = NUM_EPOCHS_RE.findall(job_data.get('extra_configs') or '')
+    return float(matches[-1]) if matches else None
+
+
+class ProgressStore:
+    """
+    Append-only progress samples of the jobs, one binary file of (time, epoch) records per job.
+    A sample is only written when the epoch changes, so the last record is the last time the job advanced.
+    Several processes (tpu monitor, the web UI) may append to the same file, a duplicate sample is harmless.
+    """
+    def __init__(self, dir_path=PROGRESS_DIR):
+        self.dir_path = dir_path
+        self.last = {}          # key -> last (time, epoch) of the file
+        self.lock = threading.Lock()
+        self.pruned = False
+
+    def _path(self, key):
+        return os.path.join(self.dir_path, f"{key}.bin")
+
+    def _read(self, key, index, count):
+        try:
+            with open(self._path(key), 'rb') as file:
+                file.seek(index * RECORD.size)
+                data = file.read(count * RECORD.size)
+        except OSError:
+            return []
+        return [RECORD.unpack_from(data, i) for i in range(0, len(data) - RECORD.size + 1, RECORD.size)]
+
+    def _size(self, key):
+        try:
+            return os.path.getsize(self._path(key)) // RECORD.size
+        except OSError:
+            return 0
+
+    def _last(self, key):
+        with self.lock:
+            if key in self.last:
+                return self.last[key]
+        n = self._size(key)
+        last = self._read(key, n - 1, 1)[0] if n > 0 else None
+        with self.lock:
+            self.last[key] = last
+        return last
+
+    def record(self, key, epoch, ts=None):
+        """
+        Record the epoch of a job, return True if it advanced (or moved) since the last sample.
+        """
+        try:
+            epoch = float(epoch)
+        except (TypeError, ValueError):
+            return False
+        last = self._last(key)
+        if last is not None and last[1] == epoch:
+            return False
+        sample = (time.time() if ts is None else ts, epoch)
+        try:
+            os.makedirs(self.dir_path, exist_ok=True)
+            with open(self._path(key), 'ab') as file:
+                file.write(RECORD.pack(*sample))
+        except OSError as e:
+            print(f"{WARNING} ProgressStore: Failed to record progress of {key}: {e}")
+            return False
+        with self.lock:
+            self.last[key] = sample
+        if not self.pruned:
+            self.pruned = True
+            self.prune()
+        return True
+
+    def samples(self, key, since=None):
+        """
+        The samples of a job with time >= since (all if None), oldest first. The records are in time order,
+        so the first one is found by bisection and only the tail of the file is read.
+        """
+        n = self._size(key)
+        lo = 0
+        if since is not None:
+            hi = n
+            while lo < hi:
+                mid = (lo + hi) // 2
+                record = self._read(key, mid, 1)
+                if record and record[0][0] < since:
+                    lo = mid + 1
+                else:
+                    hi = mid
+        return self._read(key, lo, n - lo)
+
+    def summary(self, key, total=None, stall_minutes=STALL_MINUTES, now=None):
+        """
+        Return a dict with the last epoch, the throughput (epochs per hour, over RATE_WINDOW), the ETA
+        in seconds (if total epochs is known), the seconds since the job last advanced and whether it is stalled.
+        A job is stalled when it has been idle for longer than stall_minutes and STALL_PACE times the longest gap
+        between its last PACE_SAMPLES samples, so a job with long integer epochs or long eval phases is not.
+        None if the job has no samples.
+        """
+        now = time.time() if now is None else now
+        last = self._last(key)
+        if last is None:
+            return None
+        window = self.samples(key, since=last[0] - RATE_WINDOW)
+        first = window[0] if window else last
+        rate = None
+        if last[0] - first[0] > 0 and last[1] > first[1]:
+            rate = (last[1] - first[1]) / (last[0] - first[0]) * 3600
+        eta = None
+        if rate and total is not None:
+            eta = max(0.0, total - last[1]) / rate * 3600
+        idle = now - last[0]
+        n = self._size(key)
+        recent = self._read(key, max(0, n - PACE_SAMPLES), PACE_SAMPLES)
+        pace = max((b[0] - a[0] for a, b in zip(recent, recent[1:])), default=0)
+        stalled = idle > max(stall_minutes * 60, STALL_PACE * pace)
+        return {'epoch': last[1], 'rate': rate, 'eta': eta, 'idle': idle, 'stalled': stalled}
+
+    def prune(self, keep_days=KEEP_DAYS):
+        """
+        Remove the files of the jobs that recorded nothing in keep_days days.
+        """
+        try:
+            names = os.listdir(self.dir_path)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.dir_path, name)
+            try:
+                if time.time() - os.path.getmtime(path) > keep_days * 86400:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return '-'
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return f"{minutes}m"
+    if minutes < 48 * 60:
+        return f"{minutes // 60}h{minutes % 60:02d}m"
+    return f"{minutes // 1440}d{minutes % 1440 // 60:02d}h"
+
+
+def format_rate(rate):
+    return '-' if rate is None else f"{rate:.2f} ep/h"
+
+
+PROGRESS = ProgressStore()
+
+
+def observe(job_data, epoch, stall_minutes=STALL_MINUTES):
+    """
+    Record the epoch the status parser found for a running job and return its summary (see ProgressStore.summary).
+    """
+    key = job_key(job_data)
+    if epoch is not None:
+        PROGRESS.record(key, epoch)
+    return PROGRESS.summary(key, total=num_epochs(job_data), stall_minutes=stall_minutes)
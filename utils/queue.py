@@ -4,17 +4,20 @@ from .jobs import Job, run_job_on_tpu
 from .constants import *          # INFO, GOOD, FAIL, etc.
 from .helpers import *            # get_chn_time_str, etc.
 from .data_io import *            # read_and_lock_queue, write_and_unlock_queue, release_lock_queue, read_data
+from .data_io import _atomic_write_json
 from .sheet import read_sheet_info, write_sheet_info, get_tpu_info_sheet
 from .operate import kill_jobs_tpu, check_tpu_status
 from .users import user_from_dict
+from .queue_policy import get_policy, is_running
+from . import runtime, staging, claims
 from .logger import get_wandb_notes
 
 import os
-import shlex
-import subprocess
+import json
 import time
 import random
 from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
 
 
 class Task:
@@ -73,13 +76,122 @@ class Task:
         )
 
 
-def _tmux_has_session(name: str) -> bool:
-    return subprocess.run(
-        ["tmux", "has-session", "-t", name],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-    ).returncode == 0
+# ---------- queue index ----------
+# QUEUE_INDEX_PATH keeps, for every TPU full name, the ids of the queued tasks that may run on it, in queue order.
+# It is only a candidate filter: ack_queue checks the tasks indexed for its TPU instead of the whole queue, and tries
+# them in the order of the queue policy (see queue_policy), whose scores change with time and usage. It is written
+# with the queue, under the queue lock, by every path that adds or removes tasks (see _write_queue).
 
+def _index_add(index, task_dict):
+    task_id = (task_dict.get("other_info") or {}).get("task_id")
+    if task_id is None:
+        return
+    for tpu in (task_dict.get("tpu_info") or {}).get("valid_tpu", []):
+        index["tpus"].setdefault(tpu, []).append(task_id)
+
+def _build_queue_index(queue):
+    index = {"tpus": {}}
+    for task_dict in queue:
+        _index_add(index, task_dict)
+    return index
+
+def load_queue_index(queue):
+    """
+    The index of queue (call it with the queue lock held), rebuilt if it does not cover every task of the queue
+    (e.g. queue.json was edited by hand).
+    """
+    try:
+        with open(QUEUE_INDEX_PATH, "r") as file:
+            index = json.load(file)
+        indexed = {task_id for task_ids in index["tpus"].values() for task_id in task_ids}
+    except (OSError, ValueError, KeyError, AttributeError, TypeError):
+        return _build_queue_index(queue)
+    for task_dict in queue:
+        task_id = (task_dict.get("other_info") or {}).get("task_id")
+        if task_id is not None and task_id not in indexed and (task_dict.get("tpu_info") or {}).get("valid_tpu"):
+            return _build_queue_index(queue)
+    return index
+
+def save_queue_index(index, queue):
+    """
+    Write the index (with the queue lock held), dropping the tasks no longer in queue.
+    """
+    live = {(task_dict.get("other_info") or {}).get("task_id") for task_dict in queue}
+    tpus = {}
+    for tpu, task_ids in index["tpus"].items():
+        task_ids = [task_id for task_id in task_ids if task_id in live]
+        if task_ids:
+            tpus[tpu] = task_ids
+    index["tpus"] = tpus
+    _atomic_write_json(QUEUE_INDEX_PATH, index)
+
+def _write_queue(queue, index = None):
+    """
+    write_and_unlock_queue, with the index of the tasks left in queue saved first.
+    """
+    try:
+        save_queue_index(load_queue_index(queue) if index is None else index, queue)
+    except OSError as e:
+        # the queue is still written, ack_queue skips the indexed tasks that are gone
+        print(f"{WARNING} queue: failed to save the queue index: {e}")
+    write_and_unlock_queue(queue)
+
+
+
+# ---------- backfill ----------
+# EASY backfill: the first task of the policy order that cannot start (its user is at its cap, or its TPUs are busy)
+# reserves the one TPU it will get, from the estimated time it can start (the end of the running job it waits for,
+# see runtime.Estimator). A task after it may take that TPU only if it is estimated to finish before; the other TPUs
+# are free for all. Without an estimate of that time (or if the job it waits for overran it) there is no reservation.
+
+def _reservation(task, admitted, data, estimator, free = ()):
+    """
+    Return (hours until task can start, {the TPU reserved for it}), or None if unknown.
+    free: the TPUs free now; a capped task gets one of its valid free TPUs when its user's next job ends.
+    """
+    valid = task.tpu_info.get("valid_tpu", [])
+    running = [job for user_data in data["users"].values() for job in user_data["job_data"] if is_running(job)]
+    ends = {}
+    for job in running:
+        if job.get("tpu") in valid:
+            hours = estimator.remaining(job)
+            if hours:
+                ends[job["tpu"]] = min(hours, ends.get(job["tpu"], hours))
+    if admitted:
+        if not ends:
+            return None
+        tpu = min(ends, key=lambda t: (ends[t], t))
+        return ends[tpu], {tpu}
+    # the cap of the user is released by the first of its running jobs to end
+    hours = [estimator.remaining(job) for job in running if job.get("user") == task.user]
+    hours = [h for h in hours if h]
+    if not hours:
+        return None
+    now_free = sorted(t for t in valid if t in free)
+    if now_free:
+        return min(hours), {now_free[0]}
+    if not ends:
+        return None
+    tpu = min(ends, key=lambda t: (ends[t], t))
+    return max(min(hours), ends[tpu]), {tpu}
+
+def _fits(task, tpu, reservation, estimator):
+    """
+    Whether task may take tpu without delaying the task holding reservation.
+    """
+    if reservation is None or tpu not in reservation[1]:
+        return True
+    hours, _ = estimator.estimate(task.job.to_dict()) if task.job else (None, None)
+    return hours is not None and hours <= reservation[0]
+
+def _predict(task, estimator):
+    # recorded in the job, runtime.report compares it with the actual runtime; return the job
+    if task.job is not None:
+        hours, basis = estimator.estimate(task.job.to_dict())
+        if hours is not None:
+            task.job.extra_msgs["predicted_hours"] = round(hours, 3)
+            task.job.extra_msgs["predicted_basis"] = basis
+    return task.job
 
 def ack_queue(ack_information):
     """
@@ -87,33 +199,199 @@ def ack_queue(ack_information):
         - tpu: TPU full name to be acknowledged
         - status: 'finished' / 'failed'
         - window: optional dict with keys 'session' and 'window' to identify the tmux window
+    The TPU information and data.json are read before taking the queue lock, the candidates are the tasks indexed
+    for the TPU (see load_queue_index), tried in the order of the queue policy (see queue_policy), and the chosen
+    task is removed before it is run (outside the lock).
     """
     print(f"{INFO} ack_queue: acknowledging task on TPU {ack_information['tpu']} with status {ack_information['status']}")
-    queue = read_and_lock_queue()
+    tpu = ack_information["tpu"]
+    status = ack_information["status"]
     try:
-        tpu = ack_information["tpu"]
-        status = ack_information["status"]
         tpu_information = get_tpu_info_sheet(tpu)
+        data = read_data()
+        policy = get_policy(data)
+        estimator = runtime.Estimator(runtime.load_history(data))
+    except Exception as e:
+        print(f"{FAIL} ack_queue: error {e}")
+        return
+    token = claims.claim(tpu)
+    if token is None:
+        print(f"{INFO} ack_queue: TPU {tpu} is being dispatched by another process")
+        return
 
-        idx_to_del: Optional[int] = None
-        for i, task_dict in enumerate(queue):
-            task_obj = Task.from_dict(task_dict)
-            # print(f"check_valid: {check_valid(task_obj, {"tpu": tpu, "info": tpu_information, "status": status})}")
-            if check_valid(task_obj, {"tpu": tpu, "info": tpu_information, "status": status}):
-                run_job_on_tpu(task_obj.job, tpu, quiet = False, ignore_window=ack_information.get("window"))
-                idx_to_del = i
+    task_to_run = None
+    queue = read_and_lock_queue()
+    try:
+        index = load_queue_index(queue)
+        position = {(task_dict.get("other_info") or {}).get("task_id"): i for i, task_dict in enumerate(queue)}
+        scores = policy.scores(queue)
+        candidates = {position[task_id] for task_id in index["tpus"].get(tpu, []) if task_id in position}
+        head = None
+        reservation = None
+        for i in sorted(candidates, key=lambda i: (-scores[i], i)):
+            task_obj = Task.from_dict(queue[i])
+            if not policy.admit(task_obj.user):
+                if head is None:
+                    head = task_obj
+                    reservation = _reservation(task_obj, False, data, estimator, free = {tpu})
+                continue
+            if not _fits(task_obj, tpu, reservation, estimator):
+                continue
+            if check_valid(task_obj, {"tpu": tpu, "info": tpu_information, "status": status}, data=data):
+                task_to_run = task_obj
+                del queue[i]
                 break
+    except Exception as e:
+        print(f"{FAIL} ack_queue: error {e}")
+        task_to_run = None
 
-        if idx_to_del is not None:
-            del queue[idx_to_del]
+    # the lock is an ownerless flag, only clear it on the paths that do not write
+    if task_to_run is None:
+        release_lock_queue()
+    else:
+        try:
+            _write_queue(queue, index)
+        except Exception as e:
+            print(f"{FAIL} ack_queue: error writing the queue: {e}")
+            release_lock_queue()
+            task_to_run = None
 
-        write_and_unlock_queue(queue)
+    if task_to_run is None or not run_job_on_tpu(_predict(task_to_run, estimator), tpu, quiet = False, ignore_window=ack_information.get("window")):
+        claims.release(tpu, token)
 
+def _assign(queue, free, data, policy = None, estimator = None):
+    """
+    Match the queued tasks to the free TPUs ({full name: sheet info}): in the order of the queue policy, the tasks
+    with the fewest valid TPUs first among equal scores, skipping the users at their cap. A task takes, among its
+    valid free TPUs it may use (check_valid with status 'finished'), the one wanted by the fewest of the remaining tasks.
+    The first task that cannot start holds a reservation, the tasks after it are backfilled (see _reservation).
+    Return a list of (task, tpu).
+    """
+    policy = get_policy(data) if policy is None else policy
+    estimator = runtime.Estimator(runtime.load_history(data)) if estimator is None else estimator
+    tasks = [Task.from_dict(task_dict) for task_dict in queue]
+    scores = policy.scores(queue)
+    order = sorted(range(len(tasks)), key=lambda i: (-scores[i], len(tasks[i].tpu_info.get("valid_tpu", [])), i))
+    demand = {}
+    for task in tasks:
+        for tpu in task.tpu_info.get("valid_tpu", []):
+            if tpu in free:
+                demand[tpu] = demand.get(tpu, 0) + 1
+
+    assignment = []
+    reservation = None
+    head = None
+    for i in order:
+        task = tasks[i]
+        valid = [tpu for tpu in task.tpu_info.get("valid_tpu", []) if tpu in free]
+        for tpu in valid:
+            demand[tpu] -= 1
+        admitted = policy.admit(task.user)
+        candidates = [tpu for tpu in valid if admitted and _fits(task, tpu, reservation, estimator)
+                      and check_valid(task, {"tpu": tpu, "info": free[tpu], "status": "finished"}, data=data)]
+        if candidates:
+            tpu = min(candidates, key=lambda t: (demand[t], t))
+            assignment.append((task, tpu))
+            policy.took(task.user)
+            del free[tpu]
+        elif head is None and task.tpu_info.get("valid_tpu"):
+            head = task
+            reservation = _reservation(task, admitted, data, estimator, free = free)
+    return assignment
+
+def schedule_pass(dry_run = False, workers = 8, quiet = False, tpus = None, checked = False):
+    """
+    Dispatch the queue to all the idle TPUs at once: take a snapshot of the queue and of the TPUs that are free
+    in the sheet, ready and not claimed (see claims), match them (see _assign), claim the TPUs, remove the matched
+    tasks from the queue and start them concurrently. Run by MONITOR periodically and when data.json changes,
+    by the dispatcher on the TPUs that became free (tpus), and by `tpu schedule [--dry]`.
+    checked: the tpus were just found ready by the caller, do not query gcloud again.
+    Return the list of (task_id, tpu) dispatched (or that would be, with dry_run).
+    """
+    try:
+        queue = read_queue()
+        if not queue:
+            return []
+        wanted = {tpu for task_dict in queue for tpu in (task_dict.get("tpu_info") or {}).get("valid_tpu", [])}
+        information = read_sheet_info()
+        free = {tpu: info for tpu, info in information.items() if tpu in wanted and info.get("running_status") == "free"
+                and (tpus is None or tpu in tpus)}
+        for tpu in claims.claimed():
+            free.pop(tpu, None)
+        data = read_data()
     except Exception as e:
-        print(f"{FAIL} ack_queue: error {e}")
-
-    finally:
+        print(f"{FAIL} schedule_pass: error reading the queue or the TPUs: {e}")
+        return []
+    # a TPU that was just released may already be taken by ack_queue, whose job is recorded as running
+    for user in data["users"].values():
+        for job in user["job_data"]:
+            if job.get("status") in (None, "running"):
+                free.pop(job.get("tpu"), None)
+    if not free:
+        return []
+
+    if not (checked and tpus is not None):
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            states = dict(zip(free, pool.map(lambda tpu: check_tpu_status(tpu, quiet=True, timeout=60), free)))
+        free = {tpu: info for tpu, info in free.items() if states[tpu] == "ready"}
+    estimator = runtime.Estimator(runtime.load_history(data))
+    assignment = _assign(queue, free, data, estimator=estimator)
+    for task, _ in assignment:
+        _predict(task, estimator)
+    if not assignment or dry_run:
+        if not quiet:
+            for task, tpu in assignment:
+                print(f"{INFO} schedule_pass: task {task.other_info['task_id']} of {task.user} -> {tpu}")
+        return [(task.other_info["task_id"], tpu) for task, tpu in assignment]
+
+    # the queue may have changed since the snapshot, only dispatch the tasks that are still in it
+    dispatched = []
+    tokens = {}
+    queue = read_and_lock_queue()
+    try:
+        position = {(task_dict.get("other_info") or {}).get("task_id"): i for i, task_dict in enumerate(queue)}
+        # a TPU claimed by another dispatcher since the snapshot is left to it
+        for task, tpu in assignment:
+            if task.other_info["task_id"] in position:
+                tokens[tpu] = claims.claim(tpu)
+        matched = [(task, tpu) for task, tpu in assignment if tokens.get(tpu) is not None]
+        drop = {position[task.other_info["task_id"]] for task, _ in matched}
+        queue = [task_dict for i, task_dict in enumerate(queue) if i not in drop]
+    except Exception as e:
+        # the lock is an ownerless flag, only clear it on the paths that do not write
         release_lock_queue()
+        print(f"{FAIL} schedule_pass: error updating the queue: {e}")
+        for tpu, token in tokens.items():
+            if token is not None:
+                claims.release(tpu, token)
+        return []
+    _write_queue(queue)
+    dispatched = matched
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        started = list(pool.map(lambda match: run_job_on_tpu(match[0].job, match[1], quiet=True), dispatched))
+    for (task, tpu), ok in zip(dispatched, started):
+        if ok:
+            print(f"{GOOD} schedule_pass: started task {task.other_info['task_id']} of {task.user} on {tpu}")
+        else:
+            print(f"{FAIL} schedule_pass: failed to start task {task.other_info['task_id']} of {task.user} on {tpu}, put it back in the queue")
+    failed = [task for (task, _), ok in zip(dispatched, started) if not ok]
+    for (_, tpu), ok in zip(dispatched, started):
+        if not ok:
+            claims.release(tpu, tokens[tpu])
+    if failed:
+        queue = read_and_lock_queue()
+        try:
+            index = load_queue_index(queue)
+            for task in failed:
+                queue.append(task.to_dict())
+                _index_add(index, task.to_dict())
+        except Exception as e:
+            release_lock_queue()
+            print(f"{FAIL} schedule_pass: error putting the failed tasks back in the queue: {e}")
+        else:
+            _write_queue(queue, index)
+    return [(task.other_info["task_id"], tpu) for (task, tpu), ok in zip(dispatched, started) if ok]
 
 def run_queued_job(user_obj, args):
     """
@@ -141,17 +419,23 @@ def run_queued_job(user_obj, args):
             task_obj = Task.from_dict(task_dict)
             if task_obj.user == user_obj.name and str(task_obj.other_info['task_id']) == str(id):
                 if tpu in task_obj.tpu_info['valid_tpu']:
-                    if check_tpu_status(tpu) == 'ready':
-                        run_job_on_tpu(task_obj.job, tpu, quiet=False)
+                    token = claims.claim(tpu)
+                    if token is None:
+                        print(f"{FAIL} run_queued_job: TPU {tpu} is being dispatched by another process")
+                    elif check_tpu_status(tpu) == 'ready':
+                        if not run_job_on_tpu(task_obj.job, tpu, quiet=False):
+                            claims.release(tpu, token)
                         del queue[i]
-                        write_and_unlock_queue(queue)
+                        _write_queue(queue)
+                        return
                     else:
+                        claims.release(tpu, token)
                         print(f"{FAIL} run_queued_job: TPU {tpu} is not ready")
                     break
     except Exception as e:
         print(f"{FAIL} run_queued_job: error running tasks on TPU {tpu}: {e}")
-    finally:
-        release_lock_queue()
+    # the lock is an ownerless flag, only clear it on the paths that do not write
+    release_lock_queue()
 
 def dequeue_and_run(task_id, tpu):
     """
@@ -176,21 +460,30 @@ def dequeue_and_run(task_id, tpu):
                 break
 
         if task_to_run is not None and idx_to_del is not None:
-            del queue[idx_to_del]
-            write_and_unlock_queue(queue)
-            run_job_on_tpu(task_to_run.job, tpu, quiet=False)
+            token = claims.claim(tpu)
+            if token is None:
+                print(f"{FAIL} dequeue_and_run: TPU {tpu} is being dispatched by another process")
+                task_to_run = None
+            else:
+                del queue[idx_to_del]
         else:
             print(f"{FAIL} dequeue_and_run: task {task_id} not found in queue")
 
     except Exception as e:
         print(f"{FAIL} dequeue_and_run: error running task {task_id} on TPU {tpu}: {e}")
+        task_to_run = None
 
-    finally:
+    if task_to_run is None:
         release_lock_queue()
+        return
+    _write_queue(queue)
+    if not run_job_on_tpu(task_to_run.job, tpu, quiet=False):
+        claims.release(tpu, token)
 
 
 def update_staging_info(task_id, stage_dir, stage_time):
     queue = read_and_lock_queue()
+    written = False
     try:
         for task_dict in queue:
             other = task_dict.get("other_info", {})
@@ -199,15 +492,19 @@ def update_staging_info(task_id, stage_dir, stage_time):
                 task_dict.setdefault("other_info", {})["stage_time"] = stage_time
                 task_dict.setdefault("job_info", {})["stage_dir"] = stage_dir
                 task_dict.setdefault("job", {})["stage_dir"] = stage_dir
+                staging.mark_done(task_dict)
                 break
+        written = True
         write_and_unlock_queue(queue)
     except Exception as e:
         print(f"{FAIL} update_staging_info: error updating staging info for task {task_id}: {e}")
     finally:
-        release_lock_queue()
+        # the lock is an ownerless flag, only clear it on the paths that do not write
+        if not written:
+            release_lock_queue()
 
 
-def check_valid(task, information):
+def check_valid(task, information, data = None):
     """
     input:
         task: a task in the queue
@@ -215,24 +512,22 @@ def check_valid(task, information):
             - tpu (full name)
             - info: dict of TPU spreadsheet info (must include 'user')
             - status: 'failed' / 'finished'
+        data: data.json if already read by the caller
     output:
         bool: whether this task is valid to run on the TPU
     """
     # --- sanity: stage_dir present ---
-    data = read_data()
+    if data is None:
+        data = read_data()
     stage_dir = getattr(task, "job_info", {}).get("stage_dir") if hasattr(task, "job_info") else None
     if not stage_dir:
         return False
 
-    print(f"stage_dir: {stage_dir}")
-
     # --- availability: TPU allowed ---
     valid_tpu = getattr(task, "tpu_info", {}).get("valid_tpu", []) if hasattr(task, "tpu_info") else []
     if information.get("tpu") not in valid_tpu:
         return False
 
-    print(f"valid_tpu: {valid_tpu}")
-
     # --- permission decoding ---
     status = information.get("status")
     perm_raw = getattr(task, "priority_info", {}).get("permission")
@@ -262,8 +557,6 @@ def check_valid(task, information):
     user_spreadsheet = data['users'][task.user]['spreadsheet_name']
     info_user = information.get("info", {}).get("user")
 
-    print(f"digit: {digit}, allow_own: {allow_own}, allow_other: {allow_other}")
-
     own = (user_spreadsheet == info_user) or (info_user == "free")
 
     if own and not allow_own:
@@ -431,6 +724,8 @@ def parse_config_args_for_queue(user_obj, args):
 def remove_from_queue(number):
     queue = read_and_lock_queue()
     if number == -1:
+        for task_dict in queue:
+            staging.cancel(task_dict)
         queue = []
     else:
         idx_to_del: Optional[int] = None
@@ -441,9 +736,10 @@ def remove_from_queue(number):
                 break
 
         if idx_to_del is not None:
+            staging.cancel(queue[idx_to_del])
             del queue[idx_to_del]
 
-    write_and_unlock_queue(queue)
+    _write_queue(queue)
 
 def dequeue(user_obj, args):
     """
@@ -498,60 +794,28 @@ def Queue(user_obj, args):
         priority_info=priority,
     )
 
-    if not _tmux_has_session("queue"):
-        subprocess.run(["tmux", "new-session", "-d", "-s", "queue"], check=True)
-
-    # create window with index unique_id
-    subprocess.run(["tmux", "new-window", "-t", f"queue:{unique_id}"], check=True)
-
-    print(f"{INFO} Queue: Staging job in tmux window queue:{unique_id}, please wait for seconds...")
-    time.sleep(5)
-
-    # verify window exists
-    try:
-        lw = subprocess.run(
-            ["tmux", "list-windows", "-t", "queue"],
-            capture_output=True,
-            text=True,
-            check=True,
-        ).stdout.splitlines()
-    except subprocess.CalledProcessError:
-        print(f"{FAIL} Queue: 'tmux list-windows' failed for session 'queue'")
-        return
-
-    if not any(line.startswith(f"{unique_id}:") for line in lw):
-        print(f"{FAIL} Queue: Failed to create job in tmux window queue:{unique_id}")
-        print(f"{FAIL} Queue: Window {unique_id} not found")
-        print(f"{FAIL} Queue: This may indicate the window is already present; please check the tmux session")
+    # make sure the just_staging.sh file exists
+    if not os.path.exists(f"{dir_path}/just_staging.sh"):
+        print(f"{FAIL} Queue: just_staging.sh file not found in {dir_path}")
         return
 
-    # append to queue with lock
+    # append to queue with lock, the staging executor runs just_staging.sh when a worker is free
+    task.other_info["staging"] = staging.new_state()
     q = read_and_lock_queue()
     try:
+        index = load_queue_index(q)
         q.append(task.to_dict())
-        write_and_unlock_queue(q)
+        _index_add(index, task.to_dict())
+        _write_queue(q, index)
     except Exception:
         release_lock_queue()
         raise
 
-    # make sure the just_staging.sh file exists
-    if not os.path.exists(f"{dir_path}/just_staging.sh"):
-        print(f"{FAIL} Queue: just_staging.sh file not found in {dir_path}")
-        return
-
-    # start staging
-    time.sleep(5)
-    subprocess.run(
-        ["tmux", "send-keys", "-t", f"queue:{unique_id}", f"cd {shlex.quote(dir_path)}", "Enter"],
-        check=True,
-    )
-    time.sleep(5)
-    subprocess.run(
-        ["tmux", "send-keys", "-t", f"queue:{unique_id}", f"source just_staging.sh {unique_id}; sleep 600; exit", "Enter"],
-        check=True,
-    )
-
-    print(f"{GOOD} Queue: Successfully starting staging in tmux window queue:{unique_id}")
+    cfg = staging.config(data)
+    if staging.pump(cfg):
+        print(f"{GOOD} Queue: Task {unique_id} queued, staging started (log: {STAGING_LOG_DIR}/{unique_id}.log)")
+    else:
+        print(f"{GOOD} Queue: Task {unique_id} queued, staging waits for one of the {cfg['staging_workers']} workers (see tpu vq)")
 
 def visualize_queue(limit: int = None, truncate_tpus: int = 6, return_rows: bool = False, user = None):
     """
@@ -561,6 +825,8 @@ def visualize_queue(limit: int = None, truncate_tpus: int = 6, return_rows: bool
       - id    (task_id)
       - permission (two-digit string)
       - tpu_list  (valid_tpu; truncated for display)
+      - staging: state of the staging of the task (see staging.describe)
+      - rank, score, policy: the order the queue policy tries the tasks in, and why (see queue_policy)
 
     Args:
         limit: if set, show at most this many rows (from the front of the queue).
@@ -582,6 +848,16 @@ def visualize_queue(limit: int = None, truncate_tpus: int = 6, return_rows: bool
         # we didn't modify, so just release; do NOT call write_and_unlock_queue
         release_lock_queue()
 
+    # the decisions of the queue policy, on the whole queue (the shares depend on the tasks ahead)
+    try:
+        policy = get_policy(read_data())
+        explained = policy.explain(q)
+        decisions = {(task_dict.get("other_info") or {}).get("task_id"): explained[i] for i, task_dict in enumerate(q)}
+        rank = {(q[i].get("other_info") or {}).get("task_id"): n + 1 for n, i in enumerate(policy.order(q))}
+    except Exception as e:
+        print(f"{WARNING} visualize_queue: failed to evaluate the queue policy: {e}")
+        policy, decisions, rank = None, {}, {}
+
     def _pick_time(other_info: dict) -> str:
         if not isinstance(other_info, dict):
             return "-"
@@ -609,12 +885,16 @@ def visualize_queue(limit: int = None, truncate_tpus: int = 6, return_rows: bool
             "id":   str(other.get("task_id", "-")),
             "perm": _perm_str(priority_info),
             "tpu_type": other.get("tpu_type", "-"),
-            "note": task_dict.get("job",{}).get("job_tags",'-')[:20]
+            "note": task_dict.get("job",{}).get("job_tags",'-')[:20],
+            "staging": staging.describe(task_dict),
+            "rank": str(rank.get(other.get("task_id"), "-")),
+            "score": f"{decisions[other.get('task_id')][0]:.2f}" if other.get("task_id") in decisions else "-",
+            "policy": decisions[other.get("task_id")][1] if other.get("task_id") in decisions else "-",
         }
         rows.append(row)
 
     # --- render as a simple table ---
-    headers = ["time", "user", "id", "perm", "tpu_type", "note"]
+    headers = ["time", "user", "id", "perm", "tpu_type", "note", "staging", "rank", "score", "policy"]
 
     # compute column widths
     col_w = {h: len(h) for h in headers}
@@ -635,7 +915,7 @@ def visualize_queue(limit: int = None, truncate_tpus: int = 6, return_rows: bool
         for r in rows:
             print(fmt_row(r))
         print(line("-"))
-        print(f"{INFO} visualize_queue: {len(rows)} task(s) shown")
+        print(f"{INFO} visualize_queue: {len(rows)} task(s) shown" + (f", policy {policy.name} (rank: the order tasks are tried)" if policy is not None else ""))
     else:
         print(f"{INFO} visualize_queue: queue is empty")
 
@@ -720,12 +1000,14 @@ def upd_staging_info(unique_id, window, stage_dir):
             if str(task_id) == target:
                 task_dict.setdefault("job_info", {})["stage_dir"] = stage_dir
                 task_dict.setdefault("job", {})["stage_dir"] = stage_dir
+                staging.mark_done(task_dict)
                 updated = True
                 break
 
         if updated:
             write_and_unlock_queue(queue)
             print(f"{GOOD} upd_staging_info: stage_dir set for task {unique_id} -> {stage_dir}")
+            staging.pump() # a worker is free
         else:
             # no mutation; just release the lock
             release_lock_queue()
@@ -0,0 +1,199 @@
+import re, datetime
+from .constants import *
+from .data_io import read_legacy
+
+# data.json "queue_config" (all optional):
+#   policy: 'fair' (default) or 'fifo'
+#   usage_window_hours: chip-hours are counted over this many last hours (default 24)
+#   usage_unit: chip-hours of recent usage that cost one priority point (default 256)
+#   aging_hours: a task gains one priority point per this many hours in the queue (default 6, 0 to disable)
+#   weights: {user: weight}, a user of weight 2 pays half as much for the same usage (default 1)
+#   max_running: default cap on the running jobs of a user (default 0, no cap)
+#   max_running_user: {user: cap}, overrides max_running
+DEFAULT_CONFIG = {
+    'policy': 'fair',
+    'usage_window_hours': 24,
+    'usage_unit': 256,
+    'aging_hours': 6,
+    'weights': {},
+    'max_running': 0,
+    'max_running_user': {},
+}
+TPU_SIZE_RE = re.compile(r'v\d+[a-z]*-(\d+)')
+TIME_FMT = "%Y-%m-%d %H:%M:%S"
+
+
+def parse_time(s):
+    """
+    Parse the times written by the tool ('YYYY-MM-DD HH:MM:SS', the queue times are 'CHN: ...'),
+    in the clock of get_abs_time_str. None if it cannot be parsed.
+    """
+    if not isinstance(s, str):
+        return None
+    offset = datetime.timedelta(0)
+    if s.startswith('CHN: '):
+        s, offset = s[5:], datetime.timedelta(hours=8)
+    try:
+        return datetime.datetime.strptime(s.strip(), TIME_FMT) - offset
+    except ValueError:
+        return None
+
+
+def tpu_size(tpu):
+    """
+    The size in the TPU name (v4-32 -> 32), the unit of the chip-hours. 0 if unknown.
+    """
+    m = TPU_SIZE_RE.search(tpu or '')
+    return int(m.group(1)) if m else 0
+
+
+def is_running(job):
+    return job.get('status') in (None, 'running')
+
+
+def _job_end(job, now):
+    if is_running(job):
+        return now
+    extra = job.get('extra_msgs') or {}
+    return parse_time(extra.get('finish_time_abs') or extra.get('fail_time_abs'))
+
+
+def usage_by_user(jobs, now, window_hours):
+    """
+    Chip-hours used by every user over the last window_hours: the part of each job (start_time.utc to its
+    finish/fail time, or now if running) inside the window, times the size of its TPU.
+    """
+    since = now - datetime.timedelta(hours=window_hours)
+    usage = {}
+    for job in jobs:
+        start = parse_time((job.get('start_time') or {}).get('utc'))
+        end = _job_end(job, now)
+        if start is None or end is None:
+            continue
+        hours = (min(end, now) - max(start, since)).total_seconds() / 3600
+        if hours > 0:
+            usage[job.get('user')] = usage.get(job.get('user'), 0) + hours * tpu_size(job.get('tpu'))
+    return usage
+
+
+class FifoPolicy:
+    """
+    Priority, then queue order, with the per-user caps. The policy of the queue before fair share.
+    """
+    name = 'fifo'
+
+    def __init__(self, data, config=None, now=None):
+        self.config = dict(DEFAULT_CONFIG, **(config if config is not None else data.get('queue_config', {})))
+        self.now = now or datetime.datetime.now()
+        self.running = {}
+        for user, user_data in data['users'].items():
+            self.running[user] = sum(1 for job in user_data['job_data'] if is_running(job))
+
+    def cap(self, user):
+        return self.config['max_running_user'].get(user, self.config['max_running'])
+
+    def admit(self, user):
+        """
+        Whether a task of user may start now (below its cap of running jobs).
+        """
+        cap = self.cap(user)
+        return not cap or self.running.get(user, 0) < cap
+
+    def took(self, user):
+        """
+        Record that a task of user was started (by the current scheduling pass).
+        """
+        self.running[user] = self.running.get(user, 0) + 1
+
+    def scores(self, queue):
+        """
+        {position in queue: score}, the higher the sooner.
+        """
+        return {i: _priority(task_dict) for i, task_dict in enumerate(queue)}
+
+    def order(self, queue):
+        """
+        The positions of the tasks of queue, in the order they should be tried.
+        """
+        scores = self.scores(queue)
+        return sorted(range(len(queue)), key=lambda i: (-scores[i], i))
+
+    def explain(self, queue):
+        """
+        {position: (score, note)} for visualize_queue.
+        """
+        scores = self.scores(queue)
+        return {i: (scores[i], self._cap_note(task_dict.get('user'))) for i, task_dict in enumerate(queue)}
+
+    def _cap_note(self, user):
+        cap = self.cap(user)
+        if not cap:
+            return ''
+        return f"{'capped ' if not self.admit(user) else ''}{self.running.get(user, 0)}/{cap} running"
+
+
+class FairSharePolicy(FifoPolicy):
+    """
+    score = priority + hours queued / aging_hours - (chip-hours used recently / usage_unit + tasks of the same user
+    ahead in the queue) / weight. A user who used a lot, or queued many tasks, goes after the others, and
+    an old task eventually rises.
+    """
+    name = 'fair'
+
+    def __init__(self, data, config=None, now=None, legacy=None):
+        super().__init__(data, config, now)
+        jobs = [job for user_data in data['users'].values() for job in user_data['job_data']]
+        if legacy is None:
+            try:
+                legacy = read_legacy()
+            except (OSError, ValueError):
+                legacy = []
+        self.usage = usage_by_user(jobs + legacy, self.now, self.config['usage_window_hours'])
+
+    def weight(self, user):
+        return self.config['weights'].get(user, 1) or 1
+
+    def _terms(self, queue):
+        ahead = {}
+        for i, task_dict in enumerate(queue):
+            user = task_dict.get('user')
+            other = task_dict.get('other_info') or {}
+            queued = parse_time(other.get('queue_time'))
+            age = (self.now - queued).total_seconds() / 3600 if queued else 0
+            aging = age / self.config['aging_hours'] if self.config['aging_hours'] else 0
+            share = (self.usage.get(user, 0) / self.config['usage_unit'] + ahead.get(user, 0)) / self.weight(user)
+            ahead[user] = ahead.get(user, 0) + 1
+            yield i, _priority(task_dict), aging, share
+
+    def scores(self, queue):
+        return {i: priority + aging - share for i, priority, aging, share in self._terms(queue)}
+
+    def explain(self, queue):
+        out = {}
+        for i, priority, aging, share in self._terms(queue):
+            note = f"aged +{aging:.1f}, share -{share:.1f}"
+            cap_note = self._cap_note(queue[i].get('user'))
+            out[i] = (priority + aging - share, f"{note}, {cap_note}" if cap_note else note)
+        return out
+
+
+def _priority(task_dict):
+    try:
+        return int((task_dict.get('priority_info') or {}).get('priority', 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+POLICIES = {FifoPolicy.name: FifoPolicy, FairSharePolicy.name: FairSharePolicy}
+
+
+def get_policy(data, now=None):
+    """
+    The policy chosen by queue_config.policy in data.json.
+    """
+    config = data.get('queue_config', {})
+    name = config.get('policy', DEFAULT_CONFIG['policy'])
+    if name not in POLICIES:
+        print(f"{WARNING} get_policy: unknown queue policy {name}, using {DEFAULT_CONFIG['policy']}")
+        name = DEFAULT_CONFIG['policy']
+    return POLICIES[name](data, config, now)
@@ -0,0 +1,144 @@
+import os, json, time, fcntl, random, threading
+from .constants import *
+from .metrics import counter, histogram
+
+RATE = 1.0               # requests per second allowed to the Sheets API by all our processes together (quota: 60/min/user)
+BURST = 10               # size of the bucket
+RESERVED = 3             # tokens only interactive requests may take, so background sync never starves a command
+MAX_RETRIES = 5
+MAX_BACKOFF = 64
+
+THROTTLE_SECONDS = histogram("sheet_throttle_seconds", "Time spent waiting for a Sheets API token", ["priority"],
+                             buckets=(0.01, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120))
+RETRIES = counter("sheet_api_retries_total", "Sheets API requests retried after a 429/5xx", ["status"])
+
+_local = threading.local()
+# held while a thread has the bucket file flocked: a child forked meanwhile would inherit the locked file
+# description and block on its own first update
+_fork_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    global _fork_lock
+    _fork_lock = threading.Lock()
+
+
+os.register_at_fork(before=lambda: _fork_lock.acquire(), after_in_parent=lambda: _fork_lock.release(),
+                    after_in_child=_reset_after_fork)
+
+
+class background:
+    """
+    `with rate_limit.background():` marks the Sheets API calls of this thread as background (sync, batched writes),
+    they wait while the bucket is below RESERVED.
+    """
+    def __enter__(self):
+        self.previous = getattr(_local, 'priority', 'interactive')
+        _local.priority = 'background'
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _local.priority = self.previous
+        return False
+
+
+def priority():
+    return getattr(_local, 'priority', 'interactive')
+
+
+class TokenBucket:
+    """
+    A token bucket shared by all the processes of the machine, its state ({'tokens', 'updated'}) lives in a file
+    and is updated under an flock.
+    """
+    def __init__(self, path=SHEET_BUCKET_PATH, rate=RATE, burst=BURST, reserved=RESERVED):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self.reserved = reserved
+
+    def _update(self, change):
+        # change(tokens) -> (new tokens, result), under the lock, with the bucket refilled up to now
+        with _fork_lock, open(self.path, 'a+') as file:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            try:
+                file.seek(0)
+                try:
+                    state = json.loads(file.read() or '{}')
+                except ValueError:
+                    state = {}
+                now = time.time()
+                tokens = min(self.burst, state.get('tokens', self.burst) + (now - state.get('updated', now)) * self.rate)
+                tokens, result = change(tokens)
+                file.seek(0)
+                file.truncate()
+                file.write(json.dumps({'tokens': tokens, 'updated': now}))
+                file.flush()
+            finally:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+        return result
+
+    def try_take(self, prio):
+        """
+        Take a token, return 0 on success, else the seconds to wait before there may be one.
+        """
+        floor = self.reserved if prio == 'background' else 0
+        def take(tokens):
+            if tokens >= floor + 1:
+                return tokens - 1, 0
+            return tokens, (floor + 1 - tokens) / self.rate
+        return self._update(take)
+
+    def acquire(self, prio=None):
+        """
+        Block until a token is taken, return the seconds waited.
+        """
+        prio = prio or priority()
+        start = time.time()
+        while True:
+            wait = self.try_take(prio)
+            if wait == 0:
+                break
+            time.sleep(wait + random.uniform(0, 0.05)) # jitter, so that the waiting processes do not all retry at once
+        waited = time.time() - start
+        THROTTLE_SECONDS.observe(waited, priority=prio)
+        return waited
+
+    def drain(self):
+        """
+        Empty the bucket, after a 429 every process slows down, not only the one that got it.
+        """
+        self._update(lambda tokens: (0, None))
+
+
+BUCKET = TokenBucket()
+
+
+def status_of(e):
+    return getattr(getattr(e, 'response', None), 'status_code', None)
+
+
+def retryable(e):
+    status = status_of(e)
+    return status == 429 or (status is not None and 500 <= status < 600)
+
+
+def call(fn, *args, **kwargs):
+    """
+    Call fn (a gspread call, i.e. one API request) once a token is available, retrying with exponential backoff
+    on 429 and 5xx up to MAX_RETRIES times.
+    """
+    delay = 1
+    for attempt in range(MAX_RETRIES + 1):
+        BUCKET.acquire()
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == MAX_RETRIES or not retryable(e):
+                raise
+            status = status_of(e)
+            RETRIES.inc(status=status)
+            if status == 429:
+                BUCKET.drain()
+            time.sleep(delay + random.uniform(0, delay / 2))
+            delay = min(delay * 2, MAX_BACKOFF)
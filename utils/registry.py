@@ -0,0 +1,119 @@
+import os, json, time, fcntl, copy
+from .constants import *
+from .data_io import _atomic_write_json
+
+# the columns both we and the humans write, merged per column on every sync;
+# 'local': the registry wins a conflict (written by the tool), 'sheet': the sheet wins (edited by hand)
+SYNCED_COLUMNS = {
+    'running_status': 'local',
+    'user': 'local',
+    'script_note': 'local',
+    'other_note': 'sheet',
+    'belong': 'sheet',
+    'user_note': 'sheet',
+    'env': 'sheet',
+}
+LIVE_SECONDS = 180       # the registry is used for reads only if it was synced this recently
+
+
+class _RegistryLock:
+    def __enter__(self):
+        self.file = open(REGISTRY_PATH + '.lock', 'a')
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+        return False
+
+
+def load():
+    """
+    The registry: {'synced_at': unix time, 'tpus': {full name: {'info': sheet-like info dict, 'base': {column: value}}}},
+    'base' holds the value of every synced column the last time the registry and the sheet agreed.
+    """
+    try:
+        with open(REGISTRY_PATH, 'r') as file:
+            registry = json.load(file)
+        if 'tpus' in registry:
+            return registry
+    except (OSError, ValueError):
+        pass
+    return {'synced_at': 0, 'tpus': {}}
+
+
+def is_live(registry=None):
+    registry = load() if registry is None else registry
+    return time.time() - registry.get('synced_at', 0) < LIVE_SECONDS
+
+
+def tpu_information(registry=None):
+    """
+    The TPU table in the format of sheet.read_sheet_info.
+    """
+    registry = load() if registry is None else registry
+    return {name: copy.deepcopy(entry['info']) for name, entry in registry['tpus'].items()}
+
+
+def record_local(info, columns=SYNCED_COLUMNS):
+    """
+    Record our own write of the columns of a TPU row (info as given to sheet.write_sheet_info).
+    """
+    with _RegistryLock():
+        registry = load()
+        for entry in registry['tpus'].values():
+            if entry['info'].get('line') == info.get('line'):
+                for column in columns:
+                    if column in info and column in SYNCED_COLUMNS:
+                        entry['info'][column] = _normalize(column, info[column])
+                _atomic_write_json(REGISTRY_PATH, registry)
+                return True
+    return False
+
+
+def _normalize(column, value):
+    # the values as read_sheet_info returns them
+    if column == 'running_status':
+        return {'闲的': 'free', 'reserved(error)': 'reserved'}.get(value, value)
+    if column == 'user':
+        return {'闲的': 'free'}.get(value, value)
+    return value
+
+
+def merge(sheet_information):
+    """
+    Three-way merge of the rows read from the sheet into the registry, per column (see SYNCED_COLUMNS):
+    a column changed on one side only takes that side, a column changed on both sides takes its owner's value.
+    The other fields (line, alias, zone, ...) mirror the sheet, and rows deleted from the sheet are dropped.
+    Return (info, columns) of the rows whose registry values of columns must be pushed to the sheet.
+    """
+    to_push = []
+    with _RegistryLock():
+        registry = load()
+        tpus = {}
+        for name, sheet_info in sheet_information.items():
+            entry = registry['tpus'].get(name)
+            if entry is None:
+                tpus[name] = {'info': dict(sheet_info), 'base': {c: sheet_info.get(c) for c in SYNCED_COLUMNS}}
+                continue
+            local, base = entry['info'], entry['base']
+            for key, value in sheet_info.items():
+                if key not in SYNCED_COLUMNS:
+                    local[key] = value
+            push = []
+            for column, owner in SYNCED_COLUMNS.items():
+                theirs, ours, agreed = sheet_info.get(column), local.get(column), base.get(column)
+                if theirs == ours:
+                    base[column] = theirs
+                elif ours == agreed or owner == 'sheet':
+                    local[column] = base[column] = theirs
+                else:
+                    push.append(column) # ours changed (and theirs did not, or we own the column)
+            if push:
+                to_push.append((dict(local), push))
+            tpus[name] = entry
+        registry['tpus'] = tpus
+        registry['synced_at'] = time.time()
+        _atomic_write_json(REGISTRY_PATH, registry)
+    return to_push
@@ -0,0 +1,123 @@
+import os, json, time, fcntl
+from .constants import *
+
+
+class RingLog:
+    """
+    Append-only, size-bounded log of JSON records kept in a directory of segment files
+    (00000001.jsonl, 00000002.jsonl, ...). Appends go to the newest segment under an flock, a new segment is
+    started when it reaches segment_bytes, and the oldest segments are deleted beyond max_segments,
+    so the log never grows past about segment_bytes * max_segments.
+    Every record carries its unix time "ts", reads by time only open the segments that can contain it.
+    """
+    def __init__(self, dir_path, segment_bytes=1 << 20, max_segments=8):
+        self.dir_path = dir_path
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.lock_path = os.path.join(dir_path, '.lock')
+
+    def _segments(self):
+        try:
+            names = [n for n in os.listdir(self.dir_path) if n.endswith('.jsonl') and n[:-6].isdigit()]
+        except FileNotFoundError:
+            return []
+        return sorted(names, key=lambda n: int(n[:-6]))
+
+    def _locked(self):
+        os.makedirs(self.dir_path, exist_ok=True)
+        return _FileLock(self.lock_path)
+
+    def append(self, record):
+        """
+        Append one record (dict), a "ts" field is added if missing.
+        """
+        if "ts" not in record:
+            record = {"ts": time.time()} | record
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._locked():
+            segments = self._segments()
+            if not segments:
+                segments = ['00000001.jsonl']
+            current = os.path.join(self.dir_path, segments[-1])
+            try:
+                size = os.path.getsize(current)
+            except OSError:
+                size = 0
+            if size >= self.segment_bytes:
+                segments.append(f"{int(segments[-1][:-6]) + 1:08d}.jsonl")
+                current = os.path.join(self.dir_path, segments[-1])
+                for name in segments[:-self.max_segments]:
+                    try:
+                        os.remove(os.path.join(self.dir_path, name))
+                    except OSError:
+                        pass
+            with open(current, 'a') as file:
+                file.write(line)
+
+    def _first_ts(self, name):
+        try:
+            with open(os.path.join(self.dir_path, name), 'r') as file:
+                return json.loads(file.readline())["ts"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def read(self, since=None, until=None, limit=None):
+        """
+        Return the records with since <= ts < until (unix times, None for no bound), oldest first.
+        If limit is given, only the newest limit records are returned.
+        """
+        segments = self._segments()
+        if since is not None:
+            # skip the segments that end before since, i.e. the next segment already starts before it
+            first = 0
+            for i in range(len(segments) - 1, -1, -1):
+                ts = self._first_ts(segments[i])
+                if ts is not None and ts <= since:
+                    first = i
+                    break
+            segments = segments[first:]
+        records = []
+        for name in segments:
+            try:
+                with open(os.path.join(self.dir_path, name), 'r') as file:
+                    lines = file.readlines()
+            except OSError:
+                continue # rotated away meanwhile
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue # partial line
+                ts = record.get("ts", 0)
+                if since is not None and ts < since:
+                    continue
+                if until is not None and ts >= until:
+                    return records[-limit:] if limit else records
+                records.append(record)
+        return records[-limit:] if limit else records
+
+    def clear(self):
+        with self._locked():
+            for name in self._segments():
+                try:
+                    os.remove(os.path.join(self.dir_path, name))
+                except OSError:
+                    pass
+
+
+class _FileLock:
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.file = open(self.path, 'a')
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+        return False
+
+
+MONITOR_LOG = RingLog(MONITOR_LOG_DIR)
@@ -0,0 +1,112 @@
+import datetime, statistics
+from .constants import *
+from .data_io import read_data, read_legacy
+from .queue_policy import parse_time, is_running
+
+# the keys a job is matched on, from the most to the least specific; the first with history gives the estimate
+BASES = ('config', 'tags', 'dir', 'tag')
+
+
+def _configs(job):
+    return ' '.join(sorted((job.get('extra_configs') or '').split()))
+
+
+def _keys(job):
+    job_dir = job.get('job_dir') or job.get('job_dir_id')
+    tags = job.get('job_tags') or ''
+    return {
+        'config': (job_dir, _configs(job)) if job_dir else None,
+        'tags': (job_dir, tags) if job_dir and tags else None,
+        'dir': job_dir,
+        'tag': tags or None,
+    }
+
+
+def actual_hours(job):
+    """
+    The runtime of a finished job (start_time.utc to finish_time_abs), None if it did not finish.
+    """
+    if job.get('status') != 'finished':
+        return None
+    start = parse_time((job.get('start_time') or {}).get('utc'))
+    end = parse_time((job.get('extra_msgs') or {}).get('finish_time_abs'))
+    if start is None or end is None or end < start:
+        return None
+    return (end - start).total_seconds() / 3600
+
+
+def load_history(data=None):
+    """
+    The finished jobs of legacy.json and data.json.
+    """
+    data = read_data() if data is None else data
+    try:
+        legacy = read_legacy()
+    except (OSError, ValueError):
+        legacy = []
+    jobs = legacy + [job for user_data in data['users'].values() for job in user_data['job_data']]
+    return [job for job in jobs if actual_hours(job) is not None]
+
+
+class Estimator:
+    """
+    Runtime estimates from the finished jobs: the median runtime of the jobs with the same job dir and configs,
+    else the same job dir and tags, else the same job dir, else the same tags.
+    """
+    def __init__(self, history):
+        self.samples = {basis: {} for basis in BASES}
+        for job in history:
+            hours = actual_hours(job)
+            for basis, key in _keys(job).items():
+                if key is not None:
+                    self.samples[basis].setdefault(key, []).append(hours)
+
+    def estimate(self, job):
+        """
+        Return (hours, basis), (None, None) if no similar job finished.
+        """
+        for basis, key in _keys(job).items():
+            hours = self.samples[basis].get(key) if key is not None else None
+            if hours:
+                return statistics.median(hours), basis
+        return None, None
+
+    def remaining(self, job, now=None):
+        """
+        The estimated hours left of a running job, None if unknown.
+        """
+        hours, _ = self.estimate(job)
+        start = parse_time((job.get('start_time') or {}).get('utc'))
+        if hours is None or start is None:
+            return None
+        now = now or datetime.datetime.now()
+        return max(0.0, hours - (now - start).total_seconds() / 3600)
+
+
+def report(data=None):
+    """
+    Predicted (extra_msgs.predicted_hours, written when the queue starts a job) vs actual runtime of the finished jobs,
+    per basis of the prediction.
+    """
+    rows = {}
+    for job in load_history(data):
+        extra = job.get('extra_msgs') or {}
+        predicted = extra.get('predicted_hours')
+        if predicted is None:
+            continue
+        error = actual_hours(job) - predicted
+        row = rows.setdefault(extra.get('predicted_basis', '-'), {'n': 0, 'abs': 0.0, 'bias': 0.0, 'rel': []})
+        row['n'] += 1
+        row['abs'] += abs(error)
+        row['bias'] += error
+        if predicted > 0:
+            row['rel'].append(abs(error) / predicted)
+    if not rows:
+        print(f"{INFO} runtime report: no finished job has a predicted runtime yet")
+        return rows
+    print(f"{'basis':<8} {'jobs':>5} {'MAE (h)':>8} {'bias (h)':>9} {'median rel err':>15}")
+    for basis in sorted(rows, key=lambda b: BASES.index(b) if b in BASES else len(BASES)):
+        row = rows[basis]
+        rel = f"{statistics.median(row['rel']) * 100:.0f}%" if row['rel'] else '-'
+        print(f"{basis:<8} {row['n']:>5} {row['abs'] / row['n']:>8.2f} {row['bias'] / row['n']:>+9.2f} {rel:>15}")
+    return rows
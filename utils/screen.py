@@ -0,0 +1,90 @@
+import sys, time, signal, shutil
+from .constants import ANSI_RE
+
+
+def ansi_truncate(s, width):
+    """
+    Cut s to width visible characters, keeping the escape sequences (and resetting the colour if cut).
+    """
+    out, shown, pos = [], 0, 0
+    for m in ANSI_RE.finditer(s):
+        text = s[pos:m.start()]
+        if shown + len(text) > width:
+            out.append(text[:width - shown])
+            return ''.join(out) + '\033[0m'
+        out.append(text)
+        shown += len(text)
+        out.append(m.group())
+        pos = m.end()
+    text = s[pos:]
+    if shown + len(text) > width:
+        return ''.join(out) + text[:width - shown] + '\033[0m'
+    return ''.join(out) + text
+
+
+class DiffRenderer:
+    """
+    Draw a frame (a list of lines) in place on the terminal, only rewriting the lines that changed since the
+    last frame (cursor addressing + clear to end of line), instead of clearing the screen and printing everything.
+    The whole screen is repainted when the terminal is resized (SIGWINCH) and every full_every seconds,
+    in case something else printed in between. If stdout is not a terminal, the frames are simply printed.
+    """
+    def __init__(self, out=None, full_every=60, on_resize=None):
+        self.out = out or sys.stdout
+        self.full_every = full_every
+        self.on_resize = on_resize
+        self.prev = None
+        self.last_full = 0
+        self.resized = True
+        self.tty = self.out.isatty()
+        self.old_handler = None
+        if self.tty and hasattr(signal, 'SIGWINCH'):
+            try:
+                self.old_handler = signal.signal(signal.SIGWINCH, self._handle_winch)
+            except ValueError:
+                pass # not in the main thread, the size is still checked on every frame
+
+    def _handle_winch(self, signum, frame):
+        self.resized = True
+        if self.on_resize is not None:
+            self.on_resize()
+
+    def size(self):
+        return shutil.get_terminal_size((120, 40))
+
+    def render(self, lines):
+        if not self.tty:
+            self.out.write('\n'.join(lines) + '\n')
+            self.out.flush()
+            return
+        columns, rows = self.size()
+        lines = [ansi_truncate(line, columns) for line in lines]
+        if len(lines) > rows:
+            hidden = len(lines) - rows + 1
+            lines = lines[:rows - 1] + [ansi_truncate(f"... (+{hidden} lines, enlarge the terminal or use col=)", columns)]
+
+        buf = ['\033[?25l']
+        if self.resized or self.prev is None or time.time() - self.last_full > self.full_every or (columns, rows) != self.prev[0]:
+            self.resized = False
+            self.last_full = time.time()
+            buf.append('\033[H\033[2J')
+            buf.extend(f'\033[{i + 1};1H{line}' for i, line in enumerate(lines))
+        else:
+            prev_lines = self.prev[1]
+            for i, line in enumerate(lines):
+                if i >= len(prev_lines) or prev_lines[i] != line:
+                    buf.append(f'\033[{i + 1};1H{line}\033[K')
+            for i in range(len(lines), len(prev_lines)):
+                buf.append(f'\033[{i + 1};1H\033[K')
+        buf.append(f'\033[{len(lines) + 1 if len(lines) < rows else rows};1H\033[?25h')
+        self.out.write(''.join(buf))
+        self.out.flush()
+        self.prev = ((columns, rows), lines)
+
+    def close(self):
+        if self.old_handler is not None:
+            signal.signal(signal.SIGWINCH, self.old_handler)
+            self.old_handler = None
+        if self.tty:
+            self.out.write('\033[?25h')
+            self.out.flush()
@@ -1,40 +1,191 @@
 import gspread
 from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import Request
 from typing import List
+import os, json, time, fcntl, atexit, threading
 from .helpers import *
 from .constants import *
 from .data_io import *
+from .data_io import _atomic_write_json
+from .metrics import counter
+from . import registry, rate_limit
 
-def read_sheet_info() -> dict:
+SHEET_ID = "1MFtgLx7uzBFdiPxrIqck00ilrSslZU2w2jRwriVpKMw"
+SHEET_NAME = "ka[experimental]"
+SHEET_SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+TOKEN_REFRESH_MARGIN = 300     # refresh the access token this many seconds before it expires
+SHEET_CACHE_TTL = 30           # seconds the shared snapshot of the TPU table is used before reading the sheet again
+_snapshot_time = None          # when the data last returned by read_sheet_info was read from the sheet
+REGISTRY_SYNC_INTERVAL = 60    # seconds between two syncs of the registry with the sheet
+WRITE_DELAY = 1                # seconds the row writes are queued to be merged into one batch_update
+_write_backoff = WRITE_DELAY
+
+SHEET_API_CALLS = counter("sheet_api_calls_total", "HTTP requests sent to the Google Sheets API", ["method"])
+
+
+class SheetClient:
+    """
+    One authorized gspread client per process: the credentials, the HTTP session (and its connection pool)
+    and the worksheet handle are kept, instead of authorizing and opening the sheet again for every call.
+    The access token is refreshed shortly before it expires. Every request is counted in `calls`.
+    """
+    def __init__(self, sheet_id=SHEET_ID, sheet_name=SHEET_NAME):
+        self.sheet_id = sheet_id
+        self.sheet_name = sheet_name
+        self.lock = threading.Lock()
+        self.creds = None
+        self.client = None
+        self.ws = None
+        self.calls = 0
+
+    def _count(self, response, *args, **kwargs):
+        self.calls += 1
+        SHEET_API_CALLS.inc(method=response.request.method)
+
+    def _connect(self):
+        self.creds = Credentials.from_service_account_file(SECRET_PATH, scopes=SHEET_SCOPES)
+        self.client = gspread.authorize(self.creds)
+        http_client = getattr(self.client, 'http_client', self.client) # gspread < 6 keeps the session on the client
+        http_client.session.hooks['response'].append(self._count)
+        spreadsheet = rate_limit.call(self.client.open_by_key, self.sheet_id)
+        self.ws = rate_limit.call(spreadsheet.worksheet, self.sheet_name)
+
+    def worksheet(self):
+        with self.lock:
+            if self.ws is None:
+                self._connect()
+            elif self.creds.expiry is not None and (self.creds.expiry - datetime.datetime.utcnow()).total_seconds() < TOKEN_REFRESH_MARGIN:
+                self.creds.refresh(Request())
+            return self.ws
+
+    def reset(self):
+        """
+        Drop the session, the next call authorizes again (e.g. after the worksheet was renamed).
+        """
+        with self.lock:
+            self.creds, self.client, self.ws = None, None, None
+
+
+SHEET = SheetClient()
+
+
+def get_worksheet():
+    return SHEET.worksheet()
+
+
+def _print_api_calls():
+    if SHEET.calls:
+        print(f"{INFO} sheet: {SHEET.calls} Google Sheets API requests in this process")
+
+# TPU_SHEET_STATS=1 tpu run ... prints the number of requests of the command
+if os.environ.get("TPU_SHEET_STATS"):
+    atexit.register(_print_api_calls)
+
+def read_sheet_info(max_age = SHEET_CACHE_TTL) -> dict:
     """
     Read the TPU information from the Google Sheet.
     Return: a dictionary of dictionaries with TPU information.
     Keys: TPU full name
     Values: a dictionary with keys ['zone', 'pre', 'belong', 'running_status', 'user', 'user_note', 'script_note', 'alias', 'version', 'type', 'other_note', 'env', 'line']
     Logic: Read the lines that COL B starts with 'v'.
+    The result is shared by all the processes: it comes from the local registry (registry.py) if the sync daemon is
+    running, else from the snapshot in SHEET_CACHE_PATH if it is younger than max_age seconds (0 to always read
+    the sheet). See snapshot_age for how old the returned data is.
     """
-    data = read_data()
+    global _snapshot_time
+    if max_age:
+        # the local registry, while the sync daemon keeps it in line with the sheet
+        local = registry.load()
+        if local['tpus'] and registry.is_live(local):
+            _snapshot_time = local['synced_at']
+            return registry.tpu_information(local)
+        snapshot = _load_snapshot()
+        if snapshot is not None and time.time() - snapshot['fetched_at'] < max_age:
+            _snapshot_time = snapshot['fetched_at']
+            return snapshot['info']
+    flush() # our own queued writes must be in the sheet before it is read into the snapshot
+    fetched_at = time.time()
+    tpu_information = _read_sheet_info()
+    _snapshot_time = fetched_at
+    with _snapshot_lock():
+        _atomic_write_json(SHEET_CACHE_PATH, {'fetched_at': fetched_at, 'info': tpu_information})
+    return tpu_information
+
+def _load_snapshot():
+    try:
+        with open(SHEET_CACHE_PATH, 'r') as file:
+            snapshot = json.load(file)
+        return snapshot if 'fetched_at' in snapshot and 'info' in snapshot else None
+    except (OSError, ValueError):
+        return None
 
-    secret_path = SECRET_PATH
-    sheet_id  = "1MFtgLx7uzBFdiPxrIqck00ilrSslZU2w2jRwriVpKMw"
-    sheet_name  = "ka[experimental]"
+class _snapshot_lock:
+    # serializes the writers of the snapshot, so that a write-through is not lost under a refresh
+    def __enter__(self):
+        self.file = open(SHEET_CACHE_PATH + '.lock', 'a')
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        return self
 
-    # 1. authenticate
-    scopes = ["https://www.googleapis.com/auth/spreadsheets.readonly"]
-    creds  = Credentials.from_service_account_file(secret_path, scopes=scopes)
-    client = gspread.authorize(creds)
+    def __exit__(self, exc_type, exc, tb):
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+        return False
 
-    # 2. open the sheet
-    ws = client.open_by_key(sheet_id).worksheet(sheet_name)
+def snapshot_age():
+    """
+    Seconds since the sheet data last returned by read_sheet_info was read from the sheet (None if nothing was read).
+    """
+    return None if _snapshot_time is None else time.time() - _snapshot_time
 
-    # 3. find the number of rows
-    last_row = 0
-    for sentinel_col in range(2, 7): # COL B, C (ka, belonging)
-        col_values = ws.col_values(sentinel_col)
-        last_row = max(last_row, len(col_values))
+def format_snapshot_age():
+    age = snapshot_age()
+    return "" if age is None else f"(spreadsheet data from {int(age)}s ago)"
 
-    # 4. get the data
-    table = ws.get(f"A1:Z{last_row}")      # gspread.values_get -> List[List[str]]
+def invalidate_sheet_cache():
+    """
+    Drop the snapshot, the next read_sheet_info reads the sheet (e.g. after adding a row).
+    """
+    with _snapshot_lock():
+        try:
+            os.remove(SHEET_CACHE_PATH)
+        except FileNotFoundError:
+            pass
+
+def _write_through(info, columns):
+    # keep the snapshot in line with our own write of columns, normalized like _read_sheet_info does
+    with _snapshot_lock():
+        snapshot = _load_snapshot()
+        if snapshot is None:
+            return
+        key = next((k for k, v in snapshot['info'].items() if v.get('line') == info.get('line')), None)
+        if key is None:
+            os.remove(SHEET_CACHE_PATH)
+            return
+        entry = snapshot['info'][key]
+        for column in columns:
+            entry[column] = registry._normalize(column, info[column])
+        _atomic_write_json(SHEET_CACHE_PATH, snapshot)
+
+def _known_row(info):
+    # the row as this process last saw it (where read_sheet_info took it from), None if unknown
+    local = registry.load()
+    if local['tpus'] and registry.is_live(local):
+        rows = [entry['info'] for entry in local['tpus'].values()]
+    else:
+        snapshot = _load_snapshot()
+        rows = list(snapshot['info'].values()) if snapshot is not None else []
+    return next((row for row in rows if row.get('line') == info.get('line') and row.get('alias') == info.get('alias')), None)
+
+def _read_sheet_info() -> dict:
+    """
+    Read the TPU table from the sheet itself, see read_sheet_info.
+    """
+    # 1. the cached worksheet handle (authorized once per process)
+    ws = get_worksheet()
+
+    # 2. get the data, an open-ended range returns the rows up to the last non-empty one in one request
+    # (rows below the TPU table have an empty COL B and are skipped)
+    table = rate_limit.call(ws.get, "A1:Z")      # gspread.values_get -> List[List[str]]
     
     tpu_information = {}
     for i, row in enumerate(table):
@@ -89,47 +240,171 @@ def read_sheet_info() -> dict:
 
     return tpu_information
 
-def write_sheet_info(info_to_write):
+# the cells of a TPU row, the tool owns the first three, the others are edited by hand
+SHEET_COLUMNS = {'running_status': 'D', 'user': 'E', 'script_note': 'G', 'belong': 'C', 'user_note': 'F', 'env': 'H', 'other_note': 'I'}
+MACHINE_COLUMNS = ('running_status', 'user', 'script_note')
+
+def write_sheet_info(info_to_write, sync = False, columns = None):
     """
     Write the tpu information to the Google Sheet.
     Args: a dictionary of a specific TPU information, with keys ['zone', 'pre', 'belong', 'running_status', 'user', 'user_note', 'script_note', 'alias', 'version', 'type', 'other_note', 'line']
-    Only updating belong, running_status, user, user_note, script_note
+    Only the cells we own (running_status, user, script_note) and the other cells the caller changed (compared with
+    the row as read_sheet_info returned it) are written, each in its own range, so that a hand edit of another cell
+    made since the row was read is kept. columns: the columns to write instead (the registry sync).
+    The cells are queued and written by the next flush (WRITE_DELAY seconds later, at exit, or now if sync),
+    a later write of the same cell replaces the queued one. The shared snapshot is updated at once.
+    A process that exits without atexit (a multiprocessing child) must call flush itself.
     """
-    secret_path = SECRET_PATH
-    sheet_id  = "1MFtgLx7uzBFdiPxrIqck00ilrSslZU2w2jRwriVpKMw"
-    sheet_name  = "ka[experimental]"
-
-    # 1. authenticate
-    scopes = ["https://www.googleapis.com/auth/spreadsheets"]
-    creds  = Credentials.from_service_account_file(secret_path, scopes=scopes)
-    client = gspread.authorize(creds)
-
-    # 2. open the sheet
-    ws = client.open_by_key(sheet_id).worksheet(sheet_name)
-
-    # 3. write the data
-    row = info_to_write['line']
-    col = 1
+    if columns is None:
+        known = _known_row(info_to_write)
+        columns = [column for column in SHEET_COLUMNS if column in MACHINE_COLUMNS
+                   or (known is not None and info_to_write.get(column) != known.get(column))]
     transform_dict = {'free': '闲的'}
+    cells = {column: transform_dict.get(info_to_write[column], info_to_write[column]) for column in columns}
+    _write_through(info_to_write, columns)
+    registry.record_local(info_to_write, columns)
+    with _pending_lock:
+        queued = _pending.get(info_to_write['alias'])
+        _pending[info_to_write['alias']] = (dict(info_to_write), dict(queued[1] if queued else {}, **cells))
+    if sync:
+        flush()
+    else:
+        _schedule_flush(WRITE_DELAY)
+    return True
 
-    ws.update(f"C{row}:I{row}", [
-        [
-            transform_dict.get(info_to_write['belong'], info_to_write['belong']),
-            transform_dict.get(info_to_write['running_status'], info_to_write['running_status']),
-            transform_dict.get(info_to_write['user'], info_to_write['user']),
-            transform_dict.get(info_to_write['user_note'], info_to_write['user_note']),
-            transform_dict.get(info_to_write['script_note'], info_to_write['script_note']),            
-            transform_dict.get(info_to_write['env'], info_to_write['env']),
-            transform_dict.get(info_to_write['other_note'], info_to_write['other_note']),
-        ]
-    ], value_input_option='USER_ENTERED')
+_pending = {}                  # TPU name in COL B -> (info, {column: value}), the cells not sent yet
+_pending_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_flush_timer = None
+
+def _reset_after_fork():
+    # a forked child (MONITOR's recovery workers) has none of the parent's threads: the locks may have been held by one,
+    # and the queued rows are sent by the parent
+    global _pending_lock, _flush_lock, _flush_timer
+    _pending_lock = threading.Lock()
+    _flush_lock = threading.Lock()
+    _flush_timer = None
+    _pending.clear()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _schedule_flush(delay):
+    global _flush_timer
+    with _pending_lock:
+        if _flush_timer is not None and _flush_timer.is_alive():
+            return
+        _flush_timer = threading.Timer(delay, _flush_in_background)
+        _flush_timer.daemon = True
+        _flush_timer.start()
+
+def _flush_in_background():
+    global _flush_timer, _write_backoff
+    delay = WRITE_DELAY
+    try:
+        with rate_limit.background():
+            flush()
+        _write_backoff = WRITE_DELAY
+    except Exception as e:
+        # the rows stay queued, try again later (rate_limit.call already retried the 429/5xx)
+        _write_backoff = min(_write_backoff * 2, 120)
+        delay = _write_backoff
+        print(f"{WARNING} write_sheet_info: Failed to write {len(_pending)} rows, retrying in {delay}s: {e}")
+    with _pending_lock:
+        _flush_timer = None
+        again = bool(_pending) # written meanwhile, or failed
+    if again:
+        _schedule_flush(delay)
+
+def flush():
+    """
+    Send the queued cell writes to the sheet in one batch_update request. Call it when the sheet itself must show
+    the writes (read-your-writes from another place), it also runs before the sheet is read and at exit.
+    The line of every TPU is checked against COL B first (rows may have been inserted or deleted by hand since it
+    was read), a TPU no longer in the sheet is dropped.
+    If it fails (after the retries of rate_limit.call), the error is raised and the cells stay queued.
+    """
+    with _flush_lock:
+        with _pending_lock:
+            batch = dict(_pending)
+            _pending.clear()
+        if not batch:
+            return
+        try:
+            ws = get_worksheet()
+            names = [row[0].strip() if row else '' for row in rate_limit.call(ws.get, "B1:B")]
+            lines = {}
+            for alias, (info, _) in batch.items():
+                line = info['line']
+                if line > len(names) or names[line - 1] != alias:
+                    line = names.index(alias) + 1 if alias in names else None
+                lines[alias] = line
+            data = [{'range': f"{SHEET_COLUMNS[column]}{lines[alias]}", 'values': [[value]]}
+                    for alias, (_, cells) in sorted(batch.items()) if lines[alias] is not None for column, value in cells.items()]
+            if data:
+                rate_limit.call(ws.batch_update, data, value_input_option='USER_ENTERED')
+        except Exception:
+            with _pending_lock:
+                for alias, (info, cells) in batch.items():
+                    queued = _pending.get(alias)
+                    _pending[alias] = (queued[0], dict(cells, **queued[1])) if queued else (info, cells) # unless written again meanwhile
+            raise
+        moved = False
+        for alias, (info, cells) in batch.items():
+            if lines[alias] is None:
+                print(f"{WARNING} write_sheet_info: TPU {alias} is no longer in the sheet, its update {cells} is dropped")
+                moved = True
+            elif lines[alias] != info['line']:
+                print(f"{WARNING} write_sheet_info: TPU {alias} moved from line {info['line']} to {lines[alias]} in the sheet")
+                moved = True
+            else:
+                # the snapshot may have been refreshed from the sheet before the batch landed
+                _write_through(info, cells)
+                print(f"{INFO} write_sheet_info: TPU {alias} information updated in the sheet")
+        if moved:
+            # the lines of the snapshot are stale, the registry takes the new ones on its next sync
+            invalidate_sheet_cache()
+
+def sync_registry():
+    """
+    One round of the two-way sync between the local registry and the sheet: pull the sheet, merge it per column
+    into the registry, and push the rows where the registry is ahead. Return the number of rows pushed.
+    """
+    flush()
+    to_push = registry.merge(_read_sheet_info())
+    for info, columns in to_push:
+        print(f"{INFO} sync_registry: pushing {columns} of TPU {info['alias']} to the sheet")
+        write_sheet_info(info, columns=columns)
+    flush()
+    return len(to_push)
+
+def registry_sync_loop(interval = REGISTRY_SYNC_INTERVAL, stop = None):
+    """
+    The sync daemon: sync_registry every interval seconds until stop (a threading.Event) is set.
+    """
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        try:
+            with rate_limit.background():
+                sync_registry()
+        except Exception as e:
+            print(f"{WARNING} registry_sync_loop: Failed to sync the TPU registry: {e}")
+        stop.wait(interval)
 
-    # print("" + str(resp))  # Debugging output to see the response from the update
+def start_registry_sync(interval = REGISTRY_SYNC_INTERVAL):
+    """
+    Run registry_sync_loop in a daemon thread, return the Event that stops it.
+    """
+    stop = threading.Event()
+    threading.Thread(target=registry_sync_loop, args=(interval, stop), daemon=True).start()
+    return stop
 
-    # print(f"{INFO} update row {row} in the sheet with TPU information: {info_to_write}")
+def _flush_at_exit():
+    try:
+        flush()
+    except Exception as e:
+        print(f"{FAIL} write_sheet_info: Failed to write {len(_pending)} rows to the sheet: {e}")
 
-    print(f"{INFO} write_sheet_info: TPU {info_to_write['alias']} information updated in the sheet")
-    return True
+atexit.register(_flush_at_exit)
 
 def read_tpu_info_from_type(args):
     """
@@ -180,7 +455,9 @@ def find_tpu_from_type(args):
             if info.get('running_status') != '没了!'
             and (info.get('script_note') or '').lower() not in ['not found', 'preempted']
         }
-    return display_tpu_information(information, style=style)
+    result = display_tpu_information(information, style=style)
+    print(format_snapshot_age())
+    return result
 
 def get_tpu_info_sheet(tpu):
     """
@@ -334,7 +611,7 @@ def keng_tpu(args):
         print(f"{INFO} No deleted temporary TPUs found matching the criteria")
         return
     
-    print(f"{RED}Deleted Temporary TPUs{NC} (Total: {len(filtered_tpus)})")
+    print(f"{RED}Deleted Temporary TPUs{NC} (Total: {len(filtered_tpus)}) {format_snapshot_age()}")
     print(f"{'Alias':<20} {'Zone':<20} {'User':<15} {'Note':<30}")
     print("-" * 90)
     
@@ -455,17 +732,7 @@ def write_tpu_usage_to_sheet(usage_stats):
     K column: type (e.g., v6(us-central1-b))
     L column: chip count (e.g., 1024)
     """
-    secret_path = SECRET_PATH
-    sheet_id = "1MFtgLx7uzBFdiPxrIqck00ilrSslZU2w2jRwriVpKMw"
-    sheet_name = "ka[experimental]"
-    
-    # 1. authenticate
-    scopes = ["https://www.googleapis.com/auth/spreadsheets"]
-    creds = Credentials.from_service_account_file(secret_path, scopes=scopes)
-    client = gspread.authorize(creds)
-    
-    # 2. open the sheet
-    ws = client.open_by_key(sheet_id).worksheet(sheet_name)
+    ws = get_worksheet()
     
     # 3. Prepare data - sort by type name for consistency
     sorted_stats = sorted(usage_stats.items())
@@ -473,13 +740,13 @@ def write_tpu_usage_to_sheet(usage_stats):
     # 4. Clear existing data in K and L columns from row 6 onwards
     # First, find how many rows to clear (use a reasonable number, e.g., 100)
     max_rows = max(100, len(sorted_stats) + 10)
-    ws.batch_clear([f"K6:L{max_rows}"])
+    rate_limit.call(ws.batch_clear, [f"K6:L{max_rows}"])
     
     # 5. Write new data starting from row 6
     if sorted_stats:
         data_to_write = [[key, str(value)] for key, value in sorted_stats]
         print(f"data_to_write: {data_to_write}")
-        ws.update(f"K6:L{5 + len(data_to_write)}", data_to_write, value_input_option='USER_ENTERED')
+        rate_limit.call(ws.update, f"K6:L{5 + len(data_to_write)}", data_to_write, value_input_option='USER_ENTERED')
         print(f"{INFO} write_tpu_usage_to_sheet: Updated {len(sorted_stats)} TPU usage statistics in K and L columns")
     else:
         print(f"{WARNING} write_tpu_usage_to_sheet: No TPU usage statistics to write")
@@ -497,23 +764,14 @@ def read_tpu_total_counts_from_sheet():
     import re
     from .data_io import read_data
     
-    secret_path = SECRET_PATH
-    sheet_id = "1MFtgLx7uzBFdiPxrIqck00ilrSslZU2w2jRwriVpKMw"
-    sheet_name = "ka[experimental]"
-    
-    # 1. authenticate
-    scopes = ["https://www.googleapis.com/auth/spreadsheets.readonly"]
-    creds = Credentials.from_service_account_file(secret_path, scopes=scopes)
-    client = gspread.authorize(creds)
-    
-    # 2. open the sheet
-    ws = client.open_by_key(sheet_id).worksheet(sheet_name)
+    ws = get_worksheet()
     
     # 3. Read K and L columns from row 6 onwards
-    # Read up to row 200 to be safe
+    # Read up to row 200 to be safe, both columns in one request
     max_row = 200
-    k_col_values = ws.col_values(11)  # Column K is index 11 (1-based)
-    l_col_values = ws.col_values(12)  # Column L is index 12 (1-based)
+    rows = rate_limit.call(ws.get, f"K1:L{max_row}")
+    k_col_values = [row[0] if len(row) > 0 else '' for row in rows]
+    l_col_values = [row[1] if len(row) > 1 else '' for row in rows]
     
     counts = {}  # {version: {zone: total_cards}}
     
@@ -0,0 +1,239 @@
+import os, json, time, signal, statistics, subprocess
+from .constants import *
+from .data_io import read_data, read_queue, read_and_lock_queue, write_and_unlock_queue, release_lock_queue, _atomic_write_json
+
+# data.json "queue_config" (all optional):
+#   staging_workers: stagings (just_staging.sh) running at once on the machine (default 4)
+#   staging_retries: times a failed staging is retried (default 2)
+#   staging_timeout: seconds after which a staging is killed and counted as failed (default 1800)
+DEFAULT_CONFIG = {'staging_workers': 4, 'staging_retries': 2, 'staging_timeout': 1800}
+RETRY_DELAY = 60          # seconds before the first retry, doubled for each next one
+MAX_STATS = 500           # finished stagings kept in STAGING_STATS_PATH
+
+_procs = {}               # pid -> Popen, the stagings started by this process (polled to reap them)
+
+
+def config(data=None):
+    data = read_data() if data is None else data
+    queue_config = data.get('queue_config', {})
+    return {key: queue_config.get(key, value) for key, value in DEFAULT_CONFIG.items()}
+
+
+def new_state():
+    """
+    The staging state of a new task (other_info.staging); the tasks queued before the executor have none and are left alone.
+    """
+    return {'state': 'pending', 'attempts': 0, 'queued': time.time()}
+
+
+def _proc_start(pid):
+    """
+    (start time in clock ticks since boot, state) of a process, from /proc/<pid>/stat; None if there is no such process.
+    """
+    try:
+        with open(f"/proc/{pid}/stat", 'r') as file:
+            fields = file.read().rsplit(')', 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    return int(fields[19]), fields[0]
+
+
+def _alive(staging):
+    """
+    Whether the staging process of a task still runs. Its pid may have been reused after it exited, or it may be
+    an unreaped zombie of the process that started it, so its start time and state are checked too.
+    """
+    pid = staging['pid']
+    if pid in _procs:
+        if _procs[pid].poll() is None:
+            return True
+        del _procs[pid]
+        return False
+    stat = _proc_start(pid)
+    return stat is not None and stat[1] != 'Z' and stat[0] == staging.get('pid_start', stat[0])
+
+
+def _start(task_dict):
+    task_id = task_dict['other_info']['task_id']
+    dir_path = task_dict.get('job', {}).get('job_dir')
+    os.makedirs(STAGING_LOG_DIR, exist_ok=True)
+    with open(os.path.join(STAGING_LOG_DIR, f"{task_id}.log"), 'a') as log:
+        # an interactive shell, so that ~/.bashrc (the tpu alias for upd-staging-info) is loaded as in the
+        # tmux window the staging used to run in; there is no terminal and no tmux session though
+        proc = subprocess.Popen(
+            ['bash', '-ic', f'source just_staging.sh {task_id}'],
+            cwd=dir_path, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+            start_new_session=True, # its own process group, killed as a whole on timeout
+        )
+    _procs[proc.pid] = proc
+    return proc.pid
+
+
+def _kill(pid):
+    try:
+        os.killpg(pid, signal.SIGTERM)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _record(stats_entry, stats=None):
+    # called with the queue lock held
+    try:
+        stats = read_stats() if stats is None else stats
+        stats.append(stats_entry)
+        _atomic_write_json(STAGING_STATS_PATH, stats[-MAX_STATS:])
+    except OSError as e:
+        print(f"{WARNING} staging: failed to record the staging of task {stats_entry.get('task_id')}: {e}")
+
+
+def read_stats():
+    try:
+        with open(STAGING_STATS_PATH, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return []
+
+
+def _finished(task_dict, staging, ok, now):
+    _record({
+        'task_id': task_dict['other_info']['task_id'], 'user': task_dict.get('user'), 'ok': ok,
+        'queued': staging.get('queued'), 'started': staging.get('started'), 'finished': now,
+        'attempts': staging.get('attempts', 0),
+    })
+
+
+def pump(cfg=None, quiet=True):
+    """
+    Reap the stagings that ended (done if upd_staging_info set the stage dir, else failed and retried after a backoff)
+    or timed out, then start the pending ones in queue order while fewer than staging_workers run.
+    Cheap, called by Queue, by upd_staging_info when a staging completes, and by MONITOR on every loop.
+    Return the number of stagings started.
+    """
+    cfg = config() if cfg is None else cfg
+    now = time.time()
+    started = 0
+    changed = False
+    queue = read_and_lock_queue()
+    try:
+        running = 0
+        for task_dict in queue:
+            staging = (task_dict.get('other_info') or {}).get('staging')
+            if staging is None or staging['state'] != 'running':
+                continue
+            if _alive(staging) and now - staging['started'] < cfg['staging_timeout']:
+                running += 1
+                continue
+            if _alive(staging):
+                _kill(staging['pid'])
+                staging['error'] = f"timed out after {cfg['staging_timeout']}s"
+            else:
+                staging['error'] = 'exited before upd-staging-info'
+            changed = True
+            if staging['attempts'] <= cfg['staging_retries']:
+                staging['state'] = 'pending'
+                staging['retry_at'] = now + RETRY_DELAY * 2 ** (staging['attempts'] - 1)
+                print(f"{WARNING} staging: task {task_dict['other_info']['task_id']} {staging['error']}, retry {staging['attempts']}/{cfg['staging_retries']}")
+            else:
+                staging['state'] = 'failed'
+                _finished(task_dict, staging, False, now)
+                print(f"{FAIL} staging: task {task_dict['other_info']['task_id']} {staging['error']}, giving up after {staging['attempts']} attempts")
+
+        for task_dict in queue:
+            if running >= cfg['staging_workers']:
+                break
+            staging = (task_dict.get('other_info') or {}).get('staging')
+            if staging is None or staging['state'] != 'pending' or staging.get('retry_at', 0) > now:
+                continue
+            try:
+                staging['pid'] = _start(task_dict)
+                staging['pid_start'] = (_proc_start(staging['pid']) or (None,))[0]
+            except OSError as e:
+                staging['state'] = 'failed'
+                staging['error'] = str(e)
+                _finished(task_dict, staging, False, now)
+                print(f"{FAIL} staging: failed to start the staging of task {task_dict['other_info']['task_id']}: {e}")
+                changed = True
+                continue
+            staging['state'] = 'running'
+            staging['started'] = now
+            staging['attempts'] += 1
+            running += 1
+            started += 1
+            changed = True
+            if not quiet:
+                print(f"{INFO} staging: started the staging of task {task_dict['other_info']['task_id']} (attempt {staging['attempts']})")
+
+    except Exception as e:
+        print(f"{FAIL} staging: error {e}")
+    # the lock is an ownerless flag, only clear it once (keep the states of the stagings started before an error)
+    try:
+        if changed:
+            write_and_unlock_queue(queue)
+            return started
+    except Exception as e:
+        print(f"{FAIL} staging: failed to write the queue: {e}")
+    release_lock_queue()
+    return started
+
+
+def mark_done(task_dict):
+    """
+    Called by upd_staging_info (with the queue lock held) when the staging of task_dict completed.
+    """
+    staging = (task_dict.get('other_info') or {}).get('staging')
+    if staging is None or staging['state'] == 'done':
+        return
+    staging['state'] = 'done'
+    staging['finished'] = time.time()
+    staging.pop('pid', None)
+    staging.pop('pid_start', None)
+    _finished(task_dict, staging, True, staging['finished'])
+
+
+def cancel(task_dict):
+    """
+    Kill the staging of a task removed from the queue.
+    """
+    staging = (task_dict.get('other_info') or {}).get('staging')
+    if staging is not None and staging['state'] == 'running' and _alive(staging):
+        _kill(staging['pid'])
+
+
+def describe(task_dict, now=None):
+    """
+    Short staging state of a task for visualize_queue.
+    """
+    staging = (task_dict.get('other_info') or {}).get('staging')
+    if staging is None:
+        return 'done' if (task_dict.get('job_info') or {}).get('stage_dir') else '-'
+    now = time.time() if now is None else now
+    if staging['state'] == 'running':
+        return f"running {int(now - staging['started']) // 60}m (try {staging['attempts']})"
+    if staging['state'] == 'pending' and staging.get('attempts'):
+        return f"retry in {max(0, int(staging['retry_at'] - now))}s"
+    return staging['state']
+
+
+def report(hours=24):
+    """
+    Print the staging throughput of the queue over the last hours, and the current state.
+    """
+    now = time.time()
+    recent = [entry for entry in read_stats() if entry.get('finished', 0) >= now - hours * 3600]
+    ok = [entry for entry in recent if entry['ok']]
+    states = {}
+    for task_dict in read_queue():
+        staging = (task_dict.get('other_info') or {}).get('staging')
+        if staging is not None:
+            states[staging['state']] = states.get(staging['state'], 0) + 1
+    cfg = config()
+    print(f"{INFO} staging: {states.get('running', 0)}/{cfg['staging_workers']} running, {states.get('pending', 0)} pending, "
+          f"{states.get('failed', 0)} failed in the queue")
+    print(f"{INFO} staging: last {hours}h: {len(ok)} staged ({len(ok) / hours:.2f}/h), {len(recent) - len(ok)} given up, "
+          f"{sum(max(0, entry['attempts'] - 1) for entry in recent)} retries")
+    if ok:
+        durations = [entry['finished'] - entry['started'] for entry in ok if entry.get('started')]
+        waits = [entry['started'] - entry['queued'] for entry in ok if entry.get('started') and entry.get('queued')]
+        if durations:
+            print(f"{INFO} staging: median staging time {statistics.median(durations) / 60:.1f}m, "
+                  f"median wait for a worker {statistics.median(waits) / 60 if waits else 0:.1f}m")
@@ -0,0 +1,127 @@
+import subprocess, threading, time
+from typing import NamedTuple
+from .constants import *
+
+CAPTURE_TTL = 2.0          # seconds a capture is reused for the same window
+MIN_CAPTURE_LINES = 200    # the pane tail is also searched for the error kind, keep some context
+MAX_CAPTURE_LINES = 50000
+
+_cache = {}                # (session, window) -> (time, lines asked, complete, text, window_activity)
+_cache_lock = threading.Lock()
+
+
+def _capture(target, lines):
+    cmd = ["tmux", "capture-pane", "-p", "-t", target, "-S", "-" if lines is None else f"-{lines}"]
+    try:
+        out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return ""
+    if out.returncode != 0:
+        return ""
+    return out.stdout.decode(errors='replace').rstrip()
+
+
+def capture_pane(session, window, chars=None, lines=None, ttl=CAPTURE_TTL, activity=None):
+    """
+    Return the tail of a tmux pane with at least the last lines lines and the last chars characters
+    (as far as the history goes), callers cut it to what they show. Only the needed lines are asked from
+    tmux (capture-pane -S -K), K is doubled until chars is reached or the history is exhausted. With neither
+    chars nor lines the whole history is captured. Captures are cached per (session, window) for ttl seconds,
+    so the web table, the monitor and the log view share them. If activity (window_activity from
+    list_all_windows) is given, a capture taken after that activity is reused however old it is.
+    """
+    key = (str(session), str(window))
+    if chars is None and lines is None:
+        want = None
+    else:
+        want = max(lines or 0, MIN_CAPTURE_LINES, (chars or 0) // 80 + 1)
+
+    now = time.time()
+    with _cache_lock:
+        cached = _cache.get(key)
+    if cached is not None:
+        taken, got, complete, text, _ = cached
+        # window_activity has a resolution of one second, a capture within that second may miss output
+        unchanged = activity is not None and taken >= activity + 1
+        if (now - taken < ttl or unchanged) and (
+                complete or (want is not None and got >= want and (chars is None or len(text) >= chars))):
+            return text
+
+    target = f"{session}:{window}"
+    taken = time.time()
+    if want is None:
+        text, complete = _capture(target, None), True
+    else:
+        while True:
+            text = _capture(target, want)
+            # fewer lines than asked (history plus the visible screen) means the history is exhausted
+            complete = text.count("\n") + 1 < want
+            if complete or chars is None or len(text) >= chars or want >= MAX_CAPTURE_LINES:
+                break
+            want = min(want * 2, MAX_CAPTURE_LINES)
+    with _cache_lock:
+        _cache[key] = (taken, want or 0, complete, text, activity)
+    return text
+
+
+def invalidate(session=None, window=None):
+    """
+    Drop the cached captures (of one window, one session or all).
+    """
+    with _cache_lock:
+        for key in list(_cache):
+            if (session is None or key[0] == str(session)) and (window is None or key[1] == str(window)):
+                del _cache[key]
+
+
+class Window(NamedTuple):
+    session: str
+    index: str
+    name: str
+    pane_pid: int
+    activity: int      # unix time of the last output in the window
+    dead: bool         # the pane's process has exited (remain-on-exit)
+
+
+LIST_FORMAT = "\t".join(["#{session_name}", "#{window_index}", "#{window_name}", "#{pane_pid}",
+                         "#{window_activity}", "#{pane_dead}"])
+_inventory = (0.0, [])
+
+
+def list_all_windows(ttl=CAPTURE_TTL):
+    """
+    All the windows of all the tmux sessions, from a single `tmux list-windows -a -F` call (cached for ttl seconds).
+    """
+    global _inventory
+    if time.time() - _inventory[0] < ttl:
+        return _inventory[1]
+    try:
+        out = subprocess.run(["tmux", "list-windows", "-a", "-F", LIST_FORMAT],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=10)
+        lines = out.stdout.decode(errors='replace').splitlines() if out.returncode == 0 else []
+    except (OSError, subprocess.TimeoutExpired):
+        lines = []
+    windows = []
+    for line in lines:
+        parts = line.split("\t")
+        if len(parts) != 6:
+            continue
+        session, index, name, pid, activity, dead = parts
+        windows.append(Window(session, index, name, int(pid) if pid.isdigit() else 0,
+                              int(activity) if activity.isdigit() else 0, dead == '1'))
+    _inventory = (time.time(), windows)
+    return windows
+
+
+def windows_of(session):
+    """
+    The windows of one session, see list_all_windows.
+    """
+    return [w for w in list_all_windows() if w.session == str(session)]
+
+
+def job_index(job_data):
+    """
+    Index a user's job_data by window id (as str).
+    """
+    return {str(job.get('windows_id')): job for job in job_data}
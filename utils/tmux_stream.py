@@ -0,0 +1,174 @@
+import re, codecs, subprocess, threading
+from .constants import *
+from . import tmux
+
+TAIL_CHARS = 65536         # characters of output kept per window
+OCTAL_RE = re.compile(rb'\\([0-7]{3})')
+OSC_RE = re.compile(r'\x1B\][^\x07\x1B]*(?:\x07|\x1B\\)')
+
+
+def unescape_output(data):
+    """
+    Undo the escaping of %output lines: characters below 32 and backslashes are sent as \\ooo octal.
+    """
+    return OCTAL_RE.sub(lambda m: bytes([int(m.group(1), 8)]), data)
+
+
+def clean_text(text):
+    """
+    Turn raw terminal output into pane-like text: drop escape sequences and carriage returns.
+    """
+    text = OSC_RE.sub('', ANSI_RE.sub('', text))
+    text = text.replace('\r\n', '\n')
+    # a bare \r redraws the line (progress bars), keep what was drawn last
+    if '\r' in text:
+        text = '\n'.join(line.rsplit('\r', 1)[-1] for line in text.split('\n'))
+    return text
+
+
+class SessionStream:
+    """
+    A `tmux -C` control-mode client attached (read-only, ignoring its size) to one session.
+    It keeps the last TAIL_CHARS characters of output of every window, seeded with a capture-pane.
+    """
+    def __init__(self, session, on_output=None):
+        self.session = str(session)
+        self.on_output = on_output
+        self.tails = {}            # window index -> str
+        self.pane_window = {}      # pane id (%N) -> window index
+        self.decoders = {}         # pane id -> incremental utf-8 decoder
+        self.lock = threading.Lock()
+        self.proc = None
+        self.alive = False
+
+    def start(self):
+        try:
+            self.proc = subprocess.Popen(
+                ["tmux", "-C", "attach-session", "-t", self.session, "-f", "read-only,ignore-size"],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            )
+        except OSError as e:
+            print(f"{WARNING} SessionStream: Failed to start tmux control mode for {self.session}: {e}")
+            return False
+        self.alive = True
+        self._refresh_panes()
+        for window in tmux.windows_of(self.session):
+            self.tails[window.index] = tmux.capture_pane(self.session, window.index, chars=TAIL_CHARS)[-TAIL_CHARS:]
+        threading.Thread(target=self._read, daemon=True).start()
+        return True
+
+    def close(self):
+        self.alive = False
+        if self.proc is not None and self.proc.poll() is None:
+            try:
+                self.proc.stdin.close() # detaches the control client
+                self.proc.wait(timeout=2)
+            except (OSError, subprocess.TimeoutExpired):
+                self.proc.kill()
+
+    def _refresh_panes(self):
+        try:
+            out = subprocess.run(["tmux", "list-panes", "-s", "-t", self.session, "-F", "#{pane_id}\t#{window_index}"],
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            return
+        mapping = {}
+        for line in out.stdout.decode(errors='replace').splitlines():
+            parts = line.split('\t')
+            if len(parts) == 2:
+                mapping[parts[0]] = parts[1]
+        with self.lock:
+            self.pane_window = mapping
+            # windows that were closed, their index may be reused by a new job
+            for window in list(self.tails):
+                if window not in mapping.values():
+                    del self.tails[window]
+
+    def _read(self):
+        for line in self.proc.stdout:
+            if line.startswith(b'%output '):
+                _, pane, data = (line.rstrip(b'\n').split(b' ', 2) + [b''])[:3]
+                self._append(pane.decode(), unescape_output(data))
+            elif line.startswith((b'%window-add', b'%window-close', b'%unlinked-window', b'%layout-change')):
+                self._refresh_panes()
+            elif line.startswith(b'%exit'):
+                break
+        self.alive = False
+
+    def _append(self, pane, data):
+        with self.lock:
+            window = self.pane_window.get(pane)
+        if window is None:
+            self._refresh_panes()
+            with self.lock:
+                window = self.pane_window.get(pane)
+            if window is None:
+                return
+        decoder = self.decoders.setdefault(pane, codecs.getincrementaldecoder('utf-8')(errors='replace'))
+        text = clean_text(decoder.decode(data))
+        with self.lock:
+            tail = self.tails.get(window, '') + text
+            self.tails[window] = tail[-TAIL_CHARS:]
+        if self.on_output is not None:
+            self.on_output(self.session, window)
+
+    def tail(self, window):
+        with self.lock:
+            return self.tails.get(str(window))
+
+
+class StreamHub:
+    """
+    The control-mode clients of a process (the CLI monitor or the web UI), one per tmux session.
+    changed is set whenever a watched window prints something.
+    """
+    def __init__(self):
+        self.streams = {}
+        self.lock = threading.Lock()
+        self.changed = threading.Event()
+
+    def watch(self, session):
+        with self.lock:
+            stream = self.streams.get(str(session))
+            if stream is not None and stream.alive:
+                return stream
+            stream = SessionStream(session, on_output=lambda s, w: self.changed.set())
+            if not stream.start():
+                return None
+            self.streams[str(session)] = stream
+            return stream
+
+    def tail(self, session, window):
+        with self.lock:
+            stream = self.streams.get(str(session))
+        if stream is None or not stream.alive:
+            return None
+        return stream.tail(window)
+
+    def wait(self, timeout):
+        """
+        Wait for at most timeout seconds for new output in a watched session, return True if there was some.
+        """
+        changed = self.changed.wait(timeout)
+        self.changed.clear()
+        return changed
+
+    def close(self):
+        with self.lock:
+            for stream in self.streams.values():
+                stream.close()
+            self.streams = {}
+
+
+HUB = StreamHub()
+
+
+def pane_tail(session, window, chars=None, activity=None):
+    """
+    The tail of a window: from the control-mode stream if its session is watched by HUB and the stream
+    holds enough, otherwise from tmux.capture_pane.
+    """
+    text = HUB.tail(session, window)
+    if text is not None and (chars is not None and chars <= TAIL_CHARS):
+        return text
+    return tmux.capture_pane(session, window, chars=chars, activity=activity)
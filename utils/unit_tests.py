@@ -1,10 +1,12 @@
-import os, sys
+import os, sys, time, datetime, tempfile
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from utils import operate, data_io
 from utils import directories as dirs
 from utils.sheet import read_sheet_info, write_sheet_info
 from utils.helpers import *
 from .constants import *
+from .classifier import classify
+from . import queue_policy, runtime, queue, claims, progress, staging
 
 def test_get_zone_pre(quiet = False):
     try:
@@ -156,12 +158,318 @@ def test_write_sheet_info(tpu):
         tpu_info['running_status'] = 'reserved'
         tpu_info['user'] = 'jzc'
         tpu_info['user_note'] = 'test'
-        write_sheet_info(tpu_info)
+        write_sheet_info(tpu_info, sync=True)
     else:
         print(f"{FAIL} TPU {tpu} not found in the sheet")
         return None
     return tpu_information[full_name]
 
+# (pane text, cut, expected (state, epoch, error)) for the status classifier
+CLASSIFIER_CORPUS = [
+    ("step 10 loss 2.3\nEpoch 12 train loss 1.2", 800, ('running', '12', None)),
+    ("ep=3.250000, loss=0.1", 800, ('running', '3.250000', None)),
+    ("ep = 7, lr=0.1", 800, ('running', '7', None)),
+    ("Sampling epoch 4 images", 800, ('sampling', '4', None)),
+    ("Sampling  ep=4.5", 800, ('sampling', '4.5', None)),
+    ("Compiling the train step...", 800, ('compiling', None, None)),
+    ("jax compilation cache miss\nEpoch 3", 800, ('compiling', None, None)),
+    ("Initializing model", 800, ('initializing', None, None)),
+    ("Staging files to /kmh-nfs", 800, ('staging', None, None)),
+    ("nothing interesting here", 800, ('unknown', None, None)),
+    ("Epoch 5\njax.errors.JaxRuntimeError: GRPC error happened", 800, ('error', None, 'grpc')),
+    ("Allocation type: HBM\nRESOURCE_EXHAUSTED\nJob failed", 800, ('error', None, 'OOM')),
+    ("bash: python: No such file or directory\nJob failed", 800, ('error', None, 'file error')),
+    ("DEADLINE_EXCEEDED: timed out\nFAIL", 800, ('error', None, 'deadline exceeded')),
+    ("ValueError: bad config", 800, ('error', None, 'unknown')),
+    # harmless messages are ignored
+    ("AttributeError: 'MessageFactory' object has no attribute 'GetPrototype'\nEpoch 2", 800, ('running', '2', None)),
+    ("ERROR: pip's dependency resolver\nStaging", 800, ('staging', None, None)),
+    # the state only looks at the cut, the error kind at the whole text
+    ("RuntimeError: old\n" + "x" * 900 + "\nEpoch 9", 800, ('running', '9', None)),
+    ("GRPC Error long ago\n" + "x" * 900 + "\nJob failed", 800, ('error', None, 'grpc')),
+]
+
+def test_classifier(quiet = False):
+    """
+    Regression test of utils/classifier.py on CLASSIFIER_CORPUS.
+    """
+    try:
+        for i, (text, cut, expected) in enumerate(CLASSIFIER_CORPUS):
+            result = classify(text, cut=cut)
+            got = (result.state, result.epoch, result.error)
+            assert got == expected, f"T{i}, Expected {expected}, got {got} for {text[-80:]!r}"
+            if result.span is not None:
+                start, end = result.span
+                assert 0 <= start < end <= len(text), f"T{i}, bad span {result.span}"
+        # the cause scrolled out of the captured tail, it is found in the pane history
+        result = classify("x" * 900 + "\nJob failed", cut=800, history=lambda: "Allocation type\n" + "x" * 900 + "\nJob failed")
+        assert (result.state, result.error) == ('error', 'OOM'), f"history, got {result}"
+        result = classify("x" * 900 + "\nJob failed", cut=800, history=lambda: "python: No such file or directory\n",
+                          history_kinds=['OOM', 'grpc'])
+        assert (result.state, result.error) == ('error', 'unknown'), f"history_kinds, got {result}"
+        if not quiet:
+            print(f"{GREEN}[PASSED]{NC} test_classifier")
+        return True
+    except Exception as e:
+        print(f"{RED}[FAILED]{NC} test_classifier")
+        print(e)
+        return False
+
+def test_queue_policy(quiet = False):
+    """
+    Usage window, fair-share scores, weights and caps of utils/queue_policy.py on a fixed data.json.
+    """
+    try:
+        now = queue_policy.parse_time("2026-01-02 00:00:00")
+        jobs = [
+            # running for 12h on a v4-32: 12 * 32 chip-hours
+            {"user": "A", "tpu": "kmh-tpuvm-v4-32-1", "status": "running", "start_time": {"utc": "2026-01-01 12:00:00"}},
+            # 6h on a v4-8, of which the last 2h are in the 24h window
+            {"user": "B", "tpu": "kmh-tpuvm-v4-8-1", "status": "finished", "start_time": {"utc": "2025-12-31 20:00:00"},
+             "extra_msgs": {"finish_time_abs": "2026-01-01 02:00:00"}},
+            # failed before the window
+            {"user": "B", "tpu": "kmh-tpuvm-v4-8-1", "status": "error", "start_time": {"utc": "2025-12-30 00:00:00"},
+             "extra_msgs": {"fail_time_abs": "2025-12-30 05:00:00"}},
+        ]
+        usage = queue_policy.usage_by_user(jobs, now, 24)
+        assert usage == {"A": 384, "B": 16}, f"T1, Expected usage {{'A': 384, 'B': 16}}, got {usage}"
+
+        data = {"users": {user: {"job_data": [job for job in jobs if job["user"] == user]} for user in ("A", "B")}}
+        queue = [{"user": user, "priority_info": {"priority": prio}, "other_info": {"queue_time": "CHN: 2026-01-02 08:00:00"}}
+                 for user, prio in (("A", 0), ("A", 1), ("B", 0))]
+        config = {"aging_hours": 0, "max_running_user": {"A": 1}}
+        policy = queue_policy.FairSharePolicy(data, config, now, legacy=[])
+        scores = policy.scores(queue)
+        # A: 384 / 256 = 1.5 points of usage, plus one per task of A ahead in the queue
+        expected = {0: -1.5, 1: 1 - 2.5, 2: -16 / 256}
+        assert all(abs(scores[i] - expected[i]) < 1e-9 for i in expected), f"T2, Expected scores {expected}, got {scores}"
+        assert policy.order(queue) == [2, 0, 1], f"T3, Expected order [2, 0, 1], got {policy.order(queue)}"
+        # a weight divides the share
+        policy = queue_policy.FairSharePolicy(data, dict(config, weights={"A": 4}), now, legacy=[])
+        assert policy.order(queue) == [1, 2, 0], f"T4, Expected order [1, 2, 0] with weight 4 for A, got {policy.order(queue)}"
+        # A is at its cap of 1 running job, B has no cap
+        assert not policy.admit("A") and policy.admit("B"), f"T5, Expected A capped and B admitted"
+        policy.took("B")
+        assert policy.running["B"] == 1 and policy.admit("B"), f"T6, Expected B admitted after took, got {policy.running}"
+        # fifo: priority, then position
+        fifo = queue_policy.FifoPolicy(data, config, now)
+        assert fifo.order(queue) == [1, 0, 2], f"T7, Expected fifo order [1, 0, 2], got {fifo.order(queue)}"
+        if not quiet:
+            print(f"{GREEN}[PASSED]{NC} test_queue_policy")
+        return True
+    except Exception as e:
+        print(f"{RED}[FAILED]{NC} test_queue_policy")
+        print(e)
+        return False
+
+def _finished_job(job_dir, tags, hours, ago, configs = None):
+    # a job of job_dir finished ago hours ago after running for hours hours
+    now = datetime.datetime.now()
+    return {"status": "finished", "job_dir": job_dir, "job_tags": tags, "extra_configs": configs,
+            "start_time": {"utc": (now - datetime.timedelta(hours=ago + hours)).strftime(queue_policy.TIME_FMT)},
+            "extra_msgs": {"finish_time_abs": (now - datetime.timedelta(hours=ago)).strftime(queue_policy.TIME_FMT)}}
+
+def test_runtime_estimator(quiet = False):
+    """
+    Fallback of the runtime estimates of utils/runtime.py: same configs, then tags, then job dir, then tags alone.
+    """
+    try:
+        estimator = runtime.Estimator([
+            _finished_job("d1", "t1", 2, 10, configs = "--config.lr=1 --config.bs=8"),
+            _finished_job("d1", "t1", 4, 10, configs = "--config.lr=2"),
+            _finished_job("d1", "t2", 9, 10),
+            _finished_job("d2", "t3", 10, 10),
+        ])
+        cases = [
+            # the configs are compared as a set of options
+            ({"job_dir": "d1", "job_tags": "t1", "extra_configs": "--config.bs=8 --config.lr=1"}, (2, "config")),
+            ({"job_dir": "d1", "job_tags": "t1", "extra_configs": "--config.lr=3"}, (3, "tags")),
+            ({"job_dir": "d1", "extra_configs": "--config.lr=3"}, (4, "dir")),
+            ({"job_dir": "d9", "job_tags": "t3"}, (10, "tag")),
+            ({"job_dir": "d9", "job_tags": "t9"}, (None, None)),
+        ]
+        for i, (job, expected) in enumerate(cases):
+            got = estimator.estimate(job)
+            assert got == expected, f"T{i}, Expected {expected}, got {got} for {job}"
+        running = {"job_dir": "d2", "start_time": {"utc": (datetime.datetime.now() - datetime.timedelta(hours=4)).strftime(queue_policy.TIME_FMT)}}
+        left = estimator.remaining(running)
+        assert abs(left - 6) < 0.1, f"T5, Expected about 6 hours left, got {left}"
+        running["start_time"]["utc"] = (datetime.datetime.now() - datetime.timedelta(hours=12)).strftime(queue_policy.TIME_FMT)
+        assert estimator.remaining(running) == 0, f"T6, Expected 0 hours left for an overrun job, got {estimator.remaining(running)}"
+        if not quiet:
+            print(f"{GREEN}[PASSED]{NC} test_runtime_estimator")
+        return True
+    except Exception as e:
+        print(f"{RED}[FAILED]{NC} test_runtime_estimator")
+        print(e)
+        return False
+
+def test_backfill(quiet = False):
+    """
+    queue._assign with a blocked head task: only the TPU it will get is reserved, and only a task estimated to
+    finish before the head can start may take it.
+    """
+    def task(task_id, user, job_dir, valid, prio):
+        return {"user": user, "job": {"user": user, "job_dir": job_dir, "job_tags": job_dir, "stage_dir": "/stage"},
+                "tpu_info": {"valid_tpu": valid}, "priority_info": {"permission": "11", "priority": prio},
+                "job_info": {"stage_dir": "/stage"}, "other_info": {"task_id": task_id}}
+    def assign(queue_list, free, data, estimator):
+        result = queue._assign(queue_list, {tpu: {"user": "free"} for tpu in free}, data, estimator=estimator)
+        return [(t.other_info["task_id"], tpu) for t, tpu in result]
+
+    try:
+        estimator = runtime.Estimator([_finished_job("dA", "dA", 1, 10), _finished_job("dL", "dL", 48, 10), _finished_job("dS", "dS", 0.2, 10)])
+        started = (datetime.datetime.now() - datetime.timedelta(hours=0.5)).strftime(queue_policy.TIME_FMT)
+        data = {"users": {user: {"spreadsheet_name": user, "job_data": []} for user in ("A", "B", "C")},
+                "queue_config": {"policy": "fifo", "max_running": 1}}
+        # A runs a job with about 0.5h left elsewhere and is at its cap
+        data["users"]["A"]["job_data"].append({"user": "A", "tpu": "P", "status": "running", "job_dir": "dA", "job_tags": "dA", "start_time": {"utc": started}})
+        queue_list = [task(1, "A", "dA", ["X"], 5), task(2, "B", "dL", ["X"], 3), task(3, "C", "dS", ["X"], 1)]
+        got = assign(queue_list, ["X"], data, estimator)
+        assert got == [(3, "X")], f"T1, Expected only the short task 3 backfilled on X, got {got}"
+        data["queue_config"]["max_running"] = 0
+        got = assign(queue_list, ["X"], data, estimator)
+        assert got == [(1, "X")], f"T2, Expected the head task 1 on X without cap, got {got}"
+        # the capped head reserves one of its two free TPUs, a task without an estimate takes the other one
+        data["queue_config"]["max_running"] = 1
+        queue_list = [task(1, "A", "dA", ["X", "Y"], 5), task(2, "B", "dNone", ["X", "Y"], 3)]
+        got = assign(queue_list, ["X", "Y"], data, estimator)
+        assert got == [(2, "Y")], f"T3, Expected task 2 on the unreserved TPU Y, got {got}"
+        if not quiet:
+            print(f"{GREEN}[PASSED]{NC} test_backfill")
+        return True
+    except Exception as e:
+        print(f"{RED}[FAILED]{NC} test_backfill")
+        print(e)
+        return False
+
+def test_claims(quiet = False):
+    """
+    TPU claims of utils/claims.py, on a temporary claims file: one claim per TPU until it expires,
+    also within one process, and only the token of the claim releases it.
+    """
+    path = claims.CLAIMS_PATH
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            claims.CLAIMS_PATH = os.path.join(tmp, "claims.json")
+            token = claims.claim("X")
+            assert token is not None, "T1, Expected the first claim of X to succeed"
+            assert claims.claim("X") is None, "T2, Expected a second claim of X in the same process to be refused"
+            claims.release("X", "not-the-token")
+            assert "X" in claims.claimed(), "T3, Expected a release with another token to keep the claim"
+            claims.release("X", token)
+            assert "X" not in claims.claimed(), "T4, Expected the release with the token to drop the claim"
+            token = claims.claim("Y", ttl=0.2)
+            assert token is not None and claims.claim("Z") is not None, "T5, Expected claims of different TPUs to succeed"
+            time.sleep(0.3)
+            assert sorted(claims.claimed()) == ["Z"], f"T6, Expected the claim of Y to expire, got {sorted(claims.claimed())}"
+            assert claims.claim("Y") not in (None, token), "T7, Expected a new claim with a new token once the old one expired"
+        if not quiet:
+            print(f"{GREEN}[PASSED]{NC} test_claims")
+        return True
+    except Exception as e:
+        print(f"{RED}[FAILED]{NC} test_claims")
+        print(e)
+        return False
+    finally:
+        claims.CLAIMS_PATH = path
+
+def test_progress(quiet = False):
+    """
+    Stall detection of utils/progress.py, on a temporary samples dir: a job with fractional epochs is stalled
+    after stall_minutes, a job with integer epochs of 50 minutes only after twice its epoch time.
+    """
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            store = progress.ProgressStore(tmp)
+            for i in range(10):
+                store.record("frac", i / 100, ts=1000 + 60 * i)
+                store.record("int", i, ts=1000 + 3000 * i)
+            last = 1000 + 60 * 9
+            assert not store.summary("frac", now=last + 20 * 60)['stalled'], "T1, Expected a fractional-epoch job idle for 20m not to be stalled"
+            assert store.summary("frac", now=last + 31 * 60)['stalled'], "T2, Expected a fractional-epoch job idle for 31m to be stalled"
+            last = 1000 + 3000 * 9
+            summary = store.summary("int", now=last + 40 * 60)
+            assert summary['epoch'] == 9 and not summary['stalled'], f"T3, Expected an integer-epoch job within its epoch not to be stalled, got {summary}"
+            assert not store.summary("int", now=last + 90 * 60)['stalled'], "T4, Expected an integer-epoch job idle for 90m not to be stalled"
+            assert store.summary("int", now=last + 101 * 60)['stalled'], "T5, Expected an integer-epoch job idle for twice its epoch time to be stalled"
+        if not quiet:
+            print(f"{GREEN}[PASSED]{NC} test_progress")
+        return True
+    except Exception as e:
+        print(f"{RED}[FAILED]{NC} test_progress")
+        print(e)
+        return False
+
+def test_staging(quiet = False):
+    """
+    staging.pump on an in-memory queue: a staging whose just_staging.sh exits without calling upd-staging-info
+    is marked failed on the next pump (with no retries left), not left running until staging_timeout.
+    """
+    names = ("read_and_lock_queue", "write_and_unlock_queue", "release_lock_queue", "STAGING_LOG_DIR", "STAGING_STATS_PATH")
+    saved = {name: getattr(staging, name) for name in names}
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "just_staging.sh"), "w") as file:
+                file.write("echo staged without upd-staging-info\n")
+            queue_list = [{"user": "A", "job": {"job_dir": tmp}, "other_info": {"task_id": 1, "staging": staging.new_state()}}]
+            staging.read_and_lock_queue = lambda: queue_list
+            staging.write_and_unlock_queue = staging.release_lock_queue = lambda *args: None
+            staging.STAGING_LOG_DIR, staging.STAGING_STATS_PATH = tmp, os.path.join(tmp, "stats.json")
+            cfg = {"staging_workers": 1, "staging_retries": 0, "staging_timeout": 1800}
+            assert staging.pump(cfg) == 1, "T1, Expected the pending staging to be started"
+            state = queue_list[0]["other_info"]["staging"]
+            for _ in range(100):
+                if not staging._alive(state):
+                    break
+                time.sleep(0.1)
+            staging.pump(cfg)
+            assert state["state"] == "failed", f"T2, Expected the staging that exited to be failed, got {state}"
+            assert state["error"] == "exited before upd-staging-info", f"T3, Unexpected error {state.get('error')}"
+            with open(os.path.join(tmp, "1.log")) as file:
+                assert "staged without upd-staging-info" in file.read(), "T4, Expected the output of just_staging.sh in its log"
+        if not quiet:
+            print(f"{GREEN}[PASSED]{NC} test_staging")
+        return True
+    except Exception as e:
+        print(f"{RED}[FAILED]{NC} test_staging")
+        print(e)
+        return False
+    finally:
+        for name, value in saved.items():
+            setattr(staging, name, value)
+
+def bench_classifier(num_panes = 200, pane_lines = 2000):
+    """
+    Throughput of the status classifier on synthetic tmux panes.
+    """
+    import time, random
+    random.seed(0)
+    lines = [f"step {i}, ep={i / 100:.4f}, loss={random.random():.4f}, lr=0.0001" for i in range(pane_lines)]
+    pane = "\n".join(lines)
+    start = time.time()
+    for _ in range(int(num_panes)):
+        classify(pane, cut=800)
+    used = time.time() - start
+    mb = len(pane) * int(num_panes) / 1e6
+    print(f"{INFO} bench_classifier: {int(num_panes)} panes of {len(pane)} chars in {used:.3f} seconds, "
+          f"{mb / used:.1f} MB/s, {used / int(num_panes) * 1000:.2f} ms per pane")
+
+def bench_sheet(tpu = None, rounds = 3):
+    """
+    Google Sheets API requests and time of the spreadsheet read done by `tpu run` (get_tpu_info_sheet),
+    the first round includes authorizing and opening the sheet. `tpu run` then sends one more request to write the row.
+    """
+    import time
+    from . import sheet
+    for i in range(int(rounds)):
+        calls, start = sheet.SHEET.calls, time.time()
+        if tpu is None:
+            sheet.read_sheet_info()
+        else:
+            sheet.get_tpu_info_sheet(tpu)
+        print(f"{INFO} bench_sheet: round {i + 1}: {sheet.SHEET.calls - calls} API requests in {time.time() - start:.3f} seconds")
+
 def sanity_check():
     if data_io.check_code_lock():
         print(f"{WARNING} Code is locked for developing, skipping sanity checks.")
@@ -175,6 +483,13 @@ def sanity_check():
         test_zombie_jobs,
         test_has_child,
         test_code_locked,
+        test_classifier,
+        test_queue_policy,
+        test_runtime_estimator,
+        test_backfill,
+        test_claims,
+        test_progress,
+        test_staging,
         # test_check_tpu_status,
     ]
     passed, failed = 0, 0
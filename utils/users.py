@@ -30,6 +30,7 @@ class User():
             "monitor_tpu": True,
             "monitor_verbose": False,
             "show_length": 200,
+            "stall_minutes": 30,
             "time_zone": "us",
             "extra_settings": {}
         }
@@ -72,6 +73,7 @@ def user_from_dict(config_dict):
             "monitor_tpu": True,
             "monitor_verbose": False,
             "show_length": 200,
+            "stall_minutes": 30,
             "time_zone": "us",
             "extra_settings": {}
         })
@@ -0,0 +1,218 @@
+import os, time, errno, select, struct, ctypes, ctypes.util
+from .constants import *
+
+# ------------ inotify constants (linux/inotify.h) ----------
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+
+# file systems on which inotify does not see writes from other hosts
+POLL_FS_TYPES = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'fuse', 'fuse.gcsfuse', 'fuse.sshfs', 'lustre', '9p')
+
+DATA_KEY = '__data__'
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+def _read_mounts():
+    """
+    Return a list of (mount_point, fs_type), longest mount point first.
+    """
+    mounts = []
+    try:
+        with open('/proc/mounts', 'r') as file:
+            for line in file:
+                parts = line.split()
+                if len(parts) >= 3:
+                    mounts.append((parts[1].replace('\\040', ' '), parts[2]))
+    except OSError:
+        pass
+    mounts.sort(key=lambda m: len(m[0]), reverse=True)
+    return mounts
+
+
+def needs_polling(path, mounts=None):
+    """
+    Whether changes to path have to be detected by polling (network file systems).
+    """
+    if mounts is None:
+        mounts = _read_mounts()
+    path = os.path.abspath(path)
+    for mount_point, fs_type in mounts:
+        if path == mount_point or path.startswith(mount_point.rstrip('/') + '/'):
+            return fs_type.startswith(POLL_FS_TYPES)
+    return False
+
+
+def _stat_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class LogWatcher:
+    """
+    Watch a set of files (keyed by job) and report which of them changed.
+    Local files are watched with inotify on their parent directory; files on NFS (or when
+    inotify is unavailable) are stat-polled every poll_interval seconds.
+    """
+    def __init__(self, poll_interval=5, debounce=1.0):
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.targets = {}          # key -> path
+        self.poll_state = {}       # key -> stat key, for polled targets
+        self.dir_wd = {}           # dir -> wd
+        self.wd_dir = {}           # wd -> dir
+        self.dir_files = {}        # dir -> {basename: set(keys)}
+        self.mounts = _read_mounts()
+        self.next_poll = 0
+        self.libc = _load_libc()
+        self.fd = -1
+        if self.libc is not None:
+            fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self.fd = fd
+        if self.fd < 0:
+            print(f"{WARNING} LogWatcher: inotify not available, falling back to polling")
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def _add_dir_watch(self, dir_path):
+        if self.fd < 0:
+            return False
+        if dir_path in self.dir_wd:
+            return True
+        wd = self.libc.inotify_add_watch(self.fd, dir_path.encode(), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                print(f"{WARNING} LogWatcher: inotify watch limit reached, polling {dir_path}")
+            return False
+        self.dir_wd[dir_path] = wd
+        self.wd_dir[wd] = dir_path
+        return True
+
+    def _remove_dir_watch(self, dir_path):
+        wd = self.dir_wd.pop(dir_path, None)
+        if wd is not None:
+            self.wd_dir.pop(wd, None)
+            if self.fd >= 0:
+                self.libc.inotify_rm_watch(self.fd, wd)
+
+    def set_targets(self, targets):
+        """
+        targets: dict key -> file path. Replaces the current set of watched files.
+        """
+        targets = {k: os.path.abspath(p) for k, p in targets.items() if p}
+        if targets == self.targets:
+            return
+        self.targets = targets
+        new_dir_files = {}
+        new_poll_state = {}
+        for key, path in targets.items():
+            dir_path, base = os.path.split(path)
+            if (not needs_polling(path, self.mounts)) and os.path.isdir(dir_path) and self._add_dir_watch(dir_path):
+                new_dir_files.setdefault(dir_path, {}).setdefault(base, set()).add(key)
+            else:
+                new_poll_state[key] = self.poll_state.get(key, _stat_key(path))
+        for dir_path in list(self.dir_wd):
+            if dir_path not in new_dir_files:
+                self._remove_dir_watch(dir_path)
+        self.dir_files = new_dir_files
+        self.poll_state = new_poll_state
+
+    def polled_keys(self):
+        return list(self.poll_state)
+
+    def _drain_inotify(self):
+        changed = set()
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            except OSError:
+                break
+            if not buf:
+                break
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(buf):
+                wd, mask, _, name_len = EVENT_HEADER.unpack_from(buf, offset)
+                offset += EVENT_HEADER.size
+                name = buf[offset:offset + name_len].rstrip(b'\0').decode(errors='replace')
+                offset += name_len
+                dir_path = self.wd_dir.get(wd)
+                if dir_path is None:
+                    continue
+                if mask & (IN_IGNORED | IN_DELETE_SELF):
+                    # the directory went away, its files fall back to polling
+                    files = self.dir_files.pop(dir_path, {})
+                    self.dir_wd.pop(dir_path, None)
+                    self.wd_dir.pop(wd, None)
+                    for base, keys in files.items():
+                        for key in keys:
+                            self.poll_state[key] = None
+                            changed.add(key)
+                    continue
+                changed |= self.dir_files.get(dir_path, {}).get(name, set())
+        return changed
+
+    def _poll(self):
+        changed = set()
+        for key in list(self.poll_state):
+            cur = _stat_key(self.targets[key])
+            if cur != self.poll_state[key]:
+                self.poll_state[key] = cur
+                changed.add(key)
+        return changed
+
+    def wait(self, timeout):
+        """
+        Block for at most timeout seconds until at least one target changed.
+        Return the set of changed keys (empty on timeout).
+        """
+        deadline = time.time() + timeout
+        if self.next_poll == 0:
+            self.next_poll = time.time() + self.poll_interval
+        changed = set()
+        while True:
+            now = time.time()
+            if now >= deadline:
+                return changed
+            wait_time = max(0.0, min(deadline, self.next_poll) - now)
+            if self.fd >= 0 and self.dir_wd:
+                ready, _, _ = select.select([self.fd], [], [], wait_time)
+                if ready:
+                    changed |= self._drain_inotify()
+            else:
+                time.sleep(wait_time)
+            if time.time() >= self.next_poll:
+                changed |= self._poll()
+                self.next_poll = time.time() + self.poll_interval
+            if changed:
+                # coalesce a burst of writes into one wake-up
+                time.sleep(self.debounce)
+                if self.fd >= 0 and self.dir_wd:
+                    changed |= self._drain_inotify()
+                return changed
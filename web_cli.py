@@ -58,6 +58,9 @@ except Exception:
     SHEET_MODULE_OK = False
     sheet_mod = None
 
+from utils.classifier import classify
+from utils import tmux, tmux_stream, progress
+
 ANSI_RE = re.compile(r"\x1B\[[0-?]*[ -/]*[@-~]")
 def strip_ansi(s: str) -> str:
     return ANSI_RE.sub("", s or "")
@@ -70,6 +73,7 @@ DEFAULT_SETTINGS = {
     "monitor_tpu": True,
     "monitor_verbose": False,
     "show_length": 200,
+    "stall_minutes": 30,
     "time_zone": "us",
     "extra_settings": {},
 }
@@ -101,94 +105,21 @@ def get_user_obj(username: str) -> Optional[SimpleNamespace]:
     return _user_from_dict(u)
 
 def list_tmux_windows(session_name: str) -> List[Tuple[str, str]]:
-    try:
-        out = subprocess.check_output(
-            ["tmux", "list-windows", "-t", session_name],
-            text=True, stderr=subprocess.STDOUT
-        )
-    except subprocess.CalledProcessError:
-        return []
-    res = []
-    for line in out.splitlines():
-        if not line.strip(): continue
-        try:
-            left = line.split(":")[0].strip()
-            name = line.split(":")[1].split(" ")[0].strip()
-            res.append((left, name))
-        except Exception:
-            continue
-    return res
+    return [(w.index, w.name) for w in tmux.windows_of(session_name)]
 
-def tmux_capture(session: str, window_id: str, last_n: int = 2000) -> str:
-    try:
-        # First, try to get the history limit for this pane
-        # Use -S - to capture from the start of history to current position
-        # -E - means to current position (end)
-        # This ensures we get all available history, not just visible area
-        # We also try to increase history limit if needed by using -S with a large negative number
-        # Calculate approximate line count needed (assuming ~80 chars per line)
-        if last_n > 0:
-            approx_lines = max(50000, (last_n // 80) + 1000)  # Add buffer
-        else:
-            approx_lines = 50000
-        
-        # Try to capture with explicit line range
-        # -S -<n> means start from n lines before current, -E - means end at current
-        # But we want from the very beginning, so use -S - (start of history)
-        out = subprocess.check_output(
-            ["tmux", "capture-pane", "-t", f"{session}:{window_id}", "-p", "-S", "-", "-E", "-"],
-            text=True, stderr=subprocess.STDOUT
-        )
-        out = out.rstrip()
-        
-        # If we got content but it's shorter than expected and we need more,
-        # try to increase history limit temporarily
-        if last_n > 0 and len(out) < last_n:
-            # Try to get more by using a larger history buffer
-            # First check current history limit
-            try:
-                hist_limit_cmd = ["tmux", "show-options", "-t", f"{session}:{window_id}", "-wv", "history-limit"]
-                current_limit = subprocess.check_output(hist_limit_cmd, text=True, stderr=subprocess.STDOUT).strip()
-                current_limit_int = int(current_limit) if current_limit.isdigit() else 2000
-                
-                # If current limit is too small, try to increase it temporarily
-                if current_limit_int < approx_lines:
-                    try:
-                        subprocess.check_output(
-                            ["tmux", "set-option", "-t", f"{session}:{window_id}", "-w", "history-limit", str(approx_lines)],
-                            text=True, stderr=subprocess.STDOUT
-                        )
-                        # Retry capture
-                        out = subprocess.check_output(
-                            ["tmux", "capture-pane", "-t", f"{session}:{window_id}", "-p", "-S", "-", "-E", "-"],
-                            text=True, stderr=subprocess.STDOUT
-                        )
-                        out = out.rstrip()
-                    except Exception:
-                        pass  # If we can't increase limit, use what we have
-            except Exception:
-                pass  # If we can't check/change limit, use what we have
-        
-        if last_n and len(out) > last_n:
-            return out[-last_n:]
-        return out
-    except subprocess.CalledProcessError:
-        return ""
-
-# --------- 状态检测（与 CLI 表达式一致） ---------
-RE_ERR_GENERIC = re.compile(r"(Job failed|[eE]rror|FAIL)")
-RE_OOM_ALLOCTYPE = re.compile(r"Allocation type")
-RE_GRPC = re.compile(r"GRPC [Ee]rror")
-RE_FILE_NOT_FOUND = re.compile(r"python: No such file or directory")
-RE_DEADLINE = re.compile(r"DEADLINE_EXCEEDED")
-RE_COMPILING = re.compile(r"[cC]ompil(ing|ation|e)")
-RE_SAMPLING = re.compile(r"[sS]ampling ")
-RE_EPOCH1 = re.compile(r"[eE]poch\s([0-9]{1,6})")
-RE_EPOCH2 = re.compile(r"ep\s*=\s*([0-9]{1,4}(?:\.[0-9]{1,6})?)")
-RE_INITIALIZING = re.compile(r"[iI]nitializing")
-RE_STAGING = re.compile(r"[sS]taging")
-
-def parse_status(job_data: Dict[str, Any], last_cut: str, last_full: str) -> Tuple[str, str]:
+def tmux_capture(session: str, window_id: str, last_n: int = 2000, activity: Optional[int] = None) -> str:
+    # 已订阅 tmux -C 的 session 直接读内存里的输出尾部；否则只向 tmux 要需要的最后若干行（capture-pane -S -K），
+    # 并与 CLI 共用短时缓存；window_activity 未变时直接用缓存
+    out = tmux_stream.pane_tail(session, window_id, chars=last_n if last_n > 0 else None, activity=activity)
+    if last_n and len(out) > last_n:
+        return out[-last_n:]
+    return out
+
+# --------- 状态检测（与 CLI 共用 utils/classifier.py） ---------
+ERROR_LABELS = {"OOM": "OOM Error", "grpc": "GRPC Error", "file error": "File Error",
+                "invalid pointer": "Invalid Pointer", "deadline exceeded": "DEADLINE EXCEEDED"}
+
+def parse_status(job_data: Dict[str, Any], last_cut: str, last_full: str, result=None) -> Tuple[str, str]:
     st = job_data.get("status")
     if st == "starting": return ("Don't have logdir yet", "warn")
     if st == "error":
@@ -203,34 +134,21 @@ def parse_status(job_data: Dict[str, Any], last_cut: str, last_full: str) -> Tup
         return (f"{msg} (child={child})" if child is not None else msg, "warn")
     if st == "finished": return ("Finished", "success")
     # running/starting/None
-    if RE_ERR_GENERIC.search(last_cut):
-        if RE_OOM_ALLOCTYPE.search(last_full): return ("OOM Error", "error")
-        if RE_GRPC.search(last_full): return ("GRPC Error", "error")
-        if RE_FILE_NOT_FOUND.search(last_full): return ("File Error", "error")
-        if RE_DEADLINE.search(last_full): return ("DEADLINE EXCEEDED", "error")
-        return ("Unknown Error", "error")
-    if RE_COMPILING.search(last_cut): return ("Compiling", "info")
-    if RE_SAMPLING.search(last_cut):
-        m1 = RE_EPOCH1.search(last_cut) or RE_EPOCH2.search(last_cut)
-        if m1:
-            try:
-                epf = float(m1.group(1))
-                return (f"Sampling (ep={epf:.2f})", "info")
-            except Exception:
-                return (f"Sampling (ep={m1.group(1)})", "info")
-        return ("Sampling", "info")
-    m1 = RE_EPOCH1.search(last_cut)
-    m2 = RE_EPOCH2.search(last_cut)
-    print(f'last_cut: {last_cut}, m1: {m1}, m2: {m2}')
-    if m1: return (f"Running (ep={m1.group(1)})", "success")
-    if m2:
-        try: return (f"Running (ep={float(m2.group(1)):.2f})", "success")
-        except Exception: return (f"Running (ep={m2.group(1)})", "success")
-    if RE_INITIALIZING.search(last_cut): return ("Initializing", "info")
-    if RE_STAGING.search(last_cut): return ("Staging", "info")
+    if result is None:
+        result = classify(last_full, cut=len(last_cut))
+    if result.state == "error": return (ERROR_LABELS.get(result.error, "Unknown Error"), "error")
+    if result.state == "compiling": return ("Compiling", "info")
+    if result.state == "sampling":
+        if result.epoch is None: return ("Sampling", "info")
+        return (f"Sampling (ep={float(result.epoch):.2f})", "info")
+    if result.state == "running":
+        if "." not in result.epoch: return (f"Running (ep={result.epoch})", "success")
+        return (f"Running (ep={float(result.epoch):.2f})", "success")
+    if result.state == "initializing": return ("Initializing", "info")
+    if result.state == "staging": return ("Staging", "info")
     return ("Unknown", "warn")
 
-def summarize_job_row(user_obj: SimpleNamespace, window_id: str, job_data: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+def summarize_job_row(user_obj: SimpleNamespace, window_id: str, job_data: Optional[Dict[str, Any]], activity: Optional[int] = None) -> Optional[Dict[str, Any]]:
     # 只渲染 job_data 存在的窗口，并且 dir/tpu 不可 unknown
     if not job_data:
         return None
@@ -239,7 +157,7 @@ def summarize_job_row(user_obj: SimpleNamespace, window_id: str, job_data: Optio
     show_length = int(settings.get("show_length", DEFAULT_SETTINGS["show_length"]))
     monitor_length = int(settings.get("monitor_length", DEFAULT_SETTINGS["monitor_length"]))
 
-    last_full = tmux_capture(user_obj.tmux_name, window_id, last_n=max(monitor_length, show_length))
+    last_full = tmux_capture(user_obj.tmux_name, window_id, last_n=max(monitor_length, show_length), activity=activity)
     last_cut = last_full[-monitor_length:] if last_full else ""
 
     try:
@@ -256,7 +174,23 @@ def summarize_job_row(user_obj: SimpleNamespace, window_id: str, job_data: Optio
     if dir_ in ("(unknown)", "", None) or tpu_show in ("(unknown)", "", None, "unknown"):
         return None
 
-    s_text, s_cls = parse_status(job_data, last_cut, last_full)
+    result = None
+    if job_data.get("status") in ("running", "starting", None):
+        # 尾部看不出错误类型时，再从整个 pane 历史里找
+        result = classify(last_full, cut=len(last_cut), history=lambda: tmux.capture_pane(user_obj.tmux_name, window_id))
+    s_text, s_cls = parse_status(job_data, last_cut, last_full, result=result)
+
+    # 记录 epoch 进度，显示速度 / ETA；长时间没有前进的任务标为 stalled
+    p_text, p_cls = "", "muted"
+    if result is not None and result.state in ("running", "sampling"):
+        summary = progress.observe(job_data, result.epoch,
+                                   stall_minutes=settings.get("stall_minutes", progress.STALL_MINUTES))
+        if summary is not None and summary["stalled"]:
+            p_text, p_cls = f"Stalled {progress.format_duration(summary['idle'])}", "error"
+        elif summary is not None:
+            p_text = progress.format_rate(summary["rate"])
+            if summary["eta"] is not None:
+                p_text += f" · ETA {progress.format_duration(summary['eta'])}"
 
     return {
         "window": str(window_id),
@@ -265,6 +199,8 @@ def summarize_job_row(user_obj: SimpleNamespace, window_id: str, job_data: Optio
         "tags": str(job_data.get("job_tags") or ""),
         "status": s_text,
         "status_class": s_cls,
+        "progress": p_text,
+        "progress_class": p_cls,
         "in_data": True,
     }
 
@@ -272,14 +208,15 @@ def build_job_rows(username: str) -> Dict[str, Any]:
     user_obj = get_user_obj(username)
     if not user_obj:
         return {"jobs": [], "session_exists": False, "error": f"user '{username}' not found"}
-    windows = list_tmux_windows(user_obj.tmux_name)
+    tmux_stream.HUB.watch(user_obj.tmux_name)  # 之后该用户的表格与日志页都从 control-mode 流读取
+    windows = tmux.windows_of(user_obj.tmux_name)
     job_map = {}
     for job in getattr(user_obj, "job_data", []):
         try: job_map[str(job.get("windows_id"))] = job
         except Exception: continue
     rows: List[Dict[str, Any]] = []
-    for wid, _ in windows:
-        row = summarize_job_row(user_obj, wid, job_map.get(str(wid)))
+    for w in windows:
+        row = summarize_job_row(user_obj, w.index, job_map.get(w.index), activity=w.activity)
         if row is not None:
             rows.append(row)
     return {"jobs": rows, "session_exists": True}
@@ -647,22 +584,22 @@ def start_thread(target, *a, **kw):
     return th
 
 # ---------- Spreadsheet（严格使用 read_sheet_info） ----------
-def _get_tpu_information_all() -> Dict[str, Dict[str, Any]]:
-    """read_sheet_info() -> {full_name: info_dict}"""
+def _get_tpu_information_all(fresh: bool = False) -> Dict[str, Dict[str, Any]]:
+    """read_sheet_info() -> {full_name: info_dict}，默认用各进程共享的快照（见 sheet.SHEET_CACHE_TTL），fresh 时直接读表"""
     if not SHEET_MODULE_OK:
         return {}
     if hasattr(sheet_mod, 'read_sheet_info'):
         try:
-            info = sheet_mod.read_sheet_info()  # type: ignore
+            info = sheet_mod.read_sheet_info(max_age=0) if fresh else sheet_mod.read_sheet_info()  # type: ignore
             if isinstance(info, dict):
                 return {str(k): (v or {}) for k, v in info.items()}
         except Exception:
             pass
     return {}
 
-def fetch_tpu_sheet_rows() -> List[Dict[str, Any]]:
+def fetch_tpu_sheet_rows(fresh: bool = False) -> List[Dict[str, Any]]:
     """扁平化 read_sheet_info() 结果供 UI 使用"""
-    info_all = _get_tpu_information_all()
+    info_all = _get_tpu_information_all(fresh)
     rows: List[Dict[str, Any]] = []
     for full_name, info in sorted(info_all.items(), key=lambda x: str(x[0])):
         alias = str(info.get('alias') or full_name)
@@ -918,6 +855,7 @@ BASE_HTML = r"""
             <td class="mono nowrap">{{ j.tpu }}</td>
             <td class="tags-cell">{{ j.tags }}</td>
             <td><span class="status s-{{ j.status_class }}"><span class="dot"></span>{{ j.status }}</span></td>
+            <td class="mono nowrap {% if j.progress_class == 'error' %}s-error{% else %}muted{% endif %}">{{ j.progress }}</td>
             <td class="actions">
               {% if j.in_data %}
                 <button class="btn" onclick="doResume('{{ j.window }}')">Resume</button>
@@ -1174,6 +1112,7 @@ async function refreshJobs(){
       <td class="mono nowrap">${j.tpu||""}</td>
       <td class="tags-cell">${j.tags||""}</td>
       <td><span class="status s-${j.status_class}"><span class="dot"></span>${j.status}</span></td>
+      <td class="mono nowrap ${j.progress_class === 'error' ? 's-error' : 'muted'}">${j.progress||""}</td>
       <td class="actions">
         ${ j.in_data ? `
           <button class="btn" onclick="doResume('${j.window}')">Resume</button>
@@ -1911,6 +1850,7 @@ TPU_PANEL_HTML = r"""
       <div class="users">
         <a class="user-pill" href="{{ url_for('index') }}">← 返回用户页</a>
         <strong style="margin-left:8px">TPU 面板（以 spreadsheet 为准）</strong>
+        <span id="sheet-age" class="muted" style="margin-left:8px"></span>
       </div>
     </div>
   </div>
@@ -2652,7 +2592,7 @@ async function loadPanel(forceRefresh = false){
   // If force refresh or more than 30 seconds have passed, read from API
   if(forceRefresh || timeSinceLastRead >= SHEET_READ_INTERVAL || !cachedPanelData){
     try {
-      const res = await fetch(`{{ url_for('api_list_tpus') }}`);
+      const res = await fetch(`{{ url_for('api_list_tpus') }}` + (forceRefresh ? '?fresh=1' : ''));
       const data = await res.json();
       cachedPanelData = data;
       lastSheetReadTime = now;
@@ -2670,6 +2610,12 @@ async function loadPanel(forceRefresh = false){
   // Use cached data if available
   const data = cachedPanelData;
   if(!data) return;
+
+  // 数据新旧：服务端快照的年龄 + 浏览器缓存的时间
+  if(data.age !== null && data.age !== undefined){
+    const age = Math.round(data.age + (Date.now() - lastSheetReadTime) / 1000);
+    document.getElementById('sheet-age').textContent = `spreadsheet 数据 ${age}s 前`;
+  }
   
   const tbody = document.getElementById('panel-body');
   tbody.innerHTML = "";
@@ -3789,10 +3735,11 @@ def op_status(tid: str):
 @require_auth
 def api_list_tpus():
     try:
-        rows = fetch_tpu_sheet_rows()
+        rows = fetch_tpu_sheet_rows(fresh=request.args.get("fresh") == "1")
     except Exception as e:
         return jsonify({"ok": False, "msg": str(e), "rows": []})
-    return jsonify({"ok": True, "rows": rows})
+    age = sheet_mod.snapshot_age() if SHEET_MODULE_OK and hasattr(sheet_mod, "snapshot_age") else None
+    return jsonify({"ok": True, "rows": rows, "age": age})
 
 @app.route("/api/tpu-gcloud-counts")
 @require_auth